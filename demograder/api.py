@@ -0,0 +1,153 @@
+"""A read-only JSON API for the status of submissions and results.
+
+This is for scripts, browser extensions, and the fallback of our own pages
+(see static/main.js) that only want to know whether results are done. The
+views check permissions with get_context() like the pages do, but only read
+the return codes of the results, and never render templates. Responses have
+an ETag, so clients that poll with If-None-Match get an empty 304 response
+until the status changes.
+"""
+
+from flask import Blueprint, abort, jsonify, request, url_for
+from sqlalchemy import func, select
+
+from .context import get_context
+from .instrumentation import query_budget
+from .models import db, Result
+
+blueprint = Blueprint('api', __name__, url_prefix='/api')
+
+
+def result_status(return_code):
+    if return_code is None:
+        return 'tbd'
+    elif return_code == 0:
+        return 'pass'
+    else:
+        return 'fail'
+
+
+def result_url_prefix():
+    """Get the URL of the result pages, without the result ID.
+
+    This must be called in a request; the prefix can then be used in
+    streamed responses, after the request context is gone.
+    """
+    return url_for('demograder.result_view', result_id=0)[:-1]
+
+
+def submission_status(return_codes, result_url):
+    """Summarize the results of a submission.
+
+    Parameters:
+        return_codes (Dict[int, Optional[int]]): The return codes of the
+            results of the submission, by result ID.
+        result_url (str): The URL prefix of the result pages, from
+            result_url_prefix().
+
+    Returns:
+        Dict[str, Any]: The ID, status, and URL of each result, in order,
+            and the number of results that passed, failed, and are pending.
+    """
+    statuses = [
+        (result_id, result_status(return_code))
+        for result_id, return_code in sorted(return_codes.items())
+    ]
+    return {
+        'results': [
+            {'id': result_id, 'status': status, 'url': f'{result_url}{result_id}'}
+            for result_id, status in statuses
+        ],
+        'passed': sum(1 for _, status in statuses if status == 'pass'),
+        'failed': sum(1 for _, status in statuses if status == 'fail'),
+        'pending': sum(1 for _, status in statuses if status == 'tbd'),
+    }
+
+
+def queue_position(submission_id):
+    """Count the results queued before the pending results of a submission.
+
+    Parameters:
+        submission_id (int): The ID of the submission.
+
+    Returns:
+        int: The number of unfinished results (including those being
+            evaluated) that were queued before the earliest pending result
+            of the submission, or 0 if it has no pending results.
+    """
+    first_queued_at = (
+        select(func.min(Result.queued_at))
+        .where(Result.submission_id == submission_id, Result.return_code.is_(None))
+        .scalar_subquery()
+    )
+    return db.session.scalar(
+        select(func.count(Result.id))
+        .where(Result.return_code.is_(None), Result.queued_at < first_queued_at)
+    )
+
+
+def json_response(data):
+    """Respond with JSON that clients can revalidate with its ETag.
+
+    Parameters:
+        data (Dict[str, Any]): The response data.
+
+    Returns:
+        Response: The response, or a 304 response if the client already has
+            the same data.
+    """
+    response = jsonify(data)
+    # the status belongs to the user and may change at any time
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@blueprint.route('/submission/<int:submission_id>')
+@query_budget(10)
+def submission_status_view(submission_id):
+    context = get_context(submission_id=submission_id)
+    submission = context['submission']
+    if not submission:
+        abort(404)
+    return_codes = dict(db.session.execute(
+        select(Result.id, Result.return_code)
+        .where(Result.submission_id == submission_id)
+    ).all())
+    data = {
+        'id': submission.id,
+        'question_id': submission.question_id,
+        'user_id': submission.user_id,
+        'timestamp': submission.timestamp.isoformat(),
+        'disabled': submission.disabled,
+        **submission_status(return_codes, result_url_prefix()),
+        'queue_position': None,
+    }
+    if data['pending']:
+        data['queue_position'] = queue_position(submission_id)
+    return json_response(data)
+
+
+@blueprint.route('/result/<int:result_id>')
+@query_budget(10)
+def result_status_view(result_id):
+    context = get_context(result_id=result_id)
+    result = context['result']
+    if not result:
+        abort(404)
+    return json_response({
+        'id': result.id,
+        'submission_id': result.submission_id,
+        'status': result_status(result.return_code),
+        'queued_at': (result.queued_at.isoformat() if result.queued_at else None),
+        'finished_at': (result.finished_at.isoformat() if result.finished_at else None),
+        'url': url_for('demograder.result_view', result_id=result.id),
+    })
+
+
+@blueprint.errorhandler(401)
+@blueprint.errorhandler(403)
+@blueprint.errorhandler(404)
+def error_response(error):
+    # the pages redirect or render HTML errors, which scripts cannot use
+    return jsonify({'error': error.name}), error.code
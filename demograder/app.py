@@ -2,15 +2,26 @@ from pathlib import Path
 
 from flask import Flask
 
+from .api import blueprint as api_blueprint
 from .auth import oauth, blueprint as auth_blueprint
+from .cache import LRUCache
+from .commands import COMMANDS
+from .database import configure_engine
+from .events import init_result_events
+from .fragments import init_fragment_cache
+from .highlight import init_highlighter
+from .instrumentation import init_instrumentation
+from .metrics import init_metrics
 from .models import db
 from .routes import blueprint as routes_blueprint
-from .dispatch import create_job_queue
+from .traffic import init_traffic_capture
+from .dispatch import create_job_queue, create_result_writer
+from .migrations import upgrade_database
 
 from .fixtures import install_fixtures
 
 
-def create_app(with_queue=True):
+def create_app(with_queue=True, init_database=None):
     # create app
     app = Flask(
         __name__,
@@ -21,6 +32,10 @@ def create_app(with_queue=True):
     app.secret_key = app.config['FLASK_SECRET_KEY']
     # initialize extensions
     db.init_app(app)
+    configure_engine(app, db)
+    init_instrumentation(app, db)
+    app.metrics = init_metrics(app)
+    init_traffic_capture(app)
     oauth.init_app(app)
     oauth.register(
         name='google',
@@ -29,14 +44,34 @@ def create_app(with_queue=True):
             'scope': 'openid email profile',
         }
     )
-    # initialize the database
-    with app.app_context():
-        db.create_all()
-    install_fixtures(app)
+    # initialize the database; by default only the web app does this, since
+    # upgrading reflects every table, and worker jobs each create an app
+    if init_database is None:
+        init_database = with_queue
+    if init_database:
+        upgrade_database(app)
+        install_fixtures(app)
+    # initialize caches
+    app.identity_cache = LRUCache(
+        max_size=app.config['IDENTITY_CACHE_SIZE'],
+        ttl=app.config['IDENTITY_CACHE_SECONDS'],
+    )
+    app.identity_generation = None
+    app.fragment_cache = init_fragment_cache(app)
+    app.highlighter = init_highlighter(app)
+    app.result_events = init_result_events(app)
+    app.metrics.gauge('demograder_event_streams', app.result_events.num_subscribers)
     if with_queue:
         app.job_queue = create_job_queue(app)
+        app.result_writer = create_result_writer(app)
+        app.metrics.start()
+        app.result_events.start()
     # register blueprints
     app.register_blueprint(routes_blueprint)
     app.register_blueprint(auth_blueprint)
+    app.register_blueprint(api_blueprint)
+    # register commands
+    for command in COMMANDS:
+        app.cli.add_command(command)
     # return
     return app
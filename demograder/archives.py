@@ -0,0 +1,56 @@
+"""Streaming ZIP archives of files on disk."""
+
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+
+CHUNK_SIZE = 64 * 1024
+
+
+class _ChunkBuffer:
+    """A write-only, unseekable file that collects the chunks written to it.
+
+    Since it cannot seek, ZipFile writes each member's sizes and CRC after
+    its data instead of going back to fill in the header.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks = self.chunks
+        self.chunks = []
+        return chunks
+
+
+def stream_zip(entries, compress=True):
+    """Generate a ZIP archive in chunks, without holding it in memory.
+
+    Parameters:
+        entries (Iterable[Tuple[str, Path]]): The name in the archive and the
+            path on disk of each file. Missing files are skipped.
+        compress (bool): Whether to deflate the files, or only store them.
+            Defaults to True.
+
+    Yields:
+        bytes: The next chunk of the archive.
+    """
+    compression = (ZIP_DEFLATED if compress else ZIP_STORED)
+    buffer = _ChunkBuffer()
+    with ZipFile(buffer, 'w', compression=compression) as zip_file:
+        for name, path in entries:
+            if not path.is_file():
+                continue
+            info = ZipInfo.from_file(path, name)
+            info.compress_type = compression
+            with path.open('rb') as source, zip_file.open(info, 'w') as destination:
+                while chunk := source.read(CHUNK_SIZE):
+                    destination.write(chunk)
+                    yield from buffer.drain()
+            yield from buffer.drain()
+    yield from buffer.drain()
@@ -0,0 +1,304 @@
+"""Page and evaluation pipeline benchmarks.
+
+Each page is requested several times as a typical viewer, and its median
+latency and its query count (from the Server-Timing header; see
+instrumentation.py) are compared against a stored baseline. Query counts do
+not depend on the machine, so any increase is a regression; latencies are
+only compared within a tolerance.
+
+Run these on a database from generate_dataset() (see the generate-data and
+benchmark-pages commands in commands.py), so the numbers are comparable.
+
+The pipeline benchmark re-evaluates submissions through the real dispatch,
+job queue, worker, and result writer, and measures how long each stage
+takes. It is meant to be run with the "fake" sandbox (see workers.py), so
+that it needs no root and the script duration is known.
+"""
+
+import json
+import re
+import resource
+from collections import defaultdict, namedtuple
+from datetime import datetime as DateTime
+from statistics import median
+from time import perf_counter, sleep
+
+from sqlalchemy import distinct, func, select
+
+from .dispatch import enqueue_reevaluate_submission
+from .latency import percentile
+from .models import db, User, Instructor, Student, Assignment, Question, Submission, Result
+
+SERVER_TIMING_REGEX = re.compile(r'db;dur=([0-9.]+);desc="([0-9]+) queries"')
+
+# the pages to benchmark, with the viewer and the endpoint arguments; the
+# arguments are names of objects from benchmark_objects()
+Page = namedtuple('Page', 'name, viewer, endpoint, arguments')
+
+PAGES = [
+    Page('course_view', 'instructor', 'demograder.course_view', {'course_id': 'course'}),
+    Page('course_view (student)', 'student', 'demograder.course_view', {'course_id': 'course'}),
+    Page('submission_view', 'student', 'demograder.submission_view', {'submission_id': 'submission'}),
+    Page('question_grades_view', 'instructor', 'demograder.question_grades_view', {'question_id': 'question'}),
+    Page('assignment_grades_view', 'instructor', 'demograder.assignment_grades_view', {'assignment_id': 'assignment'}),
+    Page('user_view', 'student', 'demograder.user_view', {'page_user_email': 'student_email'}),
+    Page('admin_users_view', 'admin', 'demograder.admin_users_view', {}),
+    Page('admin_courses_view', 'admin', 'demograder.admin_courses_view', {}),
+    Page('admin_submissions_view', 'admin', 'demograder.admin_submissions_view', {}),
+]
+
+
+class BenchmarkError(Exception):
+    """Raised when a benchmark cannot run, eg. on an empty database."""
+
+
+def benchmark_objects():
+    """Pick the objects to benchmark the pages with.
+
+    The busiest question is used, along with its assignment and course, its
+    instructor, and the student with the most submissions to it.
+
+    Returns:
+        Dict[str, Any]: The IDs and emails of the objects, by name.
+
+    Raises:
+        BenchmarkError: If there are no student submissions, or no admin or
+            instructor to view the pages as.
+    """
+    row = db.session.execute(
+        select(Submission.question_id, Submission.user_id, func.count(Submission.id).label('count'))
+        .join(Question, Submission.question_id == Question.id)
+        .join(Assignment, Question.assignment_id == Assignment.id)
+        .join(Student, (Student.user_id == Submission.user_id) & (Student.course_id == Assignment.course_id))
+        .group_by(Submission.question_id, Submission.user_id)
+        .order_by(func.count(Submission.id).desc(), Submission.question_id, Submission.user_id)
+        .limit(1)
+    ).first()
+    if row is None:
+        raise BenchmarkError('there are no student submissions to benchmark with')
+    question = db.session.get(Question, row.question_id)
+    student = db.session.get(User, row.user_id)
+    objects = {
+        'course': question.assignment.course_id,
+        'assignment': question.assignment_id,
+        'question': question.id,
+        'submission': db.session.scalar(
+            select(Submission.id)
+            .where(Submission.question_id == question.id, Submission.user_id == student.id)
+            .order_by(Submission.timestamp.desc(), Submission.id.desc())
+        ),
+        'student_email': student.email,
+        'viewers': {
+            'admin': db.session.scalar(select(User.email).where(User.admin == True).order_by(User.id)),
+            'instructor': db.session.scalar(
+                select(User.email)
+                .join(Instructor, Instructor.user_id == User.id)
+                .where(Instructor.course_id == question.assignment.course_id)
+                .order_by(User.id)
+            ),
+            'student': student.email,
+        },
+    }
+    for viewer, email in objects['viewers'].items():
+        if email is None:
+            raise BenchmarkError(f'there is no {viewer} to view the pages as; run the upgrade-database command')
+    return objects
+
+
+def benchmark_pages(app, repeat=5, pages=None):
+    """Request pages repeatedly and measure them.
+
+    Parameters:
+        app (Flask): The Flask app.
+        repeat (int): The number of times to request each page, after one
+            warm-up request. Defaults to 5.
+        pages (List[Page]): The pages to benchmark. Defaults to PAGES.
+
+    Returns:
+        Dict[str, Dict[str, float]]: The median seconds, and the number of
+            queries, of each page.
+
+    Raises:
+        BenchmarkError: If a page does not respond successfully, or does not
+            report its queries in a Server-Timing header.
+    """
+    if pages is None:
+        pages = PAGES
+    app.config['SERVER_TIMING'] = True
+    with app.app_context():
+        objects = benchmark_objects()
+        with app.test_request_context():
+            urls = [
+                app.url_for(page.endpoint, **{
+                    argument: objects[name] for argument, name in page.arguments.items()
+                })
+                for page in pages
+            ]
+    client = app.test_client()
+    measurements = {}
+    for page, url in zip(pages, urls):
+        with client.session_transaction() as session:
+            session['user_email'] = objects['viewers'][page.viewer]
+        timings = []
+        for iteration in range(repeat + 1):
+            start = perf_counter()
+            response = client.get(url)
+            seconds = perf_counter() - start
+            if response.status_code != 200:
+                raise BenchmarkError(f'{page.name} ({url}) responded with {response.status_code}')
+            # the first request warms up the caches
+            if iteration == 0:
+                continue
+            timings.append(seconds)
+            queries = None
+            for header in response.headers.getlist('Server-Timing'):
+                match = SERVER_TIMING_REGEX.fullmatch(header)
+                if match:
+                    queries = int(match.group(2))
+            if queries is None:
+                raise BenchmarkError(f'{page.name} ({url}) did not report its queries in a Server-Timing header')
+        measurements[page.name] = {
+            'seconds': round(median(timings), 6),
+            'queries': queries,
+        }
+    return measurements
+
+
+def compare_to_baseline(measurements, baseline, tolerance=0.5):
+    """Find the pages that regressed from a baseline.
+
+    Parameters:
+        measurements (Dict[str, Dict[str, float]]): The measurements, as
+            returned by benchmark_pages().
+        baseline (Dict[str, Dict[str, float]]): The baseline measurements.
+        tolerance (float): The fraction a page may be slower than its
+            baseline. Defaults to 0.5.
+
+    Returns:
+        List[str]: A description of each regression.
+    """
+    regressions = []
+    for name, measurement in measurements.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        if measurement['queries'] is not None and expected['queries'] is not None:
+            if measurement['queries'] > expected['queries']:
+                regressions.append(f'{name} ran {measurement["queries"]} queries (baseline {expected["queries"]})')
+        if measurement['seconds'] > expected['seconds'] * (1 + tolerance):
+            regressions.append(
+                f'{name} took {measurement["seconds"] * 1000:.1f} ms (baseline {expected["seconds"] * 1000:.1f} ms)'
+            )
+    return regressions
+
+
+def load_baseline(path):
+    with path.open(encoding='utf-8') as fd:
+        return json.load(fd)
+
+
+def save_baseline(path, measurements):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open('w', encoding='utf-8') as fd:
+        json.dump(measurements, fd, indent=4, sort_keys=True)
+        fd.write('\n')
+
+
+def benchmark_pipeline(app, submissions=50, timeout=600):
+    """Re-evaluate submissions through the evaluation pipeline.
+
+    Parameters:
+        app (Flask): The Flask app, with a job queue and a result writer.
+        submissions (int): The number of submissions to re-evaluate; the
+            latest submissions with results are used. Defaults to 50.
+        timeout (float): The number of seconds to wait for the results.
+            Defaults to 600.
+
+    Returns:
+        Dict[str, Any]: The number of results and the seconds they took, the
+            throughput in results per second, the p50 and p95 of each stage
+            in seconds, and the maximum resident memory in MiB of this
+            process and of the largest worker.
+
+    Raises:
+        BenchmarkError: If there are no submissions with results, or if the
+            results take too long.
+    """
+    jobs = defaultdict(lambda: {'wait': [], 'run': []})
+    worker_rss = []
+    monitor = app.job_queue.monitor
+
+    def record_job(job_data, error):
+        worker_rss.append(job_data.max_rss)
+        jobs[job_data.function.__name__]['wait'].append(job_data.started_at - job_data.queued_at)
+        jobs[job_data.function.__name__]['run'].append(job_data.finished_at - job_data.started_at)
+        if monitor is not None:
+            monitor(job_data, error)
+
+    app.job_queue.monitor = record_job
+    with app.app_context():
+        submission_ids = db.session.scalars(
+            select(Submission.id)
+            .where(select(Result.id).where(Result.submission_id == Submission.id).exists())
+            .order_by(Submission.id.desc())
+            .limit(submissions)
+        ).all()
+        if not submission_ids:
+            raise BenchmarkError('there are no submissions with results to re-evaluate')
+        queued_after = DateTime.now()
+        start = perf_counter()
+        for submission_id in submission_ids:
+            enqueue_reevaluate_submission(submission_id)
+        # the results of a submission are created together, so the pipeline is
+        # done when every submission has new results and all are finished
+        statement = (
+            select(
+                func.count(distinct(Result.submission_id)),
+                func.count(Result.id) - func.count(Result.finished_at),
+            )
+            .where(Result.submission_id.in_(submission_ids), Result.queued_at >= queued_after)
+        )
+        while True:
+            sleep(0.05)
+            # end the read transaction to see new commits
+            db.session.close()
+            evaluated, unfinished = db.session.execute(statement).one()
+            if evaluated == len(submission_ids) and unfinished == 0:
+                break
+            if perf_counter() - start > timeout:
+                raise BenchmarkError(f'only {evaluated} of {len(submission_ids)} submissions finished in {timeout} s')
+        seconds = perf_counter() - start
+        results = db.session.execute(
+            select(Result.queued_at, Result.started_at, Result.finished_at)
+            .where(Result.submission_id.in_(submission_ids), Result.queued_at >= queued_after)
+        ).all()
+    app.job_queue.monitor = monitor
+    script_seconds = app.config['FAKE_SANDBOX_SECONDS'] if app.config['EVALUATION_SANDBOX'] == 'fake' else 0
+    stages = {
+        # from the request to the start of the script, including planning the results
+        'queued': [(result.started_at - result.queued_at).total_seconds() for result in results],
+        # from the end of the script until the output is committed
+        'saving': [(result.finished_at - result.started_at).total_seconds() - script_seconds for result in results],
+        'total': [(result.finished_at - result.queued_at).total_seconds() for result in results],
+    }
+    for name, times in jobs.items():
+        stages[f'{name} wait'] = times['wait']
+        stages[f'{name} run'] = times['run']
+    if 'evaluate_result' in jobs:
+        # process and app startup, and copying files, of each evaluation
+        stages['evaluate_result overhead'] = [seconds - script_seconds for seconds in jobs['evaluate_result']['run']]
+    report = {
+        'results': len(results),
+        'seconds': seconds,
+        'throughput': len(results) / seconds,
+        'stages': {},
+        'memory': {
+            # in KiB on Linux
+            'parent_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'worker_mib': max(worker_rss, default=0) / 1024,
+        },
+    }
+    for name, times in stages.items():
+        times.sort()
+        report['stages'][name] = {'p50': percentile(times, 0.5), 'p95': percentile(times, 0.95)}
+    return report
@@ -0,0 +1,151 @@
+"""Small in-process caches."""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Any, Dict, Hashable, Optional
+
+__all__ = ['LRUCache']
+
+
+class LRUCache:
+    """A thread-safe least-recently-used cache with optional expiry.
+
+    The cache is local to the process, so with multiple (gunicorn) worker
+    processes each has its own copy. Entries should therefore either be safe
+    to serve slightly stale until they expire, or be explicitly invalidated.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None, max_bytes: Optional[int] = None):
+        """Initialize the LRUCache.
+
+        Parameters:
+            max_size (int): The maximum number of entries. Defaults to 1024.
+            ttl (float): The number of seconds an entry stays valid, or None
+                if entries never expire. Defaults to None.
+            max_bytes (int): The maximum total len() of the values, or None
+                if values are not measured. Values larger than this are not
+                cached. Defaults to None.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict = OrderedDict()
+        self._bytes = 0
+        self._mutex = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        """Return the number of entries, including expired ones."""
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get a cached value.
+
+        Parameters:
+            key (Hashable): The key of the value.
+            default (Any): The value to return if the key is not cached.
+
+        Returns:
+            Any: The cached value, or the default.
+        """
+        with self._mutex:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and entry[0] < monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Cache a value, evicting the least recently used entry if necessary.
+
+        Parameters:
+            key (Hashable): The key of the value.
+            value (Any): The value to cache.
+        """
+        if self.ttl is None:
+            expiry = float('inf')
+        else:
+            expiry = monotonic() + self.ttl
+        size = self._size(value)
+        with self._mutex:
+            if key in self._entries:
+                self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._entries[key] = (expiry, value)
+            self._bytes += size
+            while len(self._entries) > self.max_size or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Remove a cached value.
+
+        Parameters:
+            key (Hashable): The key of the value.
+            default (Any): The value to return if the key is not cached.
+
+        Returns:
+            Any: The removed value, or the default.
+        """
+        with self._mutex:
+            entry = self._remove(key)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def clear(self) -> None:
+        """Remove all cached values."""
+        with self._mutex:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _size(self, value):
+        if self.max_bytes is None:
+            return 0
+        return len(value)
+
+    def _remove(self, key):
+        # must be called with the mutex held
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= self._size(entry[1])
+        return entry
+
+    @property
+    def hit_rate(self) -> float:
+        """Return the fraction of lookups that were hits.
+
+        Returns:
+            float: The hit rate, or 0 if there have been no lookups.
+        """
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return self.hits / lookups
+
+    def stats(self) -> Dict[str, Any]:
+        """Return statistics about the cache.
+
+        Returns:
+            Dict[str, Any]: The size, bytes, hits, misses, evictions, and hit
+                rate.
+        """
+        return {
+            'size': len(self),
+            'max_size': self.max_size,
+            'bytes': self._bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate,
+        }
@@ -0,0 +1,316 @@
+"""Maintenance commands.
+
+Run these with `flask --app "demograder:create_app(with_queue=False)" <command>`.
+Apps created this way do not create or upgrade the database; run
+upgrade-database first after changing the models.
+"""
+
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import func, select
+
+from .benchmarks import BenchmarkError, benchmark_pages, benchmark_pipeline
+from .benchmarks import compare_to_baseline, load_baseline, save_baseline
+from .context import forget_identities
+from .database_checks import check_database, prepare_replica
+from .enrollment import parse_roster, sync_enrollment
+from .fixtures import install_fixtures
+from .migrations import migrate_result_outputs, migrate_submission_files, upgrade_database
+from .models import db, Course, SubmissionFile
+from .query_plans import advise_indexes, check_query_plans
+from .storage import collect_garbage
+from .synthetic import generate_dataset
+from .traffic import load_trace, replay_trace
+
+BASELINE_PATH = Path(__file__).expanduser().resolve().parent.parent / 'benchmarks' / 'pages.json'
+
+
+@click.command('upgrade-database')
+@with_appcontext
+def upgrade_database_command():
+    """Create missing tables, columns, and indexes."""
+    upgrade_database(current_app)
+    install_fixtures(current_app)
+    click.echo('upgraded the database')
+
+
+@click.command('migrate-outputs')
+@click.option('--batch-size', default=1000, show_default=True, help='Results per transaction.')
+@with_appcontext
+def migrate_outputs_command(batch_size):
+    """Move result output into the compressed blob store."""
+    report = migrate_result_outputs(batch_size=batch_size)
+    saved = report['inline_bytes'] - report['blob_bytes']
+    click.echo(f'migrated {report["results"]} results')
+    click.echo(f'{report["inline_bytes"]} bytes of inline output stored in {report["blob_bytes"]} bytes of new blobs')
+    click.echo(f'{saved} bytes saved')
+
+
+@click.command('migrate-files')
+@click.option('--batch-size', default=1000, show_default=True, help='Files per transaction.')
+@with_appcontext
+def migrate_files_command(batch_size):
+    """Move submitted files into the content-addressed store."""
+    report = migrate_submission_files(batch_size=batch_size)
+    saved = report['file_bytes'] - report['object_bytes']
+    click.echo(f'migrated {report["files"]} files ({report["missing"]} missing)')
+    click.echo(f'{report["file_bytes"]} bytes of files stored in {report["object_bytes"]} bytes of new objects')
+    click.echo(f'{saved} bytes saved')
+
+
+@click.command('collect-garbage')
+@click.option('--grace-seconds', default=3600, show_default=True, help='Minimum age of objects to delete.')
+@with_appcontext
+def collect_garbage_command(grace_seconds):
+    """Delete stored files that no submission refers to."""
+    deleted, freed = collect_garbage(SubmissionFile.reference_counts(), grace_seconds=grace_seconds)
+    click.echo(f'deleted {deleted} objects, freeing {freed} bytes')
+
+
+@click.command('import-roster')
+@click.argument('course_id', type=int)
+@click.argument('roster', type=click.File(encoding='utf-8-sig'))
+@click.option('--instructors', is_flag=True, help='Import instructors instead of students.')
+@click.option('--keep-missing', is_flag=True, help='Do not unenroll users missing from the roster.')
+@with_appcontext
+def import_roster_command(course_id, roster, instructors, keep_missing):
+    """Make the enrollment of a course match a CSV roster."""
+    if not db.session.get(Course, course_id):
+        raise click.BadParameter(f'no course with ID {course_id}', param_hint='COURSE_ID')
+    changes = sync_enrollment(
+        course_id,
+        parse_roster(roster.read()),
+        instructors=instructors,
+        remove=(not keep_missing),
+    )
+    db.session.commit()
+    # running web processes clear their cached identities on their next request
+    forget_identities(changes.added | changes.removed)
+    click.echo(f'enrolled {len(changes.added)}, unenrolled {len(changes.removed)}, created {len(changes.created)} users')
+
+
+@click.command('generate-data')
+@click.option('--seed', default=0, show_default=True, help='Random seed.')
+@click.option('--courses', default=4, show_default=True, help='Number of courses.')
+@click.option('--students', default=60, show_default=True, help='Students per course.')
+@click.option('--assignments', default=8, show_default=True, help='Assignments per course.')
+@click.option('--questions', default=2, show_default=True, help='Student questions per assignment.')
+@click.option('--tests', default=3, show_default=True, help='Test files (and so results) per student submission.')
+@click.option('--submissions', default=3, show_default=True, help='Average submissions per student per question.')
+@with_appcontext
+def generate_data_command(seed, courses, students, assignments, questions, tests, submissions):
+    """Fill an empty scratch database with synthetic data.
+
+    Point DEMOGRADER_DATABASE_URI and DEMOGRADER_SUBMISSION_PATH somewhere
+    disposable first.
+    """
+    upgrade_database(current_app)
+    # the benchmarks view the admin pages as the fixture admin
+    install_fixtures(current_app)
+    if db.session.scalar(select(func.count(Course.id))):
+        raise click.ClickException('the database already has courses; use an empty scratch database')
+    counts = generate_dataset(
+        seed=seed,
+        courses=courses,
+        students=students,
+        assignments=assignments,
+        questions=questions,
+        tests=tests,
+        submissions=submissions,
+    )
+    for table, count in counts.items():
+        click.echo(f'{count} {table}')
+
+
+@click.command('benchmark-pages')
+@click.option('--baseline', type=click.Path(path_type=Path), default=BASELINE_PATH, show_default=True, help='Baseline file.')
+@click.option('--save', is_flag=True, help='Save the measurements as the new baseline.')
+@click.option('--repeat', default=5, show_default=True, help='Requests per page.')
+@click.option('--tolerance', default=0.5, show_default=True, help='Fraction a page may be slower than its baseline.')
+def benchmark_pages_command(baseline, save, repeat, tolerance):
+    """Measure page latencies and query counts against a baseline."""
+    app = current_app._get_current_object()
+    try:
+        measurements = benchmark_pages(app, repeat=repeat)
+    except BenchmarkError as error:
+        raise click.ClickException(str(error)) from error
+    expected = load_baseline(baseline) if baseline.exists() else {}
+    for name, measurement in measurements.items():
+        line = f'{name:<28} {measurement["seconds"] * 1000:8.1f} ms {measurement["queries"]:4} queries'
+        if name in expected:
+            line += f'  (baseline {expected[name]["seconds"] * 1000:.1f} ms, {expected[name]["queries"]} queries)'
+        click.echo(line)
+    if save:
+        save_baseline(baseline, measurements)
+        click.echo(f'saved the baseline to {baseline}')
+        return
+    regressions = compare_to_baseline(measurements, expected, tolerance=tolerance)
+    for regression in regressions:
+        click.echo(f'regression: {regression}', err=True)
+    if regressions:
+        raise SystemExit(1)
+
+
+@click.command('benchmark-pipeline')
+@click.option('--submissions', default=50, show_default=True, help='Submissions to evaluate.')
+@click.option('--script-seconds', default=0.1, show_default=True, help='Duration of each fake evaluation.')
+@click.option('--output-bytes', default=1000, show_default=True, help='Output size of each fake evaluation.')
+@click.option('--workers', default=3, show_default=True, help='Maximum worker processes.')
+@click.option('--tests', default=3, show_default=True, help='Results per submission.')
+@click.option('--seed', default=0, show_default=True, help='Random seed of the generated data.')
+def benchmark_pipeline_command(submissions, script_seconds, output_bytes, workers, tests, seed):
+    """Measure evaluation throughput with a fake sandbox.
+
+    This runs on generated data in a temporary database, and needs no root.
+    """
+    # pylint: disable = import-outside-toplevel
+    from .app import create_app
+    with TemporaryDirectory(prefix='demograder-benchmark-') as temp_dir:
+        # the workers create their own apps, so they are configured through
+        # the environment they inherit
+        os.environ.update({
+            'DEMOGRADER_DATABASE_URI': f'sqlite:///{temp_dir}/database.sqlite',
+            'DEMOGRADER_SUBMISSION_PATH': f'{temp_dir}/submissions',
+            'DEMOGRADER_METRICS_PATH': f'{temp_dir}/metrics',
+            'DEMOGRADER_EVALUATION_SANDBOX': 'fake',
+            'DEMOGRADER_FAKE_SANDBOX_SECONDS': str(script_seconds),
+            'DEMOGRADER_FAKE_SANDBOX_OUTPUT_BYTES': str(output_bytes),
+            'DEMOGRADER_MAX_WORKERS': str(workers),
+        })
+        app = create_app()
+        with app.app_context():
+            generate_dataset(seed=seed, courses=1, students=max(20, submissions // 4), assignments=2, tests=tests)
+        try:
+            report = benchmark_pipeline(app, submissions=submissions)
+        except BenchmarkError as error:
+            raise click.ClickException(str(error)) from error
+    click.echo(f'{report["results"]} results in {report["seconds"]:.2f} s ({report["throughput"]:.1f} results/s)')
+    for name, stage in report['stages'].items():
+        click.echo(f'{name:<32} p50 {stage["p50"] * 1000:8.1f} ms  p95 {stage["p95"] * 1000:8.1f} ms')
+    click.echo(f'max memory: {report["memory"]["parent_mib"]:.1f} MiB (web), {report["memory"]["worker_mib"]:.1f} MiB (largest worker)')
+
+
+@click.command('check-query-plans')
+@click.option('--verbose', is_flag=True, help='Show the statements and plans of every check.')
+@click.option('--advise', is_flag=True, help='Show index suggestions.')
+@with_appcontext
+def check_query_plans_command(verbose, advise):
+    """Check that the hot queries use their indexes.
+
+    Run this on a database from the generate-data command.
+    """
+    try:
+        report = check_query_plans()
+    except BenchmarkError as error:
+        raise click.ClickException(str(error)) from error
+    failed = False
+    for name, check_report in report.items():
+        click.echo(f'{name:<40} {"FAIL" if check_report["problems"] else "ok"}')
+        for problem in check_report['problems']:
+            failed = True
+            click.echo(f'    {problem}')
+        if verbose:
+            for explained in check_report['statements']:
+                click.echo('    ' + ' '.join(explained['statement'].split()))
+                for line in explained['plan']:
+                    click.echo(f'        {line}')
+    if advise:
+        click.echo()
+        for line in advise_indexes(report):
+            click.echo(line)
+    if failed:
+        raise SystemExit(1)
+
+
+@click.command('check-database')
+@click.option('--primary-uri', help='An empty scratch database. Defaults to a temporary SQLite file.')
+@click.option('--replica-uri', help='Another empty scratch database. Defaults to a temporary SQLite file.')
+def check_database_command(primary_uri, replica_uri):
+    """Check read replica routing and backend-specific queries.
+
+    This generates data in scratch databases, eg. throwaway PostgreSQL
+    databases; it never uses the configured database.
+    """
+    # pylint: disable = import-outside-toplevel
+    from .app import create_app
+    with TemporaryDirectory(prefix='demograder-check-') as temp_dir:
+        os.environ.update({
+            'DEMOGRADER_DATABASE_URI': (primary_uri or f'sqlite:///{temp_dir}/primary.sqlite'),
+            'DEMOGRADER_REPLICA_URI': (replica_uri or f'sqlite:///{temp_dir}/replica.sqlite'),
+            'DEMOGRADER_SUBMISSION_PATH': f'{temp_dir}/submissions',
+            'DEMOGRADER_METRICS_PATH': f'{temp_dir}/metrics',
+            'DEMOGRADER_EVENTS_PATH': f'{temp_dir}/events',
+            'DEMOGRADER_IDENTITY_GENERATION_PATH': f'{temp_dir}/identity-generation',
+        })
+        app = create_app(with_queue=False, init_database=True)
+        with app.app_context():
+            if db.session.scalar(select(func.count(Course.id))):
+                raise click.ClickException('the primary database already has courses; use an empty scratch database')
+            generate_dataset(courses=1, students=20, assignments=2)
+        prepare_replica(app)
+        report = check_database(app)
+    failed = False
+    for name, problems in report.items():
+        click.echo(f'{name:<40} {"FAIL" if problems else "ok"}')
+        for problem in problems:
+            failed = True
+            click.echo(f'    {problem}')
+    if failed:
+        raise SystemExit(1)
+
+
+@click.command('replay-traffic')
+@click.argument('trace', type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.option('--speed', default=1.0, show_default=True, help='How many times faster than captured.')
+@click.option('--concurrency', default=32, show_default=True, help='Maximum requests in flight.')
+@click.option('--script-seconds', default=1.0, show_default=True, help='Duration of each fake evaluation.')
+@click.option('--workers', default=3, show_default=True, help='Maximum worker processes.')
+def replay_traffic_command(trace, speed, concurrency, script_seconds, workers):
+    """Replay captured requests, with a fake sandbox, and report latencies.
+
+    This writes to the database, so point DEMOGRADER_DATABASE_URI and
+    DEMOGRADER_SUBMISSION_PATH at copies of the ones the trace was captured
+    on.
+    """
+    # pylint: disable = import-outside-toplevel
+    from .app import create_app
+    # the workers create their own apps, so they are configured through the
+    # environment they inherit
+    os.environ.pop('DEMOGRADER_TRAFFIC_CAPTURE_PATH', None)
+    os.environ.update({
+        'DEMOGRADER_EVALUATION_SANDBOX': 'fake',
+        'DEMOGRADER_FAKE_SANDBOX_SECONDS': str(script_seconds),
+        'DEMOGRADER_MAX_WORKERS': str(workers),
+    })
+    traces = load_trace(trace)
+    if not traces:
+        raise click.ClickException(f'{trace} has no requests')
+    app = create_app()
+    report = replay_trace(app, traces, speed=speed, concurrency=concurrency)
+    click.echo(f'{report["requests"]} requests in {report["seconds"]:.2f} s (p95 {report["delay_p95"] * 1000:.1f} ms late)')
+    for endpoint, stats in report['endpoints'].items():
+        click.echo(
+            f'{endpoint:<40} {stats["count"]:6} requests {stats["errors"]:4} errors  '
+            + f'p50 {stats["p50"] * 1000:8.1f} ms  p95 {stats["p95"] * 1000:8.1f} ms  p99 {stats["p99"] * 1000:8.1f} ms  '
+            + f'(captured p95 {stats["captured_p95"] * 1000:.1f} ms)'
+        )
+
+
+COMMANDS = [
+    upgrade_database_command,
+    migrate_outputs_command,
+    migrate_files_command,
+    collect_garbage_command,
+    import_roster_command,
+    generate_data_command,
+    benchmark_pages_command,
+    benchmark_pipeline_command,
+    check_query_plans_command,
+    check_database_command,
+    replay_traffic_command,
+]
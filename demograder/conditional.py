@@ -0,0 +1,115 @@
+"""HTTP conditional requests for content that does not change.
+
+Submitted files never change once they are stored (see storage.py), and a
+result only changes when it is evaluated again, which resets its queued_at
+and finished_at. The views of this content derive an entity tag (ETag) from
+those values, and answer a request whose If-None-Match or If-Modified-Since
+header matches with an empty 304 response, before reading any files or
+rendering any templates.
+
+Everything is private to the logged in user, so responses are marked
+"private" to keep them out of shared caches. Permissions are still checked
+on every request: pages must be revalidated ("no-cache"), and only the
+downloads of immutable files may be reused without asking, for
+PRIVATE_CACHE_SECONDS.
+"""
+
+from functools import lru_cache
+from hashlib import sha1
+from pathlib import Path
+
+from flask import current_app, make_response, request
+from werkzeug.http import is_resource_modified
+
+
+def entity_tag(*parts):
+    """Derive an entity tag from the values that determine a response.
+
+    The tag also depends on CACHE_VERSION, so that deploying new templates
+    invalidates the pages that browsers have cached.
+
+    Parameters:
+        *parts (Any): Values with stable reprs, eg. IDs, digests, and
+            timestamps.
+
+    Returns:
+        str: The entity tag, without quotes.
+    """
+    key = repr((cache_version(), *parts))
+    return sha1(key.encode('utf-8')).hexdigest()
+
+
+def cache_version():
+    """Get the version of the deployed templates and static files.
+
+    Returns:
+        str: CACHE_VERSION if it is set, or else the last time a template or
+            static file was modified.
+    """
+    if current_app.config['CACHE_VERSION']:
+        return current_app.config['CACHE_VERSION']
+    return _modified_version(Path(current_app.root_path, current_app.template_folder), Path(current_app.static_folder))
+
+
+@lru_cache(maxsize=None)
+def _modified_version(*directories):
+    # computed once per process, since deploying restarts the processes
+    return str(max(
+        (int(path.stat().st_mtime) for directory in directories for path in directory.rglob('*') if path.is_file()),
+        default=0,
+    ))
+
+
+def viewer_key(context):
+    """Get the parts of the context that change how a page renders.
+
+    Parameters:
+        context (Dict[str, Any]): The context from get_context().
+
+    Returns:
+        Tuple[int, int, int, bool]: The IDs of the user and the viewer, the
+            course role, and whether permissions were overridden.
+    """
+    return (
+        context['user'].id,
+        context['viewer'].id,
+        int(context['course_role']),
+        context['override'],
+    )
+
+
+def conditional_response(build, etag, last_modified=None, immutable=False):
+    """Respond only if the client does not already have the response.
+
+    Parameters:
+        build (Callable[[], Any]): Creates the response (or anything that
+            can be made into one). Only called if the client's copy is
+            stale or missing.
+        etag (str): The entity tag of the response, from entity_tag().
+        last_modified (DateTime): When the content last changed. Optional.
+        immutable (bool): If the response can be reused without
+            revalidating it. Defaults to False.
+
+    Returns:
+        Response: The response, or an empty 304 response.
+    """
+    modified = is_resource_modified(
+        request.environ,
+        etag=etag,
+        last_modified=last_modified,
+    )
+    if modified:
+        response = make_response(build())
+    else:
+        response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    if immutable:
+        # send_file() marks files as no-cache by default
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = current_app.config['PRIVATE_CACHE_SECONDS']
+    else:
+        response.cache_control.no_cache = True
+    return response
@@ -1,6 +1,94 @@
-from flask import session, request, abort
+import os
+from collections import namedtuple
+from tempfile import mkstemp
+from time import time_ns
+
+from flask import current_app, session, request, abort, g
+from sqlalchemy.orm import make_transient_to_detached
 
 from .models import db, SiteRole, CourseRole, User, Course, Assignment, Question, Submission, SubmissionFile, Result
+from .models import course_memberships, request_cache
+
+# user is a detached copy of the User, which is never added to a session
+Identity = namedtuple('Identity', 'user_id, admin, faculty, teaching, taking, user')
+
+
+def get_session_user():
+    """Get the logged in user.
+
+    The user (as a detached copy), their site role flags, and their course
+    memberships are cached across requests, keyed by the session email. A
+    cached user is merged into the session without loading it, so most
+    requests do not query for the user at all. The cache must be cleared with
+    forget_identities() whenever any of those change.
+    """
+    email = session.get('user_email')
+    if not email:
+        return None
+    _check_identity_generation()
+    identity = current_app.identity_cache.get(email)
+    if identity is None:
+        user = User.get_by_email(email)
+        if not user:
+            return None
+        identity = Identity(user.id, user.admin, user.faculty, *course_memberships(user.id), _detached_copy(user))
+        current_app.identity_cache.put(email, identity)
+    else:
+        request_cache('course_memberships')[identity.user_id] = (identity.teaching, identity.taking)
+        # merge() copies the cached state into the session, leaving the cached copy untouched
+        user = db.session.merge(identity.user, load=False)
+    g.identity = identity
+    return user
+
+
+def _detached_copy(user):
+    copy = User(**{column.key: getattr(user, column.key) for column in User.__table__.columns})
+    make_transient_to_detached(copy)
+    return copy
+
+
+def forget_identities(emails):
+    """Remove users from the identity cache, eg. after their roles change.
+
+    The users are removed from the cache of this process, and the shared
+    identity generation is bumped so that other processes (including other
+    web workers, after a command changes the database) clear their caches
+    on their next request.
+
+    Parameters:
+        emails (Iterable[str]): The emails of the users to forget.
+    """
+    emails = list(emails)
+    for email in emails:
+        identity = current_app.identity_cache.pop(email)
+        if identity:
+            request_cache('course_memberships').pop(identity.user_id, None)
+    if emails:
+        _bump_identity_generation(current_app.config['IDENTITY_GENERATION_PATH'])
+
+
+def _identity_generation(path):
+    # every bump replaces the file, so its inode and mtime identify the generation
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns)
+
+
+def _bump_identity_generation(path):
+    # a unique temporary file, since threads of one process may bump at once
+    fd, temp_path = mkstemp(prefix=f'.{path.name}.', dir=path.parent)
+    with os.fdopen(fd, 'w') as temp_file:
+        temp_file.write(str(time_ns()))
+    os.replace(temp_path, path)
+
+
+def _check_identity_generation():
+    generation = _identity_generation(current_app.config['IDENTITY_GENERATION_PATH'])
+    if generation != current_app.identity_generation:
+        current_app.identity_cache.clear()
+        current_app.identity_generation = generation
 
 
 def forbidden(context):
@@ -10,9 +98,10 @@ def forbidden(context):
 
 
 def _set_site_role_context(context, url_args, **kwargs):
-    if context['user'].admin:
+    identity = g.identity
+    if identity.admin:
         context['site_role'] = SiteRole.ADMIN
-    elif context['user'].faculty:
+    elif identity.faculty:
         context['site_role'] = SiteRole.FACULTY
     else:
         context['site_role'] = SiteRole.STUDENT
@@ -25,7 +114,7 @@ def _set_viewer_context(context, url_args, **kwargs):
         context['viewer'] = context['user']
     context['alternate_view'] = (context['user'] != context['viewer'])
     # check that the viewer is in a course taught by the user
-    if context['alternate_view'] and not bool(context['user'].courses_with_student(context['viewer'].id).first()):
+    if context['alternate_view'] and not context['user'].teaches_student(context['viewer'].id):
         forbidden(context)
 
 
@@ -101,6 +190,9 @@ def get_context(**kwargs):
     * the viewer is for acting as a specific person
     * the role is for checking renders
 
+    Course memberships are loaded once per request (see course_memberships()),
+    so the permission checks do not need to query for them again.
+
     Context Parameters:
         course_id (int): The course ID of the page being viewed.
         FIXME assignment, question, submission, result
@@ -118,7 +210,7 @@ def get_context(**kwargs):
     context = {
         'SiteRole': SiteRole, # including the Enum allows templates to branch on site role
         'CourseRole': CourseRole, # including the Enum allows templates to branch on course role
-        'user': User.get_by_email(session.get('user_email')),
+        'user': get_session_user(),
         'override': False,
     }
     # if the user is not logged in, we can stop here
@@ -149,10 +241,10 @@ def get_context(**kwargs):
         viewer = context['viewer']
         course = context['course']
         # check that the user is related to the course
-        if not (user.is_teaching(course.id) or user.is_taking(course.id)):
+        if not user.is_member(course.id):
             forbidden(context)
         # check that the viewer is related to the course
-        if not (viewer.is_teaching(course.id) or viewer.is_taking(course.id)):
+        if not viewer.is_member(course.id):
             forbidden(context)
         # set the course role context with respect to the course
         _set_course_role_context(context, url_args, **kwargs)
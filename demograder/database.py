@@ -0,0 +1,75 @@
+"""Configuration of the database engines and routing between them."""
+
+from functools import wraps
+
+from flask import g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.sql import Select
+
+
+class RoutingSession(Session):
+    """A session that can send reads to a read replica.
+
+    Inside views decorated with use_read_replica(), SELECT statements are sent
+    to the "replica" bind if one is configured (see SQLALCHEMY_BINDS in
+    settings.py). Everything else, including all statements during a flush,
+    is sent to the primary database.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        use_replica = (
+            bind is None
+            and not self._flushing
+            and isinstance(clause, Select)
+            and has_app_context()
+            and g.get('use_read_replica', False)
+        )
+        if use_replica:
+            engine = self._db.engines.get('replica')
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def use_read_replica(view):
+    """Send the reads of a view to the read replica, if there is one.
+
+    Since the replica may lag behind the primary database, this should only
+    be used for read-only views that can show slightly stale data.
+    """
+
+    @wraps(view)
+    def wrapped_view(*args, **kwargs):
+        g.use_read_replica = True
+        return view(*args, **kwargs)
+
+    return wrapped_view
+
+
+def configure_engine(app, db):
+    """Configure the database engines of the app.
+
+    This must be called after db.init_app() but before any connections are
+    made, so that the settings apply to every pooled connection.
+
+    Parameters:
+        app (Flask): The Flask app.
+        db (SQLAlchemy): The Flask-SQLAlchemy extension.
+    """
+    with app.app_context():
+        engines = list(db.engines.values())
+    for engine in engines:
+        if engine.dialect.name == 'sqlite':
+            event.listen(engine, 'connect', _sqlite_pragma_setter(app.config['SQLITE_PRAGMAS']))
+
+
+def _sqlite_pragma_setter(pragmas):
+
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+        cursor.close()
+
+    return set_sqlite_pragmas
@@ -0,0 +1,149 @@
+"""Checks of the database routing and of queries that differ between backends.
+
+These run on two scratch databases, a primary and a stand-in for its read
+replica (see database.py): temporary SQLite files by default, or empty
+PostgreSQL databases given to the check-database command. The stand-in is
+not replicated, so whether a read reached the replica can be told by what it
+finds there.
+
+Each check returns a list of problems, which is empty if the check passed.
+"""
+
+from collections import namedtuple
+from itertools import product
+
+from flask import g
+from sqlalchemy import insert, select, update
+
+from .models import db, User, Question, QuestionDependency, Submission
+
+# a user that only exists in the replica
+REPLICA_ONLY_EMAIL = 'replica-only@example.com'
+# a user that is written while reads go to the replica
+WRITTEN_EMAIL = 'written-while-routed@example.com'
+
+# a check, with a function that runs it given the app and returns its problems
+DatabaseCheck = namedtuple('DatabaseCheck', 'name, run')
+
+
+def prepare_replica(app):
+    """Create the tables in the replica, and a user that only it has.
+
+    Parameters:
+        app (Flask): The Flask app, with a "replica" bind.
+    """
+    with app.app_context():
+        engine = db.engines['replica']
+        db.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute(insert(User).values(email=REPLICA_ONLY_EMAIL))
+
+
+def _email_exists(engine, email):
+    with engine.connect() as connection:
+        return connection.scalar(select(User.id).where(User.email == email)) is not None
+
+
+def _check_routed_reads(app):
+    problems = []
+    with app.app_context():
+        g.use_read_replica = True
+        if User.get_by_email(REPLICA_ONLY_EMAIL) is None:
+            problems.append('a read in a replica view did not go to the replica')
+    with app.app_context():
+        if User.get_by_email(REPLICA_ONLY_EMAIL) is not None:
+            problems.append('a read outside of replica views went to the replica')
+    return problems
+
+
+def _check_routed_writes(app):
+    problems = []
+    with app.app_context():
+        g.use_read_replica = True
+        db.session.add(User(email=WRITTEN_EMAIL))
+        db.session.commit()
+        if not _email_exists(db.engines[None], WRITTEN_EMAIL):
+            problems.append('a write in a replica view did not go to the primary database')
+        if _email_exists(db.engines['replica'], WRITTEN_EMAIL):
+            problems.append('a write in a replica view went to the replica')
+    return problems
+
+
+def _latest_by_user(submissions):
+    # the reference for input_type 'latest': the newest submission of each user
+    latest = {}
+    for submission in submissions:
+        key = (submission.timestamp, submission.id)
+        if submission.user_id not in latest or key > (latest[submission.user_id].timestamp, latest[submission.user_id].id):
+            latest[submission.user_id] = submission
+    return [
+        submission.id for submission in
+        sorted(latest.values(), key=(lambda submission: submission.timestamp), reverse=True)
+    ]
+
+
+def _check_latest_submissions(app):
+    # Question.upstream_submission_id_sets selects the latest submission of
+    # each user with row_number(), which must match the latest of all the
+    # submissions that input_type 'all' selects
+    problems = []
+    with app.app_context():
+        questions = db.session.scalars(
+            select(Question)
+            .where(Question.id.in_(select(QuestionDependency.consumer_id)))
+        ).all()
+        if not questions:
+            return ['the dataset has no question dependencies']
+        # the generated dependencies are all on instructor submissions, so
+        # also make each question depend on its own (student) submissions
+        db.session.execute(insert(QuestionDependency), [
+            {'producer_id': question.id, 'consumer_id': question.id, 'input_type': 'all', 'submitters': 'everyone'}
+            for question in questions
+        ])
+        db.session.expire_all()
+        for submitters in ('instructors', 'students', 'everyone'):
+            db.session.execute(update(QuestionDependency).values(submitters=submitters, input_type='all'))
+            expected = {}
+            for question in questions:
+                # the sets are the product of the submissions of each dependency, in order
+                all_sets = question.upstream_submission_id_sets
+                if not all_sets:
+                    expected[question.id] = []
+                    continue
+                expected[question.id] = list(product(*(
+                    _latest_by_user(db.session.get(Submission, submission_id) for submission_id in dict.fromkeys(ids))
+                    for ids in zip(*all_sets)
+                )))
+            db.session.execute(update(QuestionDependency).values(input_type='latest'))
+            db.session.expire_all()
+            for question in questions:
+                actual = question.upstream_submission_id_sets
+                if actual != expected[question.id]:
+                    problems.append(
+                        f'the latest {submitters} submissions for question {question.id} are not the latest of all its submissions'
+                    )
+        db.session.rollback()
+    return problems
+
+
+CHECKS = [
+    DatabaseCheck('replica reads', _check_routed_reads),
+    DatabaseCheck('primary writes', _check_routed_writes),
+    DatabaseCheck('latest submissions (row_number)', _check_latest_submissions),
+]
+
+
+def check_database(app, checks=None):
+    """Run the checks.
+
+    Parameters:
+        app (Flask): The Flask app, on scratch databases with a dataset from
+            generate_dataset() and a replica from prepare_replica().
+        checks (List[DatabaseCheck]): The checks to run. Defaults to CHECKS.
+
+    Returns:
+        Dict[str, List[str]]: The problems of each check.
+    """
+    if checks is None:
+        checks = CHECKS
+    return {check.name: check.run(app) for check in checks}
@@ -1,36 +1,253 @@
+import logging
+from datetime import datetime as DateTime
+from functools import partial
+
 from flask import current_app
+from sqlalchemy import delete, insert, select, update
 
 from .job_queue import JobQueue
+from .metrics import record_job
+from .models import db, Blob, FileGrant, Result, ResultDependency, Submission
 from .workers import evaluate_submission, reevaluate_submission, evaluate_result, reevaluate_result
+from .writer import BatchWriter
+
+# Evaluation jobs run in separate processes and only read from the database.
+# Their return values are passed (through the job queue callbacks) to the
+# result writer of the web process, which does all the writing:
+#
+# 1. evaluate_submission determines the upstream submissions for each result
+# 2. the writer creates the empty results, then enqueues evaluate_result jobs
+# 3. evaluate_result runs the evaluation script for a result
+# 4. the writer saves the output of the result
 
 
 def create_job_queue(app):
-    return JobQueue(max_processes=app.config['MAX_WORKERS'])
+    job_queue = JobQueue(
+        max_processes=app.config['MAX_WORKERS'],
+        monitor=partial(record_job, app.metrics),
+        preload=['demograder.workers'],
+    )
+    app.metrics.gauge('demograder_job_queue_depth', job_queue.__len__)
+    app.metrics.gauge('demograder_job_processes_running', lambda: job_queue.num_processes)
+    app.metrics.gauge('demograder_job_processes_idle', lambda: job_queue.idle_processes)
+    return job_queue
 
 
-def enqueue_evaluate_submission(submission_id):
-    current_app.job_queue.put(
+def create_result_writer(app):
+    result_writer = BatchWriter(
+        app,
+        max_batch=app.config['RESULT_WRITER_BATCH_SIZE'],
+        max_delay=app.config['RESULT_WRITER_DELAY_SECONDS'],
+    )
+    app.metrics.gauge('demograder_result_writer_depth', result_writer.__len__)
+    return result_writer
+
+
+def enqueue_evaluate_submission(submission_id, question_id=None):
+    app = current_app._get_current_object()
+    app.job_queue.put(
         evaluate_submission,
         args=(submission_id,),
+        callback=partial(_write_empty_results, app, False, DateTime.now()),
+        error_callback=partial(_log_error, 'evaluate_submission', submission_id),
+        tag=question_id,
     )
 
 
-def enqueue_reevaluate_submission(submission_id):
-    current_app.job_queue.put(
+def enqueue_reevaluate_submission(submission_id, question_id=None):
+    app = current_app._get_current_object()
+    app.job_queue.put(
         reevaluate_submission,
         args=(submission_id,),
+        callback=partial(_write_empty_results, app, True, DateTime.now()),
+        error_callback=partial(_log_error, 'reevaluate_submission', submission_id),
+        tag=question_id,
     )
 
 
-def enqueue_evaluate_result(result_id):
-    current_app.job_queue.put(
+def enqueue_evaluate_result(result_id, question_id=None):
+    app = current_app._get_current_object()
+    app.job_queue.put(
         evaluate_result,
         args=(result_id,),
+        callback=partial(_write_result, app),
+        error_callback=partial(_log_error, 'evaluate_result', result_id),
+        tag=question_id,
     )
 
 
-def enqueue_reevaluate_result(result_id):
-    current_app.job_queue.put(
+def enqueue_reevaluate_result(result_id, question_id=None):
+    app = current_app._get_current_object()
+    app.result_writer.put(partial(mark_queued, result_id, DateTime.now()))
+    app.job_queue.put(
         reevaluate_result,
         args=(result_id,),
+        callback=partial(_write_result, app),
+        error_callback=partial(_log_error, 'reevaluate_result', result_id),
+        tag=question_id,
+    )
+
+
+def _log_error(job_name, object_id, exception):
+    logging.error(f'{job_name}({object_id}) failed: {exception!r}')
+
+
+# the following callbacks run in the result thread of the job queue, so they
+# only hand the data to the result writer
+
+
+def _write_empty_results(app, replace, queued_at, submission_id, upstream_submission_id_sets):
+    app.result_writer.put(partial(
+        create_empty_results,
+        submission_id,
+        upstream_submission_id_sets,
+        replace=replace,
+        queued_at=queued_at,
+    ))
+
+
+def _write_result(app, result_id, stdout, stderr, return_code, started_at):
+    app.result_writer.put(partial(
+        save_result,
+        result_id,
+        stdout,
+        stderr,
+        return_code,
+        started_at=started_at,
+    ))
+
+
+# the following functions run in the result writer
+
+
+def create_empty_results(submission_id, upstream_submission_id_sets, replace=False, queued_at=None):
+    """Create the results for a submission.
+
+    Parameters:
+        submission_id (int): The ID of the submission.
+        upstream_submission_id_sets (List[Tuple[int]]): The IDs of the
+            upstream submissions for each result.
+        replace (bool): Whether to delete existing results first.
+        queued_at (DateTime): When the evaluation was requested. Defaults to
+            now.
+
+    Returns:
+        Callable[[], None]: A function that enqueues the new results for
+            evaluation, once they are committed.
+    """
+    if replace:
+        result_ids = select(Result.id).where(Result.submission_id == submission_id)
+        db.session.execute(delete(FileGrant).where(FileGrant.result_id.in_(result_ids)))
+        db.session.execute(delete(ResultDependency).where(ResultDependency.result_id.in_(result_ids)))
+        db.session.execute(delete(Result).where(Result.submission_id == submission_id))
+    if queued_at is None:
+        queued_at = DateTime.now()
+    results = [
+        Result(submission_id=submission_id, queued_at=queued_at)
+        for _ in upstream_submission_id_sets
+    ]
+    db.session.add_all(results)
+    # flush so the results have IDs
+    db.session.flush()
+    dependencies = [
+        {'result_id': result.id, 'submission_id': upstream_id}
+        for result, upstream_ids in zip(results, upstream_submission_id_sets)
+        for upstream_id in upstream_ids
+    ]
+    result_ids = [result.id for result in results]
+    if dependencies:
+        db.session.execute(insert(ResultDependency), dependencies)
+        FileGrant.refresh(result_ids)
+    Submission.increment_version(submission_id)
+    question_id = db.session.scalar(select(Submission.question_id).where(Submission.id == submission_id))
+    return partial(_enqueue_evaluate_results, submission_id, result_ids, question_id)
+
+
+def _enqueue_evaluate_results(submission_id, result_ids, question_id):
+    _publish(submission_id, 'created', [(result_id, None) for result_id in result_ids])
+    for result_id in result_ids:
+        enqueue_evaluate_result(result_id, question_id=question_id)
+
+
+def _publish(submission_id, kind, return_codes):
+    current_app.result_events.publish(submission_id, kind, return_codes)
+
+
+def mark_queued(result_id, queued_at):
+    """Restart the lifecycle of a result that is evaluated again.
+
+    The old output and return code are cleared, so that the result is shown
+    as pending everywhere until it is saved again.
+
+    Parameters:
+        result_id (int): The ID of the result.
+        queued_at (DateTime): When the evaluation was requested.
+
+    Returns:
+        Callable[[], None]: A function that publishes the change, once it is
+            committed, or None if the result no longer exists.
+    """
+    # only the result writer deletes results, so the result cannot disappear before the update
+    submission_id = db.session.scalar(select(Result.submission_id).where(Result.id == result_id))
+    if submission_id is None:
+        # the results of the submission were replaced in the meantime
+        return None
+    db.session.execute(
+        update(Result)
+        .where(Result.id == result_id)
+        .values(
+            stdout_id=None,
+            stderr_id=None,
+            inline_stdout=None,
+            inline_stderr=None,
+            return_code=None,
+            queued_at=queued_at,
+            started_at=None,
+            finished_at=None,
+        )
+    )
+    Submission.increment_version(submission_id)
+    return partial(_publish, submission_id, 'queued', [(result_id, None)])
+
+
+def save_result(result_id, stdout, stderr, return_code, started_at=None):
+    """Save the output of a result.
+
+    The result is finished when it is saved, since that is when its output
+    becomes visible.
+
+    Parameters:
+        result_id (int): The ID of the result.
+        stdout (str): The standard output of the evaluation script.
+        stderr (str): The standard error of the evaluation script.
+        return_code (int): The return code of the evaluation script.
+        started_at (DateTime): When the evaluation script started.
+
+    Returns:
+        Callable[[], None]: A function that publishes the result, once it is
+            committed, or None if the result no longer exists.
+    """
+    submission_id = db.session.scalar(select(Result.submission_id).where(Result.id == result_id))
+    if submission_id is None:
+        # the results of the submission were replaced while this one was
+        # evaluated; the new results are evaluated separately
+        return None
+    stdout_blob = Blob.store(stdout)
+    stderr_blob = Blob.store(stderr)
+    # flush so new blobs have IDs
+    db.session.flush()
+    db.session.execute(
+        update(Result)
+        .where(Result.id == result_id)
+        .values(
+            stdout_id=stdout_blob.id,
+            stderr_id=stderr_blob.id,
+            inline_stdout=None,
+            inline_stderr=None,
+            return_code=return_code,
+            started_at=started_at,
+            finished_at=DateTime.now(),
+        )
     )
+    Submission.increment_version(submission_id)
+    return partial(_publish, submission_id, 'finished', [(result_id, return_code)])
@@ -0,0 +1,148 @@
+"""Bulk enrollment of users in courses from rosters."""
+
+import csv
+import re
+from collections import namedtuple
+from io import StringIO
+
+from sqlalchemy import delete, exists, insert, literal, select, update
+
+from .models import db, User, Instructor, Student
+
+EMAIL_REGEX = re.compile(r'[0-9a-z._+-]+@[0-9a-z-]+(\.[0-9a-z-]+)+', flags=re.IGNORECASE)
+
+# header names accepted for each roster column, in lower case
+ROSTER_COLUMNS = {
+    'email': ('email', 'email address', 'e-mail'),
+    'preferred_name': ('preferred_name', 'preferred name', 'first name', 'first_name', 'given name'),
+    'family_name': ('family_name', 'family name', 'last name', 'last_name', 'surname'),
+}
+
+EnrollmentChanges = namedtuple('EnrollmentChanges', 'added, removed, created')
+
+
+def find_emails(text):
+    return [re_match.group(0) for re_match in EMAIL_REGEX.finditer(text)]
+
+
+def parse_roster(text):
+    """Parse a roster.
+
+    A roster is a CSV file with a header row that includes an email column,
+    and optionally preferred and family name columns (see ROSTER_COLUMNS).
+    If there is no email column, every email address in the text is used.
+
+    Parameters:
+        text (str): The contents of the roster.
+
+    Returns:
+        Dict[str, Tuple[str, str]]: The preferred and family name for each
+            email address. Missing names are empty strings.
+    """
+    rows = list(csv.reader(StringIO(text.strip())))
+    if not rows:
+        return {}
+    header = [cell.strip().lower() for cell in rows[0]]
+    indices = {}
+    for column, names in ROSTER_COLUMNS.items():
+        for index, cell in enumerate(header):
+            if cell in names:
+                indices[column] = index
+                break
+    if 'email' not in indices:
+        return {email: ('', '') for email in find_emails(text)}
+    roster = {}
+    for row in rows[1:]:
+        values = {
+            column: (row[index].strip() if index < len(row) else '')
+            for column, index in indices.items()
+        }
+        if not EMAIL_REGEX.fullmatch(values['email']):
+            continue
+        roster[values['email']] = (values.get('preferred_name', ''), values.get('family_name', ''))
+    return roster
+
+
+def sync_enrollment(course_id, roster, instructors=False, remove=True):
+    """Make the enrollment of a course match a roster.
+
+    All emails are resolved with one query, missing users are created with
+    one batched insert, and the enrollments to add and remove are computed
+    in the database. Running this again with the same roster changes nothing.
+    The changes are not committed.
+
+    Parameters:
+        course_id (int): The ID of the course.
+        roster (Dict[str, Tuple[str, str]]): The preferred and family name
+            for each email address, as returned by parse_roster().
+        instructors (bool): Whether the roster is of instructors instead of
+            students. Defaults to False.
+        remove (bool): Whether to unenroll users who are not on the roster.
+            Defaults to True.
+
+    Returns:
+        EnrollmentChanges: The sets of emails of the users who were enrolled,
+            unenrolled, and created.
+    """
+    membership = (Instructor if instructors else Student)
+    emails = list(roster)
+    # create missing users, and fill in names that are still empty
+    existing = {
+        user.email: user for user in
+        db.session.execute(
+            select(User.id, User.email, User.preferred_name, User.family_name)
+            .where(User.email.in_(emails))
+        )
+    }
+    created = set(emails) - set(existing)
+    if created:
+        db.session.execute(insert(User), [
+            {'email': email, 'preferred_name': roster[email][0], 'family_name': roster[email][1]}
+            for email in created
+        ])
+    renamed = [
+        {
+            'id': user.id,
+            'preferred_name': user.preferred_name or roster[email][0],
+            'family_name': user.family_name or roster[email][1],
+        }
+        for email, user in existing.items()
+        if (not user.preferred_name and roster[email][0]) or (not user.family_name and roster[email][1])
+    ]
+    if renamed:
+        db.session.execute(update(User), renamed)
+    # compute the enrollment changes
+    is_enrolled = exists().where(
+        membership.user_id == User.id,
+        membership.course_id == course_id,
+    )
+    added = set(db.session.scalars(
+        select(User.email)
+        .where(User.email.in_(emails), ~is_enrolled)
+    ))
+    if remove:
+        removed = set(db.session.scalars(
+            select(User.email)
+            .join(membership, membership.user_id == User.id)
+            .where(membership.course_id == course_id, User.email.not_in(emails))
+        ))
+    else:
+        removed = set()
+    # apply the changes
+    if added:
+        db.session.execute(
+            insert(membership).from_select(
+                ['user_id', 'course_id'],
+                select(User.id, literal(course_id))
+                .where(User.email.in_(added)),
+            )
+        )
+    if removed:
+        db.session.execute(
+            delete(membership)
+            .where(
+                membership.course_id == course_id,
+                membership.user_id.in_(select(User.id).where(User.email.in_(removed))),
+            )
+        )
+    return EnrollmentChanges(added, removed, created)
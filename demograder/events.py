@@ -0,0 +1,209 @@
+"""Notifications of changes to results, shared between processes.
+
+When the result writer commits a change to the results of a submission
+(see dispatch.py), it publishes an event by appending a line of JSON to the
+events file of its process in EVENTS_PATH. Each web process runs a single
+relay thread that follows the events files of all processes and passes the
+events on to the local subscribers of each submission, so that pages can
+be updated without every client polling the database.
+
+Events files are rotated once they reach EVENTS_FILE_BYTES; readers keep
+the rotated file open until they have read all of it. The relay threads
+delete the events files that have not been written to for
+EVENTS_MAX_AGE_SECONDS (such as those of stopped processes), which also
+makes every reader close them; a process whose file was deleted while it was
+idle starts a new one.
+"""
+
+import json
+import os
+import socket
+from collections import defaultdict
+from pathlib import Path
+from queue import Queue as ThreadQueue
+from threading import Lock, Thread
+from time import sleep, time
+
+# how often each relay thread deletes stale events files
+PRUNE_SECONDS = 60
+
+
+class ResultEvents:
+    """The publisher and subscribers of result events of one process."""
+
+    def __init__(self, path, poll_seconds=0.25, max_file_bytes=2**20, max_age_seconds=60 * 60):
+        """Initialize the ResultEvents.
+
+        Parameters:
+            path (Path): The directory shared by all processes for events.
+            poll_seconds (float): How often to read new events. Defaults to
+                0.25.
+            max_file_bytes (int): The size at which to rotate the events file
+                of this process. Defaults to 1 MiB.
+            max_age_seconds (float): How long after it was last written to
+                to delete an events file. Defaults to one hour.
+        """
+        self.path = Path(path)
+        self.poll_seconds = poll_seconds
+        self.max_file_bytes = max_file_bytes
+        self.max_age_seconds = max_age_seconds
+        self.lock = Lock()
+        self.subscribers = defaultdict(set)
+        self._file = None
+        # the open events files being read, by path
+        self._readers = {}
+
+    def publish(self, submission_id, kind, return_codes):
+        """Notify all processes of a change to the results of a submission.
+
+        This must only be called after the change is committed.
+
+        Parameters:
+            submission_id (int): The ID of the submission.
+            kind (str): What happened: "created" when the results of the
+                submission are replaced, "queued" when results are evaluated
+                again, or "finished".
+            return_codes (List[Tuple[int, Optional[int]]]): The IDs and return
+                codes of the results that changed.
+        """
+        line = json.dumps({
+            'time': time(),
+            'submission_id': submission_id,
+            'kind': kind,
+            'return_codes': return_codes,
+        }) + '\n'
+        with self.lock:
+            if self._file is None or self._file.tell() >= self.max_file_bytes or self._is_deleted():
+                self._rotate()
+            self._file.write(line)
+            self._file.flush()
+
+    def _rotate(self):
+        # not computed ahead of time, since the app may be created before forking
+        filename = f'{socket.gethostname()}-{os.getpid()}.jsonl'
+        self.path.mkdir(parents=True, exist_ok=True)
+        if self._file is not None:
+            deleted = self._is_deleted()
+            self._file.close()
+            if not deleted:
+                os.replace(self.path / filename, self.path / f'{filename}.old')
+        self._file = (self.path / filename).open('a', encoding='utf-8')
+
+    def _is_deleted(self):
+        # the file was pruned while this process was idle
+        return self._file is not None and os.fstat(self._file.fileno()).st_nlink == 0
+
+    def subscribe(self, submission_id):
+        """Start receiving the events of a submission.
+
+        Parameters:
+            submission_id (int): The ID of the submission.
+
+        Returns:
+            Queue: The queue the events will be put in.
+        """
+        queue = ThreadQueue()
+        with self.lock:
+            self.subscribers[submission_id].add(queue)
+        return queue
+
+    def unsubscribe(self, submission_id, queue):
+        with self.lock:
+            self.subscribers[submission_id].discard(queue)
+            if not self.subscribers[submission_id]:
+                del self.subscribers[submission_id]
+
+    def num_subscribers(self):
+        with self.lock:
+            return sum(len(queues) for queues in self.subscribers.values())
+
+    def start(self):
+        """Start relaying events from all processes in a background thread."""
+        # events from before this process started are not relayed
+        self.path.mkdir(parents=True, exist_ok=True)
+        for path in self.path.glob('*.jsonl'):
+            reader = path.open(encoding='utf-8')
+            reader.seek(0, os.SEEK_END)
+            self._readers[path] = reader
+        Thread(name='events-thread', target=self._run, daemon=True).start()
+
+    def _run(self):
+        last_prune = 0
+        while True:
+            sleep(self.poll_seconds)
+            if time() - last_prune > PRUNE_SECONDS:
+                self.prune()
+                last_prune = time()
+            for event in self.read():
+                with self.lock:
+                    queues = list(self.subscribers.get(event['submission_id'], ()))
+                for queue in queues:
+                    queue.put(event)
+
+    def prune(self):
+        """Delete the events files that have not been written to recently.
+
+        Readers of the deleted files close them in read().
+        """
+        cutoff = time() - self.max_age_seconds
+        for path in self.path.glob('*.jsonl*'):
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink(missing_ok=True)
+            except OSError:
+                continue
+
+    def read(self):
+        """Read the new events of all processes.
+
+        Returns:
+            List[Dict[str, Any]]: The new events.
+        """
+        events = []
+        for path in self.path.glob('*.jsonl'):
+            if path not in self._readers:
+                self._readers[path] = path.open(encoding='utf-8')
+        for path, reader in list(self._readers.items()):
+            events.extend(_read_lines(reader))
+            try:
+                rotated = (os.stat(path).st_ino != os.fstat(reader.fileno()).st_ino)
+            except FileNotFoundError:
+                rotated = True
+            if rotated:
+                # nothing is written to a rotated file, so this reads the rest of it
+                events.extend(_read_lines(reader))
+                reader.close()
+                del self._readers[path]
+        return events
+
+
+def _read_lines(reader):
+    events = []
+    while True:
+        position = reader.tell()
+        line = reader.readline()
+        if not line:
+            break
+        if not line.endswith('\n'):
+            # the rest of the line has not been written yet
+            reader.seek(position)
+            break
+        events.append(json.loads(line))
+    return events
+
+
+def init_result_events(app):
+    """Create the result events of the app.
+
+    Parameters:
+        app (Flask): The Flask app.
+
+    Returns:
+        ResultEvents: The result events of this process.
+    """
+    return ResultEvents(
+        app.config['EVENTS_PATH'],
+        poll_seconds=app.config['EVENTS_POLL_SECONDS'],
+        max_file_bytes=app.config['EVENTS_FILE_BYTES'],
+        max_age_seconds=app.config['EVENTS_MAX_AGE_SECONDS'],
+    )
@@ -111,6 +111,29 @@ class CourseForm(FlaskForm):
         return CourseForm()
 
 
+class RosterForm(FlaskForm):
+    course = StringField('Course', render_kw={'readonly':''})
+    roster = FileField(
+        'Roster',
+        validators=[FileRequired()],
+        description='A CSV file with a header row and an email column, and optionally first and last name columns.',
+        render_kw={'accept': '.csv,.txt'},
+    )
+    role = SelectField('Role', choices=['students', 'instructors'])
+    remove_missing = BooleanField(
+        'Remove Missing',
+        default=True,
+        description='Unenroll users with this role who are not on the roster.',
+    )
+    submit = SubmitField('Import')
+
+    @staticmethod
+    def build(context):
+        form = RosterForm()
+        form.course.data = str(context['course'])
+        return form
+
+
 class AssignmentForm(FlaskForm):
     id = HiddenField('id')
     course_id = HiddenField('course_id')
@@ -227,7 +250,7 @@ class QuestionForm(FlaskForm):
                 'question': other_question.name,
                 'is_dependency': bool(question_dependency),
                 'submissions_used': (question_dependency.input_type if question_dependency else 'all'),
-                'submitters_used': (question_dependency.submitters if question_dependency else 'instructor'),
+                'submitters_used': (question_dependency.submitters if question_dependency else 'instructors'),
                 'viewable': (question_dependency.viewable if question_dependency else True),
             })
 
@@ -0,0 +1,67 @@
+"""Caching of rendered template fragments.
+
+A fragment is cached with the {% cache %} tag, given the values that
+determine how it renders:
+
+    {% cache 'score', submission.id, submission.version %}
+        {{ submission.num_passed }} / {{ submission.num_results }}
+    {% endcache %}
+
+The key of a fragment is its location in the template and these values, so
+the values must include a change counter of everything the fragment shows.
+Submission.version counts the changes to a submission and its results (see
+dispatch.py), and Question.version counts the edits of a question. A result
+that finishes therefore only invalidates the fragments of its submission;
+stale fragments are never read again, and are evicted as the cache fills.
+
+The cache is local to each process, and is bounded by both the number of
+fragments and their total length (FRAGMENT_CACHE_SIZE and
+FRAGMENT_CACHE_BYTES).
+"""
+
+from flask import current_app
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from .cache import LRUCache
+
+
+class FragmentCacheExtension(Extension):
+    """The {% cache %} tag."""
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        # the location of the fragment keeps keys from different fragments apart
+        parts = [nodes.Const(parser.name), nodes.Const(lineno), parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            parts.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        call = self.call_method('_render', [nodes.Tuple(parts, 'load')])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _render(self, key, caller):
+        cache = current_app.fragment_cache
+        fragment = cache.get(key)
+        if fragment is None:
+            fragment = caller()
+            cache.put(key, fragment)
+        return Markup(fragment)
+
+
+def init_fragment_cache(app):
+    """Enable the {% cache %} tag in the templates of the app.
+
+    Parameters:
+        app (Flask): The Flask app.
+
+    Returns:
+        LRUCache: The cache of rendered fragments.
+    """
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    return LRUCache(
+        max_size=app.config['FRAGMENT_CACHE_SIZE'],
+        max_bytes=app.config['FRAGMENT_CACHE_BYTES'],
+    )
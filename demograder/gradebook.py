@@ -0,0 +1,139 @@
+"""Streaming export of grades as CSV or newline-delimited JSON."""
+
+import csv
+import json
+from io import StringIO
+
+from sqlalchemy import and_, func, select, true
+
+from .models import db, User, Student, Assignment, Question, Submission, Result
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+COLUMNS = [
+    'assignment',
+    'question',
+    'family_name',
+    'preferred_name',
+    'email',
+    'submission_id',
+    'submitted',
+    'passed',
+    'results',
+    'percent',
+]
+
+
+def grade_rows(course_id, question_condition, before=None):
+    """Get the grade of every student on some questions in a course.
+
+    A grade is based on the latest enabled submission of the student to the
+    question, as on the grades pages. Students without a submission have a
+    row with no submission and a grade of zero.
+
+    The rows are fetched in batches (with a server-side cursor where the
+    database supports it), so they should be consumed as they are produced.
+
+    Parameters:
+        course_id (int): The ID of the course whose students are graded.
+        question_condition (ColumnElement): The condition on Question (and
+            Assignment) that selects the questions to grade.
+        before (DateTime): If given, ignore submissions after this time.
+
+    Returns:
+        Iterator[Dict[str, Any]]: The grades, by assignment, question, and
+            student.
+    """
+    ranked = (
+        select(
+            Submission.id,
+            Submission.user_id,
+            Submission.question_id,
+            Submission.timestamp,
+            func.row_number().over(
+                partition_by=(Submission.user_id, Submission.question_id),
+                order_by=(Submission.timestamp.desc(), Submission.id.desc()),
+            ).label('rank'),
+        )
+        .join(Question)
+        .join(Assignment)
+        .where(Submission.disabled == False, question_condition)
+    )
+    if before:
+        ranked = ranked.where(Submission.timestamp <= before)
+    ranked = ranked.subquery()
+    latest = select(ranked).where(ranked.c.rank == 1).subquery()
+    statement = (
+        select(
+            Assignment.name.label('assignment'),
+            Question.name.label('question'),
+            User.family_name,
+            User.preferred_name,
+            User.email,
+            latest.c.id.label('submission_id'),
+            latest.c.timestamp.label('submitted'),
+            func.count(Result.id).filter(Result.return_code == 0).label('passed'),
+            func.count(Result.id).label('results'),
+        )
+        .select_from(Student)
+        .join(User, Student.user_id == User.id)
+        # every student is graded on every question
+        .join(Question, true())
+        .join(Assignment, Question.assignment_id == Assignment.id)
+        .where(Student.course_id == course_id, question_condition)
+        .outerjoin(latest, and_(latest.c.user_id == User.id, latest.c.question_id == Question.id))
+        .outerjoin(Result, Result.submission_id == latest.c.id)
+        .group_by(Assignment.id, Question.id, User.id, latest.c.id, latest.c.timestamp)
+        .order_by(
+            Assignment.name,
+            Question.name,
+            User.family_name,
+            User.preferred_name,
+            User.id,
+        )
+        .execution_options(yield_per=500)
+    )
+    for row in db.session.execute(statement):
+        grade = row._asdict()
+        if grade['submitted'] is not None:
+            grade['submitted'] = grade['submitted'].isoformat()
+        if grade['results']:
+            grade['percent'] = round(100 * grade['passed'] / grade['results'], 2)
+        else:
+            grade['percent'] = 0
+        yield grade
+
+
+def export_lines(grades, export_format):
+    """Format grades as lines of CSV or newline-delimited JSON.
+
+    Parameters:
+        grades (Iterable[Dict[str, Any]]): The grades.
+        export_format (str): Either "csv" or "ndjson".
+
+    Yields:
+        str: The next line.
+    """
+    if export_format == 'csv':
+        buffer = StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=COLUMNS)
+        writer.writeheader()
+        yield _pop_lines(buffer)
+        for grade in grades:
+            writer.writerow(grade)
+            yield _pop_lines(buffer)
+    elif export_format == 'ndjson':
+        for grade in grades:
+            yield json.dumps(grade) + '\n'
+    else:
+        raise ValueError(f'unknown export format: {export_format}')
+
+
+def _pop_lines(buffer):
+    lines = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return lines
@@ -0,0 +1,148 @@
+"""Server-side syntax highlighting of submitted files.
+
+Files are shown one range of FILE_VIEW_LINES lines at a time, so a large
+file is never read (or highlighted) in full for a single page. The byte
+offset of the start of every range is found once per file by scanning a
+memory map of it, and each range is then read with a single seek and read.
+Files larger than FILE_VIEW_MAX_BYTES are not shown at all, only offered
+for download.
+
+Highlighted ranges are cached by the digest of the file (which never
+changes; see storage.py), the lexer, and the range, in a per-process LRU
+cache bounded by HIGHLIGHT_CACHE_SIZE ranges and HIGHLIGHT_CACHE_BYTES.
+
+Since each range is highlighted on its own, a construct that spans the
+start of a range (eg. a multi-line string) may be colored incorrectly.
+"""
+
+import mmap
+from collections import namedtuple
+
+from markupsafe import Markup
+from pygments import highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import get_lexer_for_filename
+from pygments.lexers.special import TextLexer
+from pygments.util import ClassNotFound
+
+from .cache import LRUCache
+
+# a highlighted range of a file, with 1-based, inclusive line numbers
+FileRange = namedtuple('FileRange', 'html, first_line, last_line, num_lines, lines_per_range')
+
+
+class Highlighter:
+    """Renders stored files as highlighted HTML, one range of lines at a time."""
+
+    def __init__(self, lines_per_range=1000, cache_size=1000, cache_bytes=64 * 2**20):
+        """Initialize the Highlighter.
+
+        Parameters:
+            lines_per_range (int): The number of lines in each range.
+                Defaults to 1000.
+            cache_size (int): The maximum number of highlighted ranges to
+                cache. Defaults to 1000.
+            cache_bytes (int): The maximum total length of the cached HTML.
+                Defaults to 64 MiB.
+        """
+        self.lines_per_range = lines_per_range
+        self.html_cache = LRUCache(max_size=cache_size, max_bytes=cache_bytes)
+        # the indexes are much smaller than the HTML of a range
+        self.index_cache = LRUCache(max_size=cache_size)
+
+    def render(self, key, path, filename, first_line=1):
+        """Highlight the range of a file that contains a line.
+
+        Parameters:
+            key (str): What identifies the contents of the file, eg. its
+                digest.
+            path (Path): The file.
+            filename (str): The name of the file, which determines the lexer.
+            first_line (int): A line of the range to render. Defaults to 1.
+
+        Returns:
+            FileRange: The highlighted range. The range is empty (with a
+                first line of 1 and a last line of 0) if the file is.
+        """
+        offsets, num_lines = self.line_index(key, path)
+        if num_lines == 0:
+            return FileRange(Markup(''), 1, 0, 0, self.lines_per_range)
+        range_index = min(max(first_line - 1, 0) // self.lines_per_range, len(offsets) - 2)
+        first_line = range_index * self.lines_per_range + 1
+        last_line = min(first_line + self.lines_per_range - 1, num_lines)
+        lexer = _get_lexer(filename)
+        cache_key = (key, lexer.name, self.lines_per_range, range_index)
+        html = self.html_cache.get(cache_key)
+        if html is None:
+            with path.open('rb') as fd:
+                fd.seek(offsets[range_index])
+                data = fd.read(offsets[range_index + 1] - offsets[range_index])
+            formatter = HtmlFormatter(
+                linenos='table',
+                linenostart=first_line,
+                lineanchors='line',
+                anchorlinenos=True,
+            )
+            html = highlight(data.decode('utf-8', errors='replace'), lexer, formatter)
+            self.html_cache.put(cache_key, html)
+        return FileRange(Markup(html), first_line, last_line, num_lines, self.lines_per_range)
+
+    def line_index(self, key, path):
+        """Find where each range of a file starts.
+
+        Parameters:
+            key (str): What identifies the contents of the file.
+            path (Path): The file.
+
+        Returns:
+            Tuple[List[int], int]: The byte offsets of the start of each
+                range, followed by the size of the file, and the number of
+                lines in the file.
+        """
+        index = self.index_cache.get(key)
+        if index is None:
+            index = _index_lines(path, self.lines_per_range)
+            self.index_cache.put(key, index)
+        return index
+
+
+def _index_lines(path, lines_per_range):
+    offsets = [0]
+    num_lines = 0
+    with path.open('rb') as fd:
+        size = fd.seek(0, 2)
+        if size == 0:
+            return [0, 0], 0
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            position = 0
+            while position < size:
+                newline = data.find(b'\n', position)
+                position = (size if newline == -1 else newline + 1)
+                num_lines += 1
+                if num_lines % lines_per_range == 0 and position < size:
+                    offsets.append(position)
+    offsets.append(size)
+    return offsets, num_lines
+
+
+def _get_lexer(filename):
+    try:
+        return get_lexer_for_filename(filename, stripnl=False)
+    except ClassNotFound:
+        return TextLexer(stripnl=False)
+
+
+def init_highlighter(app):
+    """Create the highlighter of the app.
+
+    Parameters:
+        app (Flask): The Flask app.
+
+    Returns:
+        Highlighter: The highlighter of this process.
+    """
+    return Highlighter(
+        lines_per_range=app.config['FILE_VIEW_LINES'],
+        cache_size=app.config['HIGHLIGHT_CACHE_SIZE'],
+        cache_bytes=app.config['HIGHLIGHT_CACHE_BYTES'],
+    )
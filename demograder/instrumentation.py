@@ -0,0 +1,224 @@
+"""Per-request and per-job statistics of SQL queries.
+
+Every statement run through the app's engines is recorded in the QueryStats
+of the current request (or worker job, see job_query_stats()). At the end,
+requests and jobs that go over their query budget are logged, as are
+statements that repeat many times, which usually means an N+1 query pattern:
+a query per row of another query, typically from lazy relationship loads in
+a loop.
+"""
+
+import logging
+import re
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from heapq import heappush, heappushpop
+from time import perf_counter
+
+from flask import g, request
+from sqlalchemy import event
+
+_current_stats = ContextVar('query_stats', default=None)
+
+# lists of parameters, eg. "IN (?, ?, ?)", vary in length between calls
+PARAMETER_LIST_REGEX = re.compile(r'\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,)+\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*\)')
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised in strict mode when a request or job runs too many queries."""
+
+
+class QueryStats:
+    """Statistics of the queries run by one request or job."""
+
+    def __init__(self, name, budget, max_slowest=5):
+        """Initialize the QueryStats.
+
+        Parameters:
+            name (str): The name of the request or job, for logging.
+            budget (int): The number of queries allowed.
+            max_slowest (int): The number of slowest statements to keep.
+                Defaults to 5.
+        """
+        self.name = name
+        self.budget = budget
+        self.max_slowest = max_slowest
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = Counter()
+        self.reported = False
+        self._slowest = []
+
+    @property
+    def slowest(self):
+        """The slowest statements, from slowest to fastest.
+
+        Returns:
+            List[Tuple[float, str]]: The seconds taken, and the statement.
+        """
+        return sorted(self._slowest, reverse=True)
+
+    @property
+    def over_budget(self):
+        return self.budget is not None and self.count > self.budget
+
+    def record(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.shapes[PARAMETER_LIST_REGEX.sub('(?)', statement)] += 1
+        if len(self._slowest) < self.max_slowest:
+            heappush(self._slowest, (seconds, statement))
+        else:
+            heappushpop(self._slowest, (seconds, statement))
+
+    def repeated_shapes(self, threshold):
+        """Get the statements that were run at least some number of times.
+
+        Parameters:
+            threshold (int): The minimum number of times.
+
+        Returns:
+            List[Tuple[str, int]]: The statements and their counts.
+        """
+        return [
+            (shape, count) for shape, count in self.shapes.most_common()
+            if count >= threshold
+        ]
+
+    def report(self, config):
+        """Log problems with the queries, and raise in strict mode.
+
+        Parameters:
+            config (Mapping[str, Any]): The app config.
+
+        Raises:
+            QueryBudgetExceeded: If in strict mode and over budget.
+        """
+        # only report once, even if the error response is processed again
+        if self.reported:
+            return
+        self.reported = True
+        if self.over_budget:
+            logging.warning(
+                f'{self.name} ran {self.count} queries (budget {self.budget}) in {self.seconds * 1000:.1f} ms; '
+                + 'slowest: ' + '; '.join(f'{seconds * 1000:.1f} ms: {statement}' for seconds, statement in self.slowest)
+            )
+        for shape, count in self.repeated_shapes(config['N_PLUS_ONE_THRESHOLD']):
+            logging.warning(f'{self.name} ran the same statement {count} times (likely N+1): {shape}')
+        if self.over_budget and config['QUERY_BUDGET_STRICT']:
+            raise QueryBudgetExceeded(f'{self.name} ran {self.count} queries (budget {self.budget})')
+
+    def server_timing(self):
+        return f'db;dur={self.seconds * 1000:.1f};desc="{self.count} queries"'
+
+
+def current_query_stats():
+    """Get the query statistics of the current request or job, if any."""
+    return _current_stats.get()
+
+
+def query_budget(budget):
+    """Declare the number of queries a view may run.
+
+    This replaces the default budget (QUERY_BUDGET in settings.py).
+
+    Parameters:
+        budget (int): The number of queries allowed.
+    """
+
+    def decorator(view):
+
+        @wraps(view)
+        def wrapped_view(*args, **kwargs):
+            stats = current_query_stats()
+            if stats is not None:
+                stats.budget = budget
+            return view(*args, **kwargs)
+
+        return wrapped_view
+
+    return decorator
+
+
+@contextmanager
+def job_query_stats(app, name):
+    """Record the queries of a worker job.
+
+    Parameters:
+        app (Flask): The Flask app.
+        name (str): The name of the job, for logging.
+
+    Yields:
+        QueryStats: The statistics of the job.
+    """
+    stats = QueryStats(name, app.config['QUERY_BUDGET'])
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
+    stats.report(app.config)
+
+
+def init_instrumentation(app, db):
+    """Record the queries of every request of the app.
+
+    Parameters:
+        app (Flask): The Flask app.
+        db (SQLAlchemy): The Flask-SQLAlchemy extension.
+    """
+    with app.app_context():
+        engines = list(db.engines.values())
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(engine, 'handle_error', _handle_error)
+
+    @app.before_request
+    def start_query_stats():
+        stats = QueryStats(f'{request.method} {request.path}', app.config['QUERY_BUDGET'])
+        g.query_stats_token = _current_stats.set(stats)
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = current_query_stats()
+        if stats is None:
+            return response
+        if response.is_streamed:
+            # the queries of streamed templates run after this, so they are
+            # reported by stop_query_stats(), and have no Server-Timing
+            # header (stream_page() does not stream with SERVER_TIMING)
+            return response
+        if app.config['SERVER_TIMING']:
+            response.headers.add('Server-Timing', stats.server_timing())
+        stats.report(app.config)
+        return response
+
+    @app.teardown_request
+    def stop_query_stats(exception=None):
+        token = g.pop('query_stats_token', None)
+        if token is not None:
+            stats = current_query_stats()
+            _current_stats.reset(token)
+            if stats is not None and exception is None:
+                stats.report(app.config)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_times', []).append(perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = perf_counter() - conn.info['query_start_times'].pop()
+    stats = current_query_stats()
+    if stats is not None:
+        stats.record(statement, seconds)
+
+
+def _handle_error(exception_context):
+    # the statement failed, so after_cursor_execute will not be called
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('query_start_times'):
+        connection.info['query_start_times'].pop()
@@ -1,13 +1,16 @@
 """A job queue that dispatches jobs to separate processes."""
 
 import logging
-from typing import Any, Callable, Dict, Mapping, Optional, Tuple
+import resource
+from typing import Any, Callable, Dict, Mapping, Optional, Sequence, Tuple
 from collections import namedtuple
 from itertools import count as sequence
-from multiprocessing import Queue as ProcessQueue, Process
+from multiprocessing import get_context
+from multiprocessing.queues import Queue as ProcessQueue
 from os import cpu_count
 from queue import Queue as ThreadQueue
 from threading import Lock, Condition, Thread
+from time import monotonic
 
 __all__ = ['JobQueue']
 
@@ -24,6 +27,7 @@ class JobData:
         kwargs=None, # type: Optional[Mapping[Any, Any]]
         callback=None, # type: Optional[Callable[[Any], Any]]
         error_callback=None, # type: Optional[Callable[[Any], Any]]
+        tag=None, # type: Any
     ):
         # type: (...) -> None
         """Initialize a JobData.
@@ -36,6 +40,7 @@ class JobData:
                 function succeeds. Defaults to None.
             error_callback (Callable[[Any], Any]): The function to call when
                 the function succeeds. Defaults to None.
+            tag (Any): A label for the job, for monitoring. Defaults to None.
         """
         self.process_id = next(JobData.COUNTER)
         self.function = function
@@ -43,10 +48,17 @@ class JobData:
         self.kwargs = kwargs
         self.callback = callback
         self.error_callback = error_callback
+        self.tag = tag
+        # monotonic times of when the job was put, spawned, and finished
+        self.queued_at = monotonic()
+        self.started_at = None
+        self.finished_at = None
+        # the maximum resident memory of the process that ran the job, in KiB
+        self.max_rss = None
 
 
 ProcessInput = namedtuple('ProcessInput', 'process_id, function, args, kwargs')
-ProcessOutput = namedtuple('ProcessOutput', 'process_id, error, result')
+ProcessOutput = namedtuple('ProcessOutput', 'process_id, error, result, max_rss')
 
 
 class JobQueue:
@@ -80,12 +92,28 @@ class JobQueue:
     new process can spawn if necessary.
     """
 
-    def __init__(self, max_processes: int = None):
+    def __init__(
+        self,
+        max_processes: int = None,
+        monitor: Optional[Callable[[JobData, bool], Any]] = None,
+        preload: Sequence[str] = (),
+    ):
         """Initialize the JobQueue.
 
+        Processes are forked from a separate, single-threaded fork server.
+        Forking the (multi-threaded) calling process directly can deadlock
+        the child on locks that other threads held at the time, eg. inside
+        SQLite.
+
         Parameters:
             max_processes (int): The maximum number of processes running.
                 Defaults to the number of CPUs, or if indeterminable, to 4.
+            monitor (Callable[[JobData, bool], Any]): A function to call with
+                every finished job and whether it failed, after its callbacks.
+                Defaults to None.
+            preload (Sequence[str]): Modules for the fork server to import,
+                so that processes do not import them for every job. Defaults
+                to none.
         """
         # parameters
         if max_processes is None:
@@ -93,6 +121,9 @@ class JobQueue:
         if max_processes is None:
             max_processes = 4
         self._max_processes: int = max_processes # TODO use multiprocessing.Pool instead?
+        self.monitor = monitor
+        self.context = get_context('forkserver')
+        self.context.set_forkserver_preload(list(preload))
         # variables
         self._num_processes = 0
         self.job_data: Dict[int, JobData] = {}
@@ -100,19 +131,21 @@ class JobQueue:
         self.has_idle_process = Condition(self.mutex)
         # queues
         self.wait_queue: ThreadQueue = ThreadQueue()
-        self.run_queue: ProcessQueue = ProcessQueue()
-        self.result_queue: ProcessQueue = ProcessQueue()
+        self.run_queue: ProcessQueue = self.context.Queue()
+        self.result_queue: ProcessQueue = self.context.Queue()
         # threads
         # TODO handle signals to exit cleanly
         self.in_thread = Thread(
             name='in-thread',
             target=run_thread_main,
             args=(self,),
+            daemon=True,
         )
         self.out_thread = Thread(
             name='out-thread',
             target=result_thread_main,
             args=(self,),
+            daemon=True,
         )
         self.in_thread.start()
         self.out_thread.start()
@@ -163,6 +196,7 @@ class JobQueue:
         kwargs: Mapping = None,
         callback: Optional[Callable[[Any], Any]] = None,
         error_callback: Optional[Callable[[Any], Any]] = None,
+        tag: Any = None,
     ) -> None:
         """Add a job to be run.
 
@@ -174,12 +208,13 @@ class JobQueue:
                 function succeeds.
             error_callback (Callable[Any, None]): The function to call when the
                 function succeeds.
+            tag (Any): A label for the job, for monitoring.
         """
         if args is None:
             args = ()
         if kwargs is None:
             kwargs = {}
-        job_data = JobData(function, args, kwargs, callback, error_callback)
+        job_data = JobData(function, args, kwargs, callback, error_callback, tag)
         self.job_data[job_data.process_id] = job_data
         self.wait_queue.put(job_data.process_id)
 
@@ -202,7 +237,12 @@ def worker_main(run_queue: ProcessQueue, result_queue: ProcessQueue) -> None:
     except Exception as exception: # pylint: disable = broad-except
         result = exception
         error = True
-    result_queue.put(ProcessOutput(process_id, error, result))
+    result_queue.put(ProcessOutput(
+        process_id,
+        error,
+        result,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    ))
 
 
 def run_thread_main(job_queue: JobQueue) -> None:
@@ -219,13 +259,14 @@ def run_thread_main(job_queue: JobQueue) -> None:
                 job_queue.has_idle_process.wait()
             job_queue.spawned_process()
             job_data = job_queue.job_data[process_id]
+        job_data.started_at = monotonic()
         job_queue.run_queue.put(ProcessInput(
             job_data.process_id,
             job_data.function,
             job_data.args,
             job_data.kwargs,
         ))
-        process = Process(
+        process = job_queue.context.Process(
             target=worker_main,
             args=(job_queue.run_queue, job_queue.result_queue),
             daemon=True,
@@ -244,12 +285,16 @@ def result_thread_main(job_queue: JobQueue) -> None:
         process_output = job_queue.result_queue.get()
         process_id = process_output.process_id
         job_data = job_queue.job_data[process_id]
+        job_data.finished_at = monotonic()
+        job_data.max_rss = process_output.max_rss
         if process_output.error:
             if job_data.error_callback is not None:
                 job_data.error_callback(process_output.result)
         else:
             if job_data.callback is not None:
                 job_data.callback(*process_output.result)
+        if job_queue.monitor is not None:
+            job_queue.monitor(job_data, process_output.error)
         with job_queue.has_idle_process:
             job_queue.terminated_process()
             del job_queue.job_data[process_id]
@@ -0,0 +1,200 @@
+"""Feedback latency of submissions, from the lifecycle timestamps of results.
+
+Every result records when its evaluation was requested (queued_at), when its
+script started (started_at), and when its output was saved (finished_at).
+All the results of an evaluation of a submission are queued at the same time;
+re-evaluating a single result queues it again on its own. For each
+evaluation, the time to first result is from the request to the first saved
+result, and the time to complete is from the request to the last one.
+"""
+
+from collections import defaultdict
+from math import ceil
+
+from sqlalchemy import select
+
+from .models import db, Course, Assignment, Question, Submission, Result
+
+LATENCY_GROUPS = ('course', 'question', 'hour')
+
+
+def percentile(values, fraction):
+    """Get a percentile of some values, by the nearest rank.
+
+    Parameters:
+        values (List[float]): The values, sorted in ascending order.
+        fraction (float): The percentile, between 0 and 1.
+
+    Returns:
+        float: The percentile, or None if there are no values.
+    """
+    if not values:
+        return None
+    return values[max(ceil(fraction * len(values)), 1) - 1]
+
+
+def evaluation_latencies(since, until=None, course_id=None):
+    """Get the latencies of the evaluations of submissions in a period.
+
+    The results are fetched in one query, in batches. Results from before
+    lifecycle timestamps were recorded are ignored.
+
+    Parameters:
+        since (DateTime): The start of the period.
+        until (DateTime): The end of the period. Defaults to now.
+        course_id (int): If given, only include submissions to this course.
+
+    Yields:
+        Dict[str, Any]: For each evaluation, the course and question of the
+            submission, and when the evaluation was requested; the times (in
+            seconds) to the first result and to complete, which are None if
+            they have not happened yet; and the queue and run times (in seconds) of its results.
+    """
+    statement = (
+        select(
+            Result.submission_id,
+            Course.id.label('course_id'),
+            Assignment.name.label('assignment'),
+            Question.id.label('question_id'),
+            Question.name.label('question'),
+            Result.queued_at,
+            Result.started_at,
+            Result.finished_at,
+        )
+        .join(Submission, Result.submission_id == Submission.id)
+        .join(Question, Submission.question_id == Question.id)
+        .join(Assignment, Question.assignment_id == Assignment.id)
+        .join(Course, Assignment.course_id == Course.id)
+        .where(Result.queued_at >= since)
+        .order_by(Result.submission_id, Result.queued_at)
+        .execution_options(yield_per=500)
+    )
+    if until is not None:
+        statement = statement.where(Result.queued_at < until)
+    if course_id is not None:
+        statement = statement.where(Course.id == course_id)
+    evaluation = None
+    for row in db.session.execute(statement):
+        key = (row.submission_id, row.queued_at)
+        if evaluation is None or evaluation['key'] != key:
+            if evaluation is not None:
+                yield _finish_evaluation(evaluation)
+            evaluation = {
+                'key': key,
+                'submission_id': row.submission_id,
+                'course_id': row.course_id,
+                'assignment': row.assignment,
+                'question_id': row.question_id,
+                'question': row.question,
+                'queued_at': row.queued_at,
+                'results': [],
+            }
+        evaluation['results'].append((row.started_at, row.finished_at))
+    if evaluation is not None:
+        yield _finish_evaluation(evaluation)
+
+
+def _finish_evaluation(evaluation):
+    del evaluation['key']
+    results = evaluation.pop('results')
+    queued_at = evaluation['queued_at']
+    finished = [finished_at for _, finished_at in results if finished_at is not None]
+    if finished:
+        evaluation['first_result'] = (min(finished) - queued_at).total_seconds()
+    else:
+        evaluation['first_result'] = None
+    if len(finished) == len(results):
+        evaluation['complete'] = (max(finished) - queued_at).total_seconds()
+    else:
+        evaluation['complete'] = None
+    evaluation['queue_times'] = [
+        (started_at - queued_at).total_seconds()
+        for started_at, _ in results
+        if started_at is not None
+    ]
+    evaluation['run_times'] = [
+        (finished_at - started_at).total_seconds()
+        for started_at, finished_at in results
+        if started_at is not None and finished_at is not None
+    ]
+    return evaluation
+
+
+def latency_report(evaluations, group, target_seconds):
+    """Summarize evaluation latencies by course, question, or hour.
+
+    Parameters:
+        evaluations (Iterable[Dict[str, Any]]): The latencies, as returned by
+            evaluation_latencies().
+        group (str): One of LATENCY_GROUPS. Hours are grouped by question
+            too, so that slow questions around deadlines stand out.
+        target_seconds (float): The target time to complete.
+
+    Returns:
+        List[Dict[str, Any]]: For each group, the number of evaluations and
+            of those still pending, the p50, p95, and p99 of the times to the
+            first result and to complete, the p95 queue and run times of
+            results, and the fraction of evaluations completed within the
+            target. Hours are sorted from the latest, and other groups by
+            their p95 time to complete, from the slowest.
+    """
+    groups = defaultdict(lambda: {
+        'evaluations': 0,
+        'pending': 0,
+        'first_result': [],
+        'complete': [],
+        'queue_times': [],
+        'run_times': [],
+    })
+    for evaluation in evaluations:
+        if group == 'course':
+            key = (evaluation['course_id'],)
+        elif group == 'question':
+            key = (evaluation['course_id'], evaluation['assignment'], evaluation['question_id'], evaluation['question'])
+        else:
+            hour = evaluation['queued_at'].replace(minute=0, second=0, microsecond=0)
+            key = (hour, evaluation['course_id'], evaluation['assignment'], evaluation['question_id'], evaluation['question'])
+        summary = groups[key]
+        summary['evaluations'] += 1
+        if evaluation['first_result'] is not None:
+            summary['first_result'].append(evaluation['first_result'])
+        if evaluation['complete'] is not None:
+            summary['complete'].append(evaluation['complete'])
+        else:
+            summary['pending'] += 1
+        summary['queue_times'].extend(evaluation['queue_times'])
+        summary['run_times'].extend(evaluation['run_times'])
+    courses = {}
+    course_ids = set(key[0] if group != 'hour' else key[1] for key in groups)
+    if course_ids:
+        courses = {
+            course.id: course for course in
+            db.session.scalars(select(Course).where(Course.id.in_(course_ids)))
+        }
+    report = []
+    for key, summary in groups.items():
+        row = {
+            'evaluations': summary['evaluations'],
+            'pending': summary['pending'],
+        }
+        if group == 'hour':
+            row['hour'] = key[0]
+            key = key[1:]
+        row['course'] = courses[key[0]]
+        if group != 'course':
+            row['assignment'], row['question_id'], row['question'] = key[1:]
+        for name in ('first_result', 'complete', 'queue_times', 'run_times'):
+            summary[name].sort()
+        for name in ('first_result', 'complete'):
+            for fraction in (0.5, 0.95, 0.99):
+                row[f'{name}_p{round(fraction * 100)}'] = percentile(summary[name], fraction)
+        row['queue_p95'] = percentile(summary['queue_times'], 0.95)
+        row['run_p95'] = percentile(summary['run_times'], 0.95)
+        within_target = sum(1 for seconds in summary['complete'] if seconds <= target_seconds)
+        row['within_target'] = within_target / summary['evaluations']
+        report.append(row)
+    if group == 'hour':
+        report.sort(key=(lambda row: row['hour']), reverse=True)
+    else:
+        report.sort(key=(lambda row: -1 if row['complete_p95'] is None else row['complete_p95']), reverse=True)
+    return report
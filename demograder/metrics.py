@@ -0,0 +1,410 @@
+"""Counters, gauges and histograms of the web processes and job queue.
+
+Each process keeps its own metrics in memory, and periodically writes a
+snapshot of them to a file in METRICS_PATH. Reading the metrics aggregates
+the snapshots of all processes (eg. all gunicorn workers): counters and
+histograms are summed over every snapshot, and gauges over the snapshots of
+processes that are still running.
+
+Snapshot files are named by the host, the process ID, and a random nonce
+chosen when the process starts, so that a process that reuses the ID of a
+stopped one does not overwrite its snapshot (which would make the summed
+counters go backwards). Snapshots of stopped processes are deleted once they
+are older than METRICS_MAX_AGE_SECONDS.
+"""
+
+import json
+import os
+import socket
+from collections import defaultdict
+from functools import partial
+from pathlib import Path
+from threading import Lock, Thread
+from time import perf_counter, sleep, time
+from uuid import uuid4
+
+from flask import g, request
+
+from .instrumentation import current_query_stats
+
+# how often each process deletes stale snapshots
+PRUNE_SECONDS = 60 * 60
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+METRICS = {
+    'demograder_http_requests_total': ('counter', 'HTTP requests, by endpoint and status code.'),
+    'demograder_http_request_seconds': ('histogram', 'HTTP request latency, by endpoint.'),
+    'demograder_db_queries_total': ('counter', 'SQL queries run by HTTP requests, by endpoint.'),
+    'demograder_db_query_seconds_total': ('counter', 'Time spent in SQL queries by HTTP requests, by endpoint.'),
+    'demograder_jobs_total': ('counter', 'Finished jobs, by job and outcome.'),
+    'demograder_job_wait_seconds': ('histogram', 'Time jobs wait in the queue, by job and question.'),
+    'demograder_job_run_seconds': ('histogram', 'Time jobs take to run, by job and question.'),
+    'demograder_job_queue_depth': ('gauge', 'Jobs waiting for a process.'),
+    'demograder_job_processes_running': ('gauge', 'Job processes running.'),
+    'demograder_job_processes_idle': ('gauge', 'Job processes that could be started.'),
+    'demograder_result_writer_depth': ('gauge', 'Writes waiting for the result writer.'),
+    'demograder_event_streams': ('gauge', 'Open result event streams.'),
+}
+
+
+class Metrics:
+    """The metrics of one process."""
+
+    def __init__(self, path, flush_seconds=5, max_age_seconds=7 * 24 * 60 * 60):
+        """Initialize the Metrics.
+
+        Parameters:
+            path (Path): The directory shared by all processes for snapshots.
+            flush_seconds (float): How often to write snapshots. Defaults to 5.
+            max_age_seconds (float): How long to keep the snapshots of
+                processes that have stopped. Defaults to one week.
+        """
+        self.path = Path(path)
+        self.flush_seconds = flush_seconds
+        self.max_age_seconds = max_age_seconds
+        self.lock = Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.gauges = {}
+        self._pid = None
+        self._filename = None
+
+    def inc(self, name, labels=None, value=1):
+        """Increment a counter.
+
+        Parameters:
+            name (str): The name of the counter.
+            labels (Dict[str, str]): The labels of the counter.
+            value (float): The amount to increment by. Defaults to 1.
+        """
+        with self.lock:
+            self.counters[_key(name, labels)] += value
+
+    def observe(self, name, value, labels=None):
+        """Add an observation to a histogram.
+
+        Parameters:
+            name (str): The name of the histogram.
+            value (float): The observed value, in seconds.
+            labels (Dict[str, str]): The labels of the histogram.
+        """
+        key = _key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+            histogram = self.histograms[key]
+            for index, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[0][index] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def gauge(self, name, function, labels=None):
+        """Register a gauge, whose value is computed when it is read.
+
+        Parameters:
+            name (str): The name of the gauge.
+            function (Callable[[], float]): The function that computes it.
+            labels (Dict[str, str]): The labels of the gauge.
+        """
+        self.gauges[_key(name, labels)] = function
+
+    def snapshot(self):
+        """Get the current metrics of this process.
+
+        Returns:
+            Dict[str, Any]: The snapshot, which is JSON-serializable.
+        """
+        with self.lock:
+            return {
+                'time': time(),
+                'pid': os.getpid(),
+                'hostname': socket.gethostname(),
+                'counters': [[*key, value] for key, value in self.counters.items()],
+                'histograms': [[*key, *histogram] for key, histogram in self.histograms.items()],
+                'gauges': [[*key, function()] for key, function in self.gauges.items()],
+            }
+
+    def _snapshot_filename(self):
+        # not computed ahead of time, since the app may be created before forking
+        pid = os.getpid()
+        if pid != self._pid:
+            with self.lock:
+                if self._pid is not None:
+                    # after a fork, the parent's metrics are in the parent's snapshot
+                    self.counters.clear()
+                    self.histograms.clear()
+                self._pid = pid
+                self._filename = f'{socket.gethostname()}-{pid}-{uuid4().hex[:12]}.json'
+        return self._filename
+
+    def flush(self):
+        """Write the snapshot of this process."""
+        filename = self._snapshot_filename()
+        self.path.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path / f'.{filename}'
+        with temp_path.open('w', encoding='utf-8') as fd:
+            json.dump(self.snapshot(), fd)
+        os.replace(temp_path, self.path / filename)
+
+    def start(self):
+        """Start writing snapshots in a background thread."""
+        Thread(name='metrics-thread', target=self._run, daemon=True).start()
+
+    def _run(self):
+        last_prune = 0
+        while True:
+            sleep(self.flush_seconds)
+            self.flush()
+            # aggregate() also prunes, but may never be called
+            if time() - last_prune > PRUNE_SECONDS:
+                self.prune()
+                last_prune = time()
+
+    def prune(self):
+        """Delete the snapshots that have not been written for max_age_seconds."""
+        cutoff = time() - self.max_age_seconds
+        for snapshot_path in self.path.glob('*.json'):
+            try:
+                if snapshot_path.stat().st_mtime < cutoff:
+                    snapshot_path.unlink(missing_ok=True)
+            except OSError:
+                continue
+
+    def aggregate(self):
+        """Aggregate the snapshots of all processes.
+
+        Returns:
+            Dict[str, Any]: The counters, histograms and gauges, each as a
+                dictionary from (name, labels) to values.
+        """
+        self.flush()
+        counters = defaultdict(float)
+        histograms = {}
+        gauges = defaultdict(float)
+        now = time()
+        for snapshot_path in self.path.glob('*.json'):
+            try:
+                with snapshot_path.open(encoding='utf-8') as fd:
+                    snapshot = json.load(fd)
+            except (OSError, ValueError):
+                continue
+            age = now - snapshot['time']
+            if age > self.max_age_seconds:
+                snapshot_path.unlink(missing_ok=True)
+                continue
+            for name, labels, value in snapshot['counters']:
+                counters[(name, _labels_key(labels))] += value
+            for name, labels, buckets, total, count in snapshot['histograms']:
+                key = (name, _labels_key(labels))
+                if key not in histograms:
+                    histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+                histogram = histograms[key]
+                histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+                histogram[1] += total
+                histogram[2] += count
+            # processes that have not written a snapshot recently have stopped
+            if age < 3 * self.flush_seconds:
+                for name, labels, value in snapshot['gauges']:
+                    gauges[(name, _labels_key(labels))] += value
+        return {
+            'counters': dict(counters),
+            'histograms': histograms,
+            'gauges': dict(gauges),
+        }
+
+
+def _key(name, labels):
+    return (name, tuple(sorted((labels or {}).items())))
+
+
+def _labels_key(labels):
+    return tuple(tuple(pair) for pair in labels)
+
+
+def quantile(histogram, fraction):
+    """Estimate a quantile of a histogram, as the upper bound of its bucket.
+
+    Parameters:
+        histogram (List): The bucket counts, sum, and count of the histogram.
+        fraction (float): The quantile, between 0 and 1.
+
+    Returns:
+        float: The estimate, or None if it is beyond the largest bucket.
+    """
+    buckets, _, count = histogram
+    cumulative = 0
+    for bound, bucket_count in zip(BUCKETS, buckets):
+        cumulative += bucket_count
+        if cumulative >= fraction * count:
+            return bound
+    return None
+
+
+def dashboard(aggregate):
+    """Summarize aggregated metrics for the admin dashboard.
+
+    Parameters:
+        aggregate (Dict[str, Any]): The metrics, from Metrics.aggregate().
+
+    Returns:
+        Dict[str, Any]: The gauges by name, and lists of summaries of
+            endpoints and of jobs.
+    """
+    counters = aggregate['counters']
+    histograms = aggregate['histograms']
+    endpoints = []
+    for (name, labels), histogram in histograms.items():
+        if name != 'demograder_http_request_seconds':
+            continue
+        endpoint = dict(labels)['endpoint']
+        statuses = {
+            dict(counter_labels)['status']: value
+            for (counter_name, counter_labels), value in counters.items()
+            if counter_name == 'demograder_http_requests_total' and dict(counter_labels)['endpoint'] == endpoint
+        }
+        count = histogram[2]
+        endpoints.append({
+            'endpoint': endpoint,
+            'count': count,
+            'errors': sum(value for status, value in statuses.items() if status.startswith('5')),
+            'mean': histogram[1] / count,
+            'p50': quantile(histogram, 0.5),
+            'p95': quantile(histogram, 0.95),
+            'p99': quantile(histogram, 0.99),
+            'queries': counters.get(('demograder_db_queries_total', labels), 0) / count,
+        })
+    jobs = []
+    for (name, labels), histogram in histograms.items():
+        if name != 'demograder_job_run_seconds':
+            continue
+        wait_histogram = histograms.get(('demograder_job_wait_seconds', labels), [[], 0, 0])
+        count = histogram[2]
+        jobs.append({
+            **dict(labels),
+            'count': count,
+            'wait_mean': wait_histogram[1] / count,
+            'wait_p95': quantile(wait_histogram, 0.95),
+            'run_mean': histogram[1] / count,
+            'run_p95': quantile(histogram, 0.95),
+        })
+    return {
+        'gauges': {name: value for (name, _), value in aggregate['gauges'].items()},
+        'job_outcomes': {
+            tuple(value for _, value in labels): value
+            for (name, labels), value in counters.items()
+            if name == 'demograder_jobs_total'
+        },
+        'endpoints': sorted(endpoints, key=(lambda summary: summary['endpoint'])),
+        'jobs': sorted(jobs, key=(lambda summary: (summary['job'], summary['question']))),
+    }
+
+
+def format_prometheus(aggregate):
+    """Format aggregated metrics in the Prometheus text format.
+
+    Parameters:
+        aggregate (Dict[str, Any]): The metrics, from Metrics.aggregate().
+
+    Returns:
+        str: The metrics.
+    """
+    series = defaultdict(list)
+    for kind in ('counters', 'gauges'):
+        for (name, labels), value in sorted(aggregate[kind].items()):
+            series[name].append(f'{name}{_format_labels(labels)} {value:g}')
+    for (name, labels), (buckets, total, count) in sorted(aggregate['histograms'].items()):
+        cumulative = 0
+        for bound, bucket_count in zip(BUCKETS, buckets):
+            cumulative += bucket_count
+            series[name].append(f'{name}_bucket{_format_labels(labels, le=f"{bound:g}")} {cumulative}')
+        series[name].append(f'{name}_bucket{_format_labels(labels, le="+Inf")} {count}')
+        series[name].append(f'{name}_sum{_format_labels(labels)} {total:g}')
+        series[name].append(f'{name}_count{_format_labels(labels)} {count}')
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.extend(series[name])
+    return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for key, value in pairs
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def init_metrics(app):
+    """Record the latency, status and queries of every request of the app.
+
+    Parameters:
+        app (Flask): The Flask app.
+
+    Returns:
+        Metrics: The metrics of this process.
+    """
+    metrics = Metrics(
+        app.config['METRICS_PATH'],
+        flush_seconds=app.config['METRICS_FLUSH_SECONDS'],
+        max_age_seconds=app.config['METRICS_MAX_AGE_SECONDS'],
+    )
+
+    @app.before_request
+    def start_timer():
+        g.request_start_time = perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start_time = g.pop('request_start_time', None)
+        if start_time is None:
+            return response
+        record = partial(
+            _record_request,
+            metrics,
+            request.endpoint or 'unknown',
+            response.status_code,
+            start_time,
+            current_query_stats(),
+        )
+        if response.is_streamed:
+            # the body (and its queries) only finish once it is sent
+            response.call_on_close(record)
+        else:
+            record()
+        return response
+
+    return metrics
+
+
+def _record_request(metrics, endpoint, status_code, start_time, stats):
+    metrics.observe('demograder_http_request_seconds', perf_counter() - start_time, {'endpoint': endpoint})
+    metrics.inc('demograder_http_requests_total', {'endpoint': endpoint, 'status': str(status_code)})
+    if stats is not None:
+        metrics.inc('demograder_db_queries_total', {'endpoint': endpoint}, stats.count)
+        metrics.inc('demograder_db_query_seconds_total', {'endpoint': endpoint}, stats.seconds)
+
+
+def record_job(metrics, job_data, error):
+    """Record the timing and outcome of a finished job.
+
+    This is the monitor of the job queue (see dispatch.create_job_queue()).
+
+    Parameters:
+        metrics (Metrics): The metrics of this process.
+        job_data (JobData): The finished job.
+        error (bool): Whether the job raised an exception.
+    """
+    job = job_data.function.__name__
+    labels = {'job': job, 'question': str(job_data.tag or '')}
+    metrics.inc('demograder_jobs_total', {'job': job, 'outcome': ('error' if error else 'success')})
+    metrics.observe('demograder_job_wait_seconds', job_data.started_at - job_data.queued_at, labels)
+    metrics.observe('demograder_job_run_seconds', job_data.finished_at - job_data.started_at, labels)
@@ -0,0 +1,163 @@
+"""Upgrades for databases created by older versions of the models.
+
+db.create_all() only creates missing tables. This module also adds missing
+columns and indexes to existing tables, and fills in derived data for them.
+"""
+
+from sqlalchemy import func, inspect, or_, select
+from sqlalchemy.schema import CreateColumn
+
+from .models import db, Assignment, Blob, FileGrant, Result, SubmissionFile
+from .storage import store_file
+
+
+def upgrade_database(app):
+    """Create and upgrade all tables.
+
+    Parameters:
+        app (Flask): The Flask app.
+    """
+    with app.app_context():
+        inspector = inspect(db.engine)
+        old_tables = set(inspector.get_table_names())
+        # only the primary; a read replica gets its tables from replication
+        db.create_all(bind_key=None)
+        added = []
+        for table in db.metadata.sorted_tables:
+            if table.name not in old_tables:
+                added.append((table.name, None))
+                continue
+            old_columns = set(column['name'] for column in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name not in old_columns:
+                    _add_column(table, column)
+                    added.append((table.name, column.name))
+            old_indexes = set(index['name'] for index in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in old_indexes:
+                    index.create(db.engine)
+        backfills = []
+        for key in added:
+            # several new columns may share a backfill
+            if key in BACKFILLS and BACKFILLS[key] not in backfills:
+                backfills.append(BACKFILLS[key])
+        for backfill in backfills:
+            backfill()
+            db.session.commit()
+
+
+def _add_column(table, column):
+    column_sql = CreateColumn(column).compile(dialect=db.engine.dialect)
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column_sql}')
+
+
+def _backfill_assignment_summaries():
+    for assignment in db.session.scalars(select(Assignment)):
+        assignment.update_summary()
+
+
+def _backfill_file_grants():
+    FileGrant.refresh(select(Result.id))
+
+
+# functions to fill in derived data for new columns (or new tables, with a
+# column name of None), keyed by (table name, column name)
+BACKFILLS = {
+    ('assignments', 'due_date'): _backfill_assignment_summaries,
+    ('assignments', 'has_undated_question'): _backfill_assignment_summaries,
+    ('file_grants', None): _backfill_file_grants,
+}
+
+
+def migrate_result_outputs(batch_size=1000):
+    """Move result output stored in the results table into blobs.
+
+    This is safe to interrupt and re-run; each batch is committed separately.
+    Note that SQLite only returns the freed space to the file system after a
+    VACUUM.
+
+    Parameters:
+        batch_size (int): The number of results to migrate per transaction.
+            Defaults to 1000.
+
+    Returns:
+        Dict[str, int]: The number of results migrated, the bytes of output
+            they had inline, and the bytes of new blobs that were created.
+    """
+    report = {'results': 0, 'inline_bytes': 0, 'blob_bytes': 0}
+    blobs_before = db.session.scalar(select(func.coalesce(func.sum(func.length(Blob.data)), 0)))
+    while True:
+        results = db.session.scalars(
+            select(Result)
+            .options(db.undefer(Result.inline_stdout), db.undefer(Result.inline_stderr))
+            .where(or_(Result.inline_stdout.is_not(None), Result.inline_stderr.is_not(None)))
+            .limit(batch_size)
+        ).all()
+        if not results:
+            break
+        for result in results:
+            for stream in ('stdout', 'stderr'):
+                text = getattr(result, f'inline_{stream}')
+                if text is None:
+                    continue
+                report['inline_bytes'] += len(text.encode('utf-8'))
+                # the setter stores the blob and clears the inline column
+                setattr(result, stream, text)
+        report['results'] += len(results)
+        db.session.commit()
+    blobs_after = db.session.scalar(select(func.coalesce(func.sum(func.length(Blob.data)), 0)))
+    report['blob_bytes'] = blobs_after - blobs_before
+    return report
+
+
+def migrate_submission_files(batch_size=1000):
+    """Move submitted files into the content-addressed store.
+
+    Files are moved from their old per-submission paths, and the old copies
+    are deleted once the new paths are committed. Files that are missing are
+    skipped, and left on their old paths.
+
+    Parameters:
+        batch_size (int): The number of files to migrate per transaction.
+            Defaults to 1000.
+
+    Returns:
+        Dict[str, int]: The number of files migrated and missing, the bytes
+            they used, and the bytes of new objects that were created.
+    """
+    report = {'files': 0, 'missing': 0, 'file_bytes': 0, 'object_bytes': 0}
+    last_id = 0
+    while True:
+        submission_files = db.session.scalars(
+            select(SubmissionFile)
+            .where(SubmissionFile.digest.is_(None), SubmissionFile.id > last_id)
+            .order_by(SubmissionFile.id)
+            .limit(batch_size)
+        ).all()
+        if not submission_files:
+            break
+        last_id = submission_files[-1].id
+        migrated = []
+        for submission_file in submission_files:
+            legacy_filepath = submission_file.legacy_filepath
+            if not legacy_filepath.exists():
+                report['missing'] += 1
+                continue
+            with legacy_filepath.open('rb') as fd:
+                digest, size = store_file(fd)
+            # identical files already in the store take no new space
+            already_stored = db.session.scalar(
+                select(func.count()).where(SubmissionFile.digest == digest)
+            )
+            if not already_stored:
+                report['object_bytes'] += size
+            submission_file.digest = digest
+            submission_file.size = size
+            report['files'] += 1
+            report['file_bytes'] += size
+            migrated.append(legacy_filepath)
+        db.session.commit()
+        for legacy_filepath in migrated:
+            legacy_filepath.unlink()
+    return report
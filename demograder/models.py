@@ -1,15 +1,20 @@
+import zlib
 from datetime import datetime as DateTime
 from enum import IntEnum
+from hashlib import sha256
 from itertools import product
 from textwrap import dedent
 
-from flask import current_app
+from flask import current_app, g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
-from sqlalchemy import select, case, func, or_
-from sqlalchemy.orm import aliased, validates
+from sqlalchemy import select, and_, case, delete, false, func, insert, literal, or_, union_all, update
+from sqlalchemy.orm import aliased, selectinload, validates
 
-db = SQLAlchemy()
+from .database import RoutingSession
+from .storage import object_path
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 
 class SiteRole(IntEnum):
@@ -62,10 +67,17 @@ class User(db.Model, UserMixin):
         return f'{self.preferred_name} {self.family_name}'
 
     def is_teaching(self, course_id):
-        return any(course.id == course_id for course in self.courses_teaching)
+        return course_id in course_memberships(self.id)[0]
 
     def is_taking(self, course_id):
-        return any(course.id == course_id for course in self.courses_taking)
+        return course_id in course_memberships(self.id)[1]
+
+    def is_member(self, course_id):
+        return self.is_teaching(course_id) or self.is_taking(course_id)
+
+    def teaches_student(self, student_id):
+        # return whether the user teaches a course that the student is enrolled in
+        return bool(course_memberships(self.id)[0] & course_memberships(student_id)[1])
 
     def get_id(self):
         # this method is required by flask-login
@@ -117,22 +129,20 @@ class User(db.Model, UserMixin):
 
     def submissions_from_students(self, include_hidden=False, include_disabled=False, limit=None):
         statement = (
-            select(Submission)
-            .where(Submission.disabled == include_disabled)
-            .join(Question)
-            .where(Question.visible == (not include_hidden))
+            select(Question.id)
             .join(Assignment)
-            .join(Course)
-            .join(Instructor)
+            .join(Instructor, Instructor.course_id == Assignment.course_id)
             .where(Instructor.user_id == self.id)
-            .order_by(Submission.timestamp.desc())
         )
-        if limit is None:
-            return db.session.scalars(statement)
-        else:
-            return db.session.scalars(statement.limit(limit))
+        if not include_hidden:
+            statement = statement.where(Question.visible == True)
+        return _question_submissions(
+            db.session.scalars(statement).all(),
+            include_disabled=include_disabled,
+            limit=limit,
+        )
 
-    def submissions(self, include_hidden=False, include_disabled=False, before=None, limit=None):
+    def submissions(self, include_hidden=False, include_disabled=False, before=None, limit=None, older_than=None, newer_than=None):
         statement = select(Submission).where(Submission.user_id == self.id)
         if before:
             statement = statement.where(Submission.timestamp <= before)
@@ -144,7 +154,7 @@ class User(db.Model, UserMixin):
                 .join(Question)
                 .where(Question.visible == True)
             )
-        statement = statement.order_by(Submission.timestamp.desc())
+        statement = _order_submissions(statement, older_than, newer_than)
         if limit is None:
             return db.session.scalars(statement)
         else:
@@ -168,7 +178,16 @@ class User(db.Model, UserMixin):
         * the project is not locked
         * all their previous submissions for this project have finished running
         * the cooldown has not passed since their last submission to a question
+
+        The answer is cached for the rest of the request, since both the view
+        and the template need it.
         """
+        cache = request_cache('may_submit')
+        if (self.id, question_id) not in cache:
+            cache[(self.id, question_id)] = self._may_submit(question_id)
+        return cache[(self.id, question_id)]
+
+    def _may_submit(self, question_id):
         question = db.session.get(Question, question_id)
         if self.admin or self.is_teaching(question.course.id):
             return True
@@ -191,33 +210,70 @@ class User(db.Model, UserMixin):
 
         * the file is from a submission used in a result for the student
         * the question dependency allows viewing that upstream submission
+
+        These are precomputed as FileGrants when results are created.
         """
         submission_file = db.session.get(SubmissionFile, submission_file_id)
-        if self.is_teaching(submission_file.course.id):
-            return True
         if self == submission_file.submitter:
             return True
-        producer_alias = aliased(Question)
-        consumer_alias = aliased(Question)
-        consumer_submissions_alias = aliased(Submission)
-        return bool(db.session.scalar(
-            select(QuestionDependency)
-            .distinct()
-            .where(QuestionDependency.viewable == True)
-            .join(producer_alias, QuestionDependency.producer)
-            .join(producer_alias.all_submissions)
-            .join(SubmissionFile)
-            .where(SubmissionFile.id == submission_file_id)
-            .join(consumer_alias, QuestionDependency.consumer)
-            .join(consumer_submissions_alias, consumer_alias.all_submissions)
-            .where(consumer_submissions_alias.user_id == self.id)
-        ))
+        if self.is_teaching(submission_file.course.id):
+            return True
+        return db.session.scalar(
+            select(FileGrant.id)
+            .where(
+                FileGrant.user_id == self.id,
+                FileGrant.submission_file_id == submission_file_id,
+            )
+            .limit(1)
+        ) is not None
 
     @staticmethod
     def get_by_email(email):
         return db.session.scalar(select(User).where(User.email == email))
 
 
+def request_cache(name):
+    """Get a dictionary that is kept for the duration of the request.
+
+    Outside of an application context, a new (and so uncached) dictionary is
+    returned every time.
+    """
+    if not has_app_context():
+        return {}
+    return g.setdefault(name, {})
+
+
+def course_memberships(user_id):
+    """Get the IDs of the courses a user is teaching and taking.
+
+    Both sets are loaded with a single query and cached for the rest of the
+    request, so permission checks do not need to load the full course lists.
+
+    Returns:
+        Tuple[FrozenSet[int], FrozenSet[int]]: The IDs of the courses the user
+            is teaching, and the IDs of the courses the user is taking.
+    """
+    cache = request_cache('course_memberships')
+    if user_id not in cache:
+        teaching = set()
+        taking = set()
+        rows = db.session.execute(
+            select(Instructor.course_id, literal(True))
+            .where(Instructor.user_id == user_id)
+            .union_all(
+                select(Student.course_id, literal(False))
+                .where(Student.user_id == user_id)
+            )
+        )
+        for course_id, is_instructor in rows:
+            if is_instructor:
+                teaching.add(course_id)
+            else:
+                taking.add(course_id)
+        cache[user_id] = (frozenset(teaching), frozenset(taking))
+    return cache[user_id]
+
+
 class Instructor(db.Model):
     __tablename__ = 'instructors'
     __table_args__ = (
@@ -238,6 +294,9 @@ class Student(db.Model):
     course_id = db.Column(db.Integer, db.ForeignKey('courses.id'), nullable=False, index=True)
 
 
+# the most questions whose submissions are merged in one compound select (see _question_submissions())
+MAX_MERGED_QUESTIONS = 100
+
 SEASONS = ['Fall', 'Winter', 'Spring', 'Summer']
 SEASONS_ORDER_MAP = {season: index for index, season in enumerate(SEASONS)}
 
@@ -248,7 +307,7 @@ class Course(db.Model):
         db.UniqueConstraint('season', 'year', 'department_code', 'number', 'section'),
     )
     id = db.Column(db.Integer, primary_key=True)
-    season = db.Column(db.Enum(*SEASONS), nullable=False)
+    season = db.Column(db.Enum(*SEASONS, name='season'), nullable=False)
     year = db.Column(db.Integer, nullable=False)
     department_code = db.Column(db.String, nullable=False)
     number = db.Column(db.String, nullable=False)
@@ -294,38 +353,54 @@ class Course(db.Model):
             return f'{self.department_code} {self.number} {self.section}'
 
     def assignments(self, include_hidden=False):
-        assignments = db.session.scalars(
-            select(Assignment)
-            .where(Assignment.course_id == self.id)
+        statement = select(Assignment).where(Assignment.course_id == self.id)
+        if not include_hidden:
+            statement = statement.where(Assignment.visible == True)
+        # questions without a due date are treated as being due now, so an
+        # assignment with one is due now or when its last dated question is due
+        now = DateTime.now()
+        effective_due_date = case(
+            (
+                or_(
+                    Assignment.due_date.is_(None),
+                    and_(Assignment.has_undated_question == True, Assignment.due_date < now),
+                ),
+                now,
+            ),
+            else_=Assignment.due_date,
         )
-        return sorted(
-            (assignment for assignment in assignments if include_hidden or assignment.visible),
-            key=(lambda assignment: (assignment.due_date, assignment.name.lower())),
-            reverse=True,
+        statement = statement.order_by(
+            effective_due_date.desc(),
+            func.lower(Assignment.name).desc(),
         )
+        return db.session.scalars(statement)
 
-    def submissions(self, user_id=None, include_hidden=False, include_disabled=False, before=None, limit=None):
-        statement = select(Submission)
-        if user_id:
-            statement = statement.where(Submission.user_id == user_id)
-        if before:
-            statement = statement.where(Submission.timestamp <= before)
-        if not include_disabled:
-            statement = statement.where(Submission.disabled == False)
-        statement = statement.join(Question)
+    def submissions(self, user_id=None, include_hidden=False, include_disabled=False, before=None, limit=None, older_than=None, newer_than=None):
+        statement = (
+            select(Question.id)
+            .join(Assignment)
+            .where(Assignment.course_id == self.id)
+        )
         if not include_hidden:
             statement = statement.where(Question.visible == True)
+        return _question_submissions(
+            db.session.scalars(statement).all(),
+            user_id=user_id,
+            include_disabled=include_disabled,
+            before=before,
+            limit=limit,
+            older_than=older_than,
+            newer_than=newer_than,
+        )
+
+    def latest_submissions(self, before=None):
         statement = (
-            statement
+            select(Submission)
+            .join(Question)
             .join(Assignment)
-            .join(Course)
-            .where(Course.id == self.id)
-            .order_by(Submission.timestamp.desc())
+            .where(Assignment.course_id == self.id)
         )
-        if limit is None:
-            return db.session.scalars(statement)
-        else:
-            return db.session.scalars(statement.limit(limit))
+        return _latest_submissions(statement, before=before)
 
 
 SEASONS_ORDER_BY = case(SEASONS_ORDER_MAP, value=Course.season)
@@ -333,28 +408,38 @@ SEASONS_ORDER_BY = case(SEASONS_ORDER_MAP, value=Course.season)
 
 class Assignment(db.Model):
     __tablename__ = 'assignments'
+    __table_args__ = (
+        db.Index('ix_assignments_course_id_visible_due_date', 'course_id', 'visible', 'due_date'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     course_id = db.Column(db.Integer, db.ForeignKey('courses.id'), nullable=False, index=True)
     name = db.Column(db.String, nullable=False, default='')
+    # visible, due_date, and has_undated_question are derived from the questions; see update_summary()
+    visible = db.Column(db.Boolean, nullable=False, default=False, server_default=false())
+    due_date = db.Column(db.DateTime, nullable=True)
+    has_undated_question = db.Column(db.Boolean, nullable=False, default=False, server_default=false())
     course = db.relationship('Course')
 
     def __str__(self):
         return self.name
 
-    @property
-    def visible(self):
-        return any(question.visible for question in self.questions(include_hidden=True))
+    def update_summary(self):
+        """Update the visibility and due date of the assignment.
 
-    @property
-    def due_date(self):
-        now = DateTime.now()
-        return max(
-            (
-                (question.due_date if question.due_date else now)
-                for question in self.questions()
-            ),
-            default=now,
-        )
+        An assignment is visible if any of its questions are visible. Its due
+        date is the latest due date of its visible questions, and whether any
+        visible question has no due date is kept separately, since those are
+        treated as being due now (see Course.assignments()).
+
+        This must be called whenever a question of the assignment is changed.
+        """
+        num_visible, num_dated, due_date = db.session.execute(
+            select(func.count(Question.id), func.count(Question.due_date), func.max(Question.due_date))
+            .where(Question.assignment_id == self.id, Question.visible == True)
+        ).one()
+        self.visible = (num_visible > 0)
+        self.due_date = due_date
+        self.has_undated_question = (num_dated < num_visible)
 
     def questions(self, include_hidden=False):
         statement = select(Question).where(Question.assignment_id == self.id)
@@ -367,27 +452,27 @@ class Assignment(db.Model):
         )
         return db.session.scalars(statement)
 
-    def submissions(self, user_id=None, include_hidden=False, include_disabled=False, before=None, limit=None):
-        statement = select(Submission)
-        if user_id:
-            statement = statement.where(Submission.user_id == user_id)
-        if before:
-            statement = statement.where(Submission.timestamp <= before)
-        if not include_disabled:
-            statement = statement.where(Submission.disabled == False)
-        statement = statement.join(Question)
+    def submissions(self, user_id=None, include_hidden=False, include_disabled=False, before=None, limit=None, older_than=None, newer_than=None):
+        statement = select(Question.id).where(Question.assignment_id == self.id)
         if not include_hidden:
             statement = statement.where(Question.visible == True)
+        return _question_submissions(
+            db.session.scalars(statement).all(),
+            user_id=user_id,
+            include_disabled=include_disabled,
+            before=before,
+            limit=limit,
+            older_than=older_than,
+            newer_than=newer_than,
+        )
+
+    def latest_submissions(self, before=None):
         statement = (
-            statement
-            .join(Assignment)
-            .where(Assignment.id == self.id)
-            .order_by(Submission.timestamp.desc())
+            select(Submission)
+            .join(Question)
+            .where(Question.assignment_id == self.id)
         )
-        if limit is None:
-            return db.session.scalars(statement)
-        else:
-            return db.session.scalars(statement.limit(limit))
+        return _latest_submissions(statement, before=before)
 
 
 class QuestionDependency(db.Model):
@@ -398,8 +483,8 @@ class QuestionDependency(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     producer_id = db.Column(db.Integer, db.ForeignKey('questions.id'), nullable=False, index=True)
     consumer_id = db.Column(db.Integer, db.ForeignKey('questions.id'), nullable=False, index=True)
-    input_type = db.Column(db.Enum('latest', 'all'), nullable=False, default='latest')
-    submitters = db.Column(db.Enum('instructors', 'students', 'everyone'), nullable=False, default='instructor')
+    input_type = db.Column(db.Enum('latest', 'all', name='input_type'), nullable=False, default='latest')
+    submitters = db.Column(db.Enum('instructors', 'students', 'everyone', name='submitters'), nullable=False, default='instructors')
     viewable = db.Column(db.Boolean, default=True)
 
 
@@ -418,6 +503,8 @@ class Question(db.Model):
     locked = db.Column(db.Boolean, default=False)
     allow_disable = db.Column(db.Boolean, default=False)
     hide_output = db.Column(db.Boolean, default=False)
+    # incremented by every edit, to invalidate cached fragments; see fragments.py
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     script = db.Column(db.String, nullable=False, default=dedent('''
         #!/bin/bash
 
@@ -506,10 +593,20 @@ class Question(db.Model):
             if dependency.input_type == 'all':
                 pass # no need to filter if all submissions are used
             elif dependency.input_type == 'latest':
-                statement = (
+                # keep only the latest submission of each user
+                ranked = (
                     statement
-                    .group_by(User.id)
-                    .order_by(func.max(Submission.timestamp).desc())
+                    .add_columns(func.row_number().over(
+                        partition_by=Submission.user_id,
+                        order_by=(Submission.timestamp.desc(), Submission.id.desc()),
+                    ).label('rank'))
+                    .subquery()
+                )
+                latest = aliased(Submission, ranked)
+                statement = (
+                    select(latest)
+                    .where(ranked.c.rank == 1)
+                    .order_by(latest.timestamp.desc())
                 )
             else:
                 assert False
@@ -530,7 +627,7 @@ class Question(db.Model):
             .order_by(Submission.timestamp.desc())
         )
 
-    def submissions(self, user_id=None, include_hidden=False, include_disabled=False, before=None, limit=None):
+    def submissions(self, user_id=None, include_hidden=False, include_disabled=False, before=None, limit=None, older_than=None, newer_than=None):
         statement = select(Submission).where(Submission.question_id == self.id)
         if user_id:
             statement = statement.where(Submission.user_id == user_id)
@@ -538,18 +635,19 @@ class Question(db.Model):
             statement = statement.where(Submission.timestamp <= before)
         if not include_disabled:
             statement = statement.where(Submission.disabled == False)
-        if not include_hidden:
-            statement = (
-                statement
-                .join(Question)
-                .where(Question.visible == True)
-            )
-        statement = statement.order_by(Submission.timestamp.desc())
+        if not include_hidden and not self.visible:
+            # the question is already loaded, so there is no need to join it
+            statement = statement.where(false())
+        statement = _order_submissions(statement, older_than, newer_than)
         if limit is None:
             return db.session.scalars(statement)
         else:
             return db.session.scalars(statement.limit(limit))
 
+    def latest_submissions(self, before=None):
+        statement = select(Submission).where(Submission.question_id == self.id)
+        return _latest_submissions(statement, before=before)
+
 
 class QuestionFile(db.Model):
     __tablename__ = 'question_files'
@@ -567,20 +665,40 @@ class Submission(db.Model):
         db.Index('ix_submissions_user_id_question_id_timestamp', 'user_id', 'question_id', 'timestamp'),
         # for user submissions page, group by the user_id
         db.Index('ix_submissions_user_id_timestamp', 'user_id', 'timestamp'),
-        # for course/assignment/question-level submissions page (which will ignore the user_id)
-        # and for evaluation (which uses the user_id)
+        # for evaluation and the latest submissions of each user
         db.Index('ix_submissions_question_id_disabled_user_id_timestamp', 'question_id', 'disabled', 'user_id', 'timestamp'),
+        # for course/assignment/question-level submissions pages, in page order; see _question_submissions()
+        db.Index('ix_submissions_question_id_timestamp_id', 'question_id', 'timestamp', 'id'),
     )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
     question_id = db.Column(db.Integer, db.ForeignKey('questions.id'), nullable=False, index=True)
     timestamp = db.Column(db.DateTime, nullable=False, default=(lambda: DateTime.now()))
     disabled = db.Column(db.Boolean, nullable=False, default=False)
+    # incremented whenever the submission or its results change, to
+    # invalidate cached fragments; see fragments.py
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     files = db.relationship('SubmissionFile', backref='submission')
     results = db.relationship('Result', backref='submission')
     user = db.relationship('User')
     question = db.relationship('Question', backref='all_submissions')
 
+    @staticmethod
+    def site_submissions(limit=None, older_than=None, newer_than=None):
+        statement = _order_submissions(select(Submission), older_than, newer_than)
+        if limit is None:
+            return db.session.scalars(statement)
+        else:
+            return db.session.scalars(statement.limit(limit))
+
+    @staticmethod
+    def increment_version(submission_id):
+        db.session.execute(
+            update(Submission)
+            .where(Submission.id == submission_id)
+            .values(version=(Submission.version + 1))
+        )
+
     @property
     def num_results(self):
         return db.session.scalar(
@@ -630,6 +748,206 @@ class Submission(db.Model):
         return self.question.course
 
 
+def _order_submissions(statement, older_than=None, newer_than=None):
+    """Order submissions from newest to oldest.
+
+    Submissions are ordered by (timestamp, id), so that submissions with the
+    same timestamp still have a stable order for keyset pagination.
+
+    Parameters:
+        statement (Select): The statement that selects submissions.
+        older_than (Tuple[DateTime, int]): If given, only select submissions
+            before this (timestamp, id) cursor.
+        newer_than (Tuple[DateTime, int]): If given, only select submissions
+            after this (timestamp, id) cursor. Because the limit must apply to
+            the submissions closest to the cursor, these are ordered from
+            oldest to newest instead.
+    """
+    if older_than:
+        timestamp, submission_id = older_than
+        # the first condition alone can use the timestamp indexes
+        return (
+            statement
+            .where(Submission.timestamp <= timestamp)
+            .where(or_(Submission.timestamp < timestamp, Submission.id < submission_id))
+            .order_by(Submission.timestamp.desc(), Submission.id.desc())
+        )
+    elif newer_than:
+        timestamp, submission_id = newer_than
+        return (
+            statement
+            .where(Submission.timestamp >= timestamp)
+            .where(or_(Submission.timestamp > timestamp, Submission.id > submission_id))
+            .order_by(Submission.timestamp.asc(), Submission.id.asc())
+        )
+    else:
+        return statement.order_by(Submission.timestamp.desc(), Submission.id.desc())
+
+
+def _question_submissions(question_ids, user_id=None, include_disabled=False, before=None, limit=None, older_than=None, newer_than=None):
+    """Select the submissions to several questions, from newest to oldest.
+
+    The submissions of each question are selected separately, in (timestamp,
+    id) order from the index on (question_id, timestamp, id), and only the
+    first few of each question are merged and sorted. A page therefore costs
+    the same no matter how many submissions the questions have, instead of
+    sorting all of them.
+
+    Since SQLite limits the number of parts of a compound select (to 500 by
+    default), the submissions of more than MAX_MERGED_QUESTIONS questions are
+    instead selected and sorted together.
+
+    Parameters:
+        question_ids (List[int]): The IDs of the questions.
+        user_id (int): If given, only select submissions by this user.
+        include_disabled (bool): Whether to include disabled submissions.
+        before (DateTime): If given, only select submissions at or before
+            this time.
+        limit (int): The maximum number of submissions, or None for all.
+        older_than (Tuple[DateTime, int]): See _order_submissions().
+        newer_than (Tuple[DateTime, int]): See _order_submissions().
+
+    Returns:
+        ScalarResult: The submissions.
+    """
+    if not question_ids:
+        return db.session.scalars(select(Submission).where(false()))
+
+    def filtered(statement):
+        if user_id:
+            statement = statement.where(Submission.user_id == user_id)
+        if before:
+            statement = statement.where(Submission.timestamp <= before)
+        if not include_disabled:
+            statement = statement.where(Submission.disabled == False)
+        statement = _order_submissions(statement, older_than, newer_than)
+        if limit is not None:
+            statement = statement.limit(limit)
+        return statement
+
+    if len(question_ids) > MAX_MERGED_QUESTIONS:
+        return db.session.scalars(filtered(select(Submission).where(Submission.question_id.in_(question_ids))))
+    per_question = []
+    for question_id in question_ids:
+        statement = filtered(select(Submission.id).where(Submission.question_id == question_id))
+        # wrapped, since compound selects cannot order or limit their parts
+        per_question.append(select(statement.subquery().c.id))
+    merged = union_all(*per_question).subquery()
+    statement = select(Submission).join(merged, Submission.id == merged.c.id)
+    if newer_than:
+        statement = statement.order_by(Submission.timestamp.asc(), Submission.id.asc())
+    else:
+        statement = statement.order_by(Submission.timestamp.desc(), Submission.id.desc())
+    if limit is None:
+        return db.session.scalars(statement)
+    else:
+        return db.session.scalars(statement.limit(limit))
+
+
+def _latest_submissions(statement, before=None):
+    """Get the latest enabled submission of each user to each question.
+
+    Parameters:
+        statement (Select): The statement that selects submissions.
+        before (DateTime): If given, ignore submissions after this time.
+
+    Returns:
+        ScalarResult[Submission]: The submissions, ordered by question and
+            user, with their files, users, and questions loaded.
+    """
+    if before:
+        statement = statement.where(Submission.timestamp <= before)
+    ranked = (
+        statement
+        .where(Submission.disabled == False)
+        .add_columns(func.row_number().over(
+            partition_by=(Submission.user_id, Submission.question_id),
+            order_by=(Submission.timestamp.desc(), Submission.id.desc()),
+        ).label('rank'))
+        .subquery()
+    )
+    latest = aliased(Submission, ranked)
+    return db.session.scalars(
+        select(latest)
+        .where(ranked.c.rank == 1)
+        .order_by(latest.question_id, latest.user_id)
+        .options(
+            selectinload(latest.files).selectinload(SubmissionFile.question_file),
+            selectinload(latest.user),
+            selectinload(latest.question).selectinload(Question.assignment),
+        )
+    )
+
+
+class SubmissionPage:
+    """A page of submissions, from newest to oldest.
+
+    Pages are identified by the (timestamp, id) cursor of the submission just
+    outside of them instead of by an offset, so every page is a single index
+    range scan, no matter how far into the listing it is.
+    """
+
+    def __init__(self, submissions, size, older_than=None, newer_than=None, **kwargs):
+        """Initialize the SubmissionPage.
+
+        Parameters:
+            submissions (Callable): The submissions() method of a model.
+            size (int): The maximum number of submissions on the page.
+            older_than (Tuple[DateTime, int]): The cursor of the submission
+                just newer than this page.
+            newer_than (Tuple[DateTime, int]): The cursor of the submission
+                just older than this page.
+            **kwargs: Other arguments to the submissions() method.
+        """
+        # get one more submission than needed to know if there is another page
+        if newer_than:
+            submissions = list(submissions(newer_than=newer_than, limit=size + 1, **kwargs))
+            self.has_newer = (len(submissions) > size)
+            self.has_older = True
+            self.submissions = list(reversed(submissions[:size]))
+        else:
+            submissions = list(submissions(older_than=older_than, limit=size + 1, **kwargs))
+            self.has_newer = (older_than is not None)
+            self.has_older = (len(submissions) > size)
+            self.submissions = submissions[:size]
+
+    def __iter__(self):
+        return iter(self.submissions)
+
+    def __bool__(self):
+        return bool(self.submissions)
+
+    @property
+    def newer_cursor(self):
+        if self.has_newer and self.submissions:
+            return SubmissionPage.format_cursor(self.submissions[0])
+        return None
+
+    @property
+    def older_cursor(self):
+        if self.has_older and self.submissions:
+            return SubmissionPage.format_cursor(self.submissions[-1])
+        return None
+
+    @staticmethod
+    def format_cursor(submission):
+        return f'{submission.timestamp.isoformat()}_{submission.id}'
+
+    @staticmethod
+    def parse_cursor(cursor):
+        """Parse a cursor from a URL.
+
+        Returns:
+            Tuple[DateTime, int]: The timestamp and ID of the cursor, or None
+                if the cursor is missing or malformed.
+        """
+        try:
+            timestamp, submission_id = cursor.rsplit('_', maxsplit=1)
+            return DateTime.fromisoformat(timestamp), int(submission_id)
+        except (AttributeError, ValueError):
+            return None
+
+
 class SubmissionFile(db.Model):
     __tablename__ = 'submission_files'
     id = db.Column(db.Integer, primary_key=True)
@@ -637,6 +955,9 @@ class SubmissionFile(db.Model):
     question_file_id = db.Column(db.Integer, db.ForeignKey('question_files.id'), nullable=False)
     question_file = db.relationship('QuestionFile')
     filename = db.Column(db.String, nullable=False)
+    # SHA-256 of the contents; see storage.py
+    digest = db.Column(db.String(64), nullable=True, index=True)
+    size = db.Column(db.Integer, nullable=True)
 
     @property
     def submitter(self):
@@ -656,31 +977,126 @@ class SubmissionFile(db.Model):
 
     @property
     def filepath(self):
+        if self.digest:
+            return object_path(self.digest)
+        return self.legacy_filepath
+
+    @property
+    def legacy_filepath(self):
+        """The path of files uploaded before the content-addressed store."""
         suffix = f'{self.course.id}/{self.assignment.id}/{self.submission.id}/{self.filename}'
         return current_app.config['SUBMISSION_PATH'].joinpath(suffix)
 
+    @staticmethod
+    def reference_counts():
+        """Count the submission files that refer to each stored object.
+
+        Returns:
+            Dict[str, int]: The number of submission files for each digest.
+        """
+        return dict(db.session.execute(
+            select(SubmissionFile.digest, func.count())
+            .where(SubmissionFile.digest.is_not(None))
+            .group_by(SubmissionFile.digest)
+        ).all())
+
+
+class Blob(db.Model):
+    """Compressed text, deduplicated by its SHA-256 digest.
+
+    Blobs are immutable and shared; use Blob.store() to get one for a text.
+    """
+    __tablename__ = 'blobs'
+    id = db.Column(db.Integer, primary_key=True)
+    digest = db.Column(db.String(64), nullable=False, unique=True)
+    compression = db.Column(db.Enum('none', 'zlib', name='compression'), nullable=False, default='none')
+    size = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
     @property
-    def contents(self):
-        with self.filepath.open() as fd:
-            return fd.read()
+    def text(self):
+        if self.compression == 'zlib':
+            return zlib.decompress(self.data).decode('utf-8')
+        else:
+            return self.data.decode('utf-8')
+
+    @staticmethod
+    def store(text):
+        """Get the blob for a text, creating it if necessary.
+
+        Parameters:
+            text (str): The text to store.
+
+        Returns:
+            Blob: The blob, or None if the text is None.
+        """
+        if text is None:
+            return None
+        data = text.encode('utf-8')
+        digest = sha256(data).hexdigest()
+        blob = db.session.scalar(select(Blob).where(Blob.digest == digest))
+        if blob:
+            return blob
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            blob = Blob(digest=digest, compression='zlib', size=len(data), data=compressed)
+        else:
+            blob = Blob(digest=digest, compression='none', size=len(data), data=data)
+        db.session.add(blob)
+        return blob
 
 
 class Result(db.Model):
     __tablename__ = 'results'
     __table_args__ = (
         db.Index('ix_results_submission_id_return_code', 'submission_id', 'return_code'),
+        # for the queue position of pending results; see api.queue_position()
+        db.Index('ix_results_return_code_queued_at', 'return_code', 'queued_at'),
     )
     id = db.Column(db.Integer, primary_key=True)
     submission_id = db.Column(db.Integer, db.ForeignKey('submissions.id'), nullable=False, index=True)
-    stdout = db.Column(db.String, nullable=True)
-    stderr = db.Column(db.String, nullable=True)
+    stdout_id = db.Column(db.Integer, db.ForeignKey('blobs.id'), nullable=True)
+    stderr_id = db.Column(db.Integer, db.ForeignKey('blobs.id'), nullable=True)
+    # output from before the blob store; see migrations.migrate_result_outputs()
+    inline_stdout = db.deferred(db.Column('stdout', db.String, nullable=True))
+    inline_stderr = db.deferred(db.Column('stderr', db.String, nullable=True))
     return_code = db.Column(db.Integer, nullable=True)
+    # when the evaluation was requested, when the script started, and when
+    # the output was saved; see latency.py
+    queued_at = db.Column(db.DateTime, nullable=True, index=True)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    # the blobs are only loaded when the output is actually used
+    stdout_blob = db.relationship('Blob', foreign_keys=stdout_id)
+    stderr_blob = db.relationship('Blob', foreign_keys=stderr_id)
     upstream_submissions = db.relationship(
         'Submission',
         secondary='result_dependencies',
         backref='result',
     )
 
+    @property
+    def stdout(self):
+        if self.stdout_blob:
+            return self.stdout_blob.text
+        return self.inline_stdout
+
+    @stdout.setter
+    def stdout(self, text):
+        self.stdout_blob = Blob.store(text)
+        self.inline_stdout = None
+
+    @property
+    def stderr(self):
+        if self.stderr_blob:
+            return self.stderr_blob.text
+        return self.inline_stderr
+
+    @stderr.setter
+    def stderr(self, text):
+        self.stderr_blob = Blob.store(text)
+        self.inline_stderr = None
+
     @property
     def submitter(self):
         return self.submission.user
@@ -692,6 +1108,29 @@ class Result(db.Model):
             result.extend(submission.files)
         return result
 
+    @property
+    def dependent_file_grants(self):
+        """Get the upstream files of this result, and whether they are viewable.
+
+        Returns:
+            List[Tuple[SubmissionFile, bool]]: The upstream files, and
+                whether the submitter of this result may view them.
+        """
+        return db.session.execute(
+            select(SubmissionFile, FileGrant.id.is_not(None))
+            .join(ResultDependency, ResultDependency.submission_id == SubmissionFile.submission_id)
+            .outerjoin(FileGrant, and_(
+                FileGrant.result_id == ResultDependency.result_id,
+                FileGrant.submission_file_id == SubmissionFile.id,
+            ))
+            .where(ResultDependency.result_id == self.id)
+            .order_by(SubmissionFile.id)
+            .options(
+                selectinload(SubmissionFile.question_file),
+                selectinload(SubmissionFile.submission).selectinload(Submission.user),
+            )
+        ).all()
+
     def question_dependency(self, question_id):
         return db.session.scalar(
             select(QuestionDependency)
@@ -734,3 +1173,64 @@ class ResultDependency(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     result_id = db.Column(db.Integer, db.ForeignKey('results.id'), nullable=False, index=True)
     submission_id = db.Column(db.Integer, db.ForeignKey('submissions.id'), nullable=False)
+
+
+class FileGrant(db.Model):
+    """A user's permission to view an upstream file used in one of their results.
+
+    Grants are derived from ResultDependency and QuestionDependency.viewable,
+    so that file permissions can be checked with a single indexed lookup.
+    They must be refreshed whenever either of those changes.
+    """
+    __tablename__ = 'file_grants'
+    __table_args__ = (
+        db.Index('ix_file_grants_user_id_submission_file_id', 'user_id', 'submission_file_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    submission_file_id = db.Column(db.Integer, db.ForeignKey('submission_files.id'), nullable=False)
+    result_id = db.Column(db.Integer, db.ForeignKey('results.id'), nullable=False, index=True)
+
+    @staticmethod
+    def refresh(result_ids):
+        """Recompute the grants for some results.
+
+        Parameters:
+            result_ids (Union[List[int], Select]): The IDs of the results, or
+                a statement that selects them.
+        """
+        db.session.execute(delete(FileGrant).where(FileGrant.result_id.in_(result_ids)))
+        consumer = aliased(Submission)
+        producer = aliased(Submission)
+        db.session.execute(
+            insert(FileGrant).from_select(
+                ['user_id', 'submission_file_id', 'result_id'],
+                select(consumer.user_id, SubmissionFile.id, ResultDependency.result_id)
+                .select_from(ResultDependency)
+                .join(Result, ResultDependency.result_id == Result.id)
+                .join(consumer, Result.submission_id == consumer.id)
+                .join(producer, ResultDependency.submission_id == producer.id)
+                .join(QuestionDependency, and_(
+                    QuestionDependency.producer_id == producer.question_id,
+                    QuestionDependency.consumer_id == consumer.question_id,
+                ))
+                .join(SubmissionFile, SubmissionFile.submission_id == producer.id)
+                .where(
+                    QuestionDependency.viewable == True,
+                    ResultDependency.result_id.in_(result_ids),
+                )
+            )
+        )
+
+    @staticmethod
+    def refresh_question(question_id):
+        """Recompute the grants for all results of a question.
+
+        Parameters:
+            question_id (int): The ID of the (consumer) question.
+        """
+        FileGrant.refresh(
+            select(Result.id)
+            .join(Submission)
+            .where(Submission.question_id == question_id)
+        )
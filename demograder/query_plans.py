@@ -0,0 +1,501 @@
+"""Checks of the query plans of the hot model queries.
+
+Each check calls model methods on a generated dataset (see synthetic.py),
+records the SQL statements they run, and explains each one with the
+database (EXPLAIN QUERY PLAN on SQLite, EXPLAIN on PostgreSQL). A check
+fails if a plan scans a large table without an index, sorts rows of a large
+table that an index did not already put in order (other than rows looked up
+by primary key from an already bounded set), or if an index the query was
+written for does not appear in any plan.
+
+The index advisor summarizes the plans of all checks: the columns that
+fully scanned tables were filtered on, sorts that could not use an index,
+and declared indexes that no check used.
+"""
+
+import re
+from collections import Counter, defaultdict, namedtuple
+from contextlib import contextmanager
+
+from sqlalchemy import event, inspect, select
+
+from .api import queue_position
+from .benchmarks import BenchmarkError, benchmark_objects
+from .models import db, User, Course, Assignment, Question, Submission, SubmissionFile, Blob, Result, FileGrant
+from .models import ResultDependency, SubmissionPage, course_memberships
+
+# tables that grow with the number of submissions, which must not be scanned
+LARGE_TABLES = {'submissions', 'submission_files', 'results', 'result_dependencies', 'file_grants', 'blobs'}
+
+# a query to check, with a function that runs it given the objects from
+# plan_objects(), the indexes it should use, and the large tables it may scan
+# and sort without an index
+QueryCheck = namedtuple('QueryCheck', 'name, run, indexes, allowed_scans, allowed_sorts', defaults=((), (), ()))
+
+# a step of a plan: the table (or alias) it reads, whether it reads all rows,
+# the index it uses, and the original line
+PlanStep = namedtuple('PlanStep', 'table, full_scan, index, detail')
+
+# eg. "SCAN submissions", "SEARCH results USING INDEX ix_results_submission_id_return_code (submission_id=?)"
+SQLITE_STEP_REGEX = re.compile(
+    r'(?P<operation>SCAN|SEARCH) (?P<table>\w+)(?: AS (?P<alias>\w+))?'
+    r'(?: USING (?:COVERING )?INDEX (?P<index>\w+)| USING (?:INTEGER )?PRIMARY KEY)?'
+)
+# eg. "Seq Scan on submissions", "Index Scan Backward using ix_submissions_timestamp on submissions submissions_1"
+POSTGRES_STEP_REGEX = re.compile(
+    r'(?P<operation>Seq Scan|(?:Parallel )?(?:Index|Index Only|Bitmap Heap) Scan)'
+    r'(?: Backward)?(?: using (?P<index>\w+))? on (?P<table>\w+)'
+)
+# eg. "->  Sort  (cost=...)", but not "Sort Key: ..."
+POSTGRES_SORT_REGEX = re.compile(r'^(?:->\s+)?Sort\s+\(')
+# eg. "submissions.question_id = ?", for the advisor
+PREDICATE_REGEX = re.compile(r'(\w+)\.(\w+) (?:=|<=|>=|<|>|IN|IS) ')
+
+
+def plan_objects():
+    """Pick the objects to run the queries with.
+
+    These are the objects of benchmark_objects(), plus a result and a
+    submission file of the student, and a file that result depends on.
+
+    Returns:
+        Dict[str, Any]: The IDs and emails of the objects, by name.
+    """
+    objects = benchmark_objects()
+    objects['result'] = db.session.scalar(
+        select(Result.id)
+        .where(Result.submission_id == objects['submission'])
+        .order_by(Result.id)
+    )
+    objects['submission_file'] = db.session.scalar(
+        select(SubmissionFile.id)
+        .where(SubmissionFile.submission_id == objects['submission'])
+        .order_by(SubmissionFile.id)
+    )
+    # a file the student may only see through a grant
+    objects['upstream_file'] = db.session.scalar(
+        select(SubmissionFile.id)
+        .join(ResultDependency, ResultDependency.submission_id == SubmissionFile.submission_id)
+        .where(ResultDependency.result_id == objects['result'])
+        .order_by(SubmissionFile.id)
+    )
+    objects['student'] = db.session.scalar(select(User.id).where(User.email == objects['student_email']))
+    objects['instructor'] = db.session.scalar(select(User.id).where(User.email == objects['viewers']['instructor']))
+    if None in objects.values():
+        raise BenchmarkError('the dataset has no results; generate one with the generate-data command')
+    return objects
+
+
+# the arguments the instructor listings of submissions use
+ROUTE_FLAGS = {'include_hidden': True, 'include_disabled': True}
+
+
+def _cursor(objects):
+    submission = db.session.get(Submission, objects['submission'])
+    return (submission.timestamp, submission.id)
+
+
+def _instructor(objects):
+    return db.session.get(User, objects['instructor'])
+
+
+def _student(objects):
+    return db.session.get(User, objects['student'])
+
+
+def _course(objects):
+    return db.session.get(Course, objects['course'])
+
+
+def _assignment(objects):
+    return db.session.get(Assignment, objects['assignment'])
+
+
+def _question(objects):
+    return db.session.get(Question, objects['question'])
+
+
+CHECKS = [
+    QueryCheck(
+        'User.get_by_email',
+        lambda objects: User.get_by_email(objects['student_email']),
+        indexes=['ix_users_email'],
+    ),
+    QueryCheck(
+        'course_memberships',
+        lambda objects: course_memberships(objects['student']),
+        # the unique constraints on (user_id, course_id) also serve this
+        indexes=[
+            'ix_instructors_user_id', 'ix_students_user_id',
+            'sqlite_autoindex_instructors_1', 'sqlite_autoindex_students_1',
+            'instructors_user_id_course_id_key', 'students_user_id_course_id_key',
+        ],
+    ),
+    QueryCheck('User.courses', lambda objects: list(_student(objects).courses())),
+    QueryCheck(
+        'User.submissions',
+        lambda objects: list(_student(objects).submissions(limit=100)),
+        indexes=['ix_submissions_user_id_timestamp'],
+    ),
+    QueryCheck(
+        'User.submissions (page)',
+        lambda objects: list(SubmissionPage(_student(objects).submissions, 100, older_than=_cursor(objects))),
+        indexes=['ix_submissions_user_id_timestamp'],
+    ),
+    QueryCheck(
+        'User.submissions_from_students',
+        lambda objects: list(_instructor(objects).submissions_from_students(limit=100)),
+        indexes=['ix_submissions_question_id_timestamp_id'],
+    ),
+    QueryCheck(
+        'User.may_view_file',
+        lambda objects: _student(objects).may_view_file(objects['upstream_file']),
+        indexes=['ix_file_grants_user_id_submission_file_id'],
+    ),
+    QueryCheck(
+        'Course.assignments',
+        lambda objects: list(_course(objects).assignments()),
+        indexes=['ix_assignments_course_id_visible_due_date'],
+    ),
+    QueryCheck(
+        'Course.submissions',
+        lambda objects: list(_course(objects).submissions(limit=100)),
+        indexes=['ix_submissions_question_id_timestamp_id'],
+    ),
+    # as course_submissions_view lists them
+    QueryCheck(
+        'Course.submissions (route)',
+        lambda objects: list(SubmissionPage(_course(objects).submissions, 100, **ROUTE_FLAGS)),
+        indexes=['ix_submissions_question_id_timestamp_id'],
+    ),
+    QueryCheck(
+        'Course.submissions (route, older page)',
+        lambda objects: list(SubmissionPage(_course(objects).submissions, 100, older_than=_cursor(objects), **ROUTE_FLAGS)),
+        indexes=['ix_submissions_question_id_timestamp_id'],
+    ),
+    QueryCheck(
+        'Course.submissions (route, newer page)',
+        lambda objects: list(SubmissionPage(_course(objects).submissions, 100, newer_than=_cursor(objects), **ROUTE_FLAGS)),
+        indexes=['ix_submissions_question_id_timestamp_id'],
+    ),
+    QueryCheck(
+        'Course.latest_submissions',
+        lambda objects: list(_course(objects).latest_submissions()),
+        indexes=['ix_submissions_question_id_disabled_user_id_timestamp'],
+        # this ranks every submission to the course, to report on all of them
+        allowed_sorts=['submissions'],
+    ),
+    QueryCheck(
+        'Assignment.questions',
+        lambda objects: list(_assignment(objects).questions()),
+        indexes=['ix_questions_assignment_id_due_date_visible'],
+    ),
+    QueryCheck(
+        'Assignment.update_summary',
+        lambda objects: _assignment(objects).update_summary(),
+        indexes=['ix_questions_assignment_id_due_date_visible'],
+    ),
+    QueryCheck(
+        'Assignment.submissions',
+        lambda objects: list(_assignment(objects).submissions(limit=100)),
+        indexes=['ix_submissions_question_id_timestamp_id'],
+    ),
+    # as assignment_submissions_view lists them
+    QueryCheck(
+        'Assignment.submissions (route)',
+        lambda objects: list(SubmissionPage(_assignment(objects).submissions, 100, **ROUTE_FLAGS)),
+        indexes=['ix_submissions_question_id_timestamp_id'],
+    ),
+    QueryCheck(
+        'Assignment.submissions (route, older page)',
+        lambda objects: list(SubmissionPage(_assignment(objects).submissions, 100, older_than=_cursor(objects), **ROUTE_FLAGS)),
+        indexes=['ix_submissions_question_id_timestamp_id'],
+    ),
+    QueryCheck(
+        'Assignment.latest_submissions',
+        lambda objects: list(_assignment(objects).latest_submissions()),
+        indexes=['ix_submissions_question_id_disabled_user_id_timestamp'],
+        # this ranks every submission to the assignment, to report on all of them
+        allowed_sorts=['submissions'],
+    ),
+    QueryCheck(
+        'Question.upstream_submission_id_sets',
+        lambda objects: _question(objects).upstream_submission_id_sets,
+        indexes=['ix_submissions_question_id_disabled_user_id_timestamp'],
+    ),
+    QueryCheck(
+        'Question.most_recent_submission',
+        lambda objects: _question(objects).most_recent_submission(objects['student']),
+        indexes=['ix_submissions_user_id_question_id_timestamp'],
+    ),
+    QueryCheck(
+        'Question.submissions',
+        lambda objects: list(_question(objects).submissions(limit=100)),
+        indexes=['ix_submissions_question_id_timestamp_id'],
+    ),
+    # as question_submissions_view lists them
+    QueryCheck(
+        'Question.submissions (route)',
+        lambda objects: list(SubmissionPage(_question(objects).submissions, 100, **ROUTE_FLAGS)),
+        indexes=['ix_submissions_question_id_timestamp_id'],
+    ),
+    QueryCheck(
+        'Question.submissions (route, older page)',
+        lambda objects: list(SubmissionPage(_question(objects).submissions, 100, older_than=_cursor(objects), **ROUTE_FLAGS)),
+        indexes=['ix_submissions_question_id_timestamp_id'],
+    ),
+    QueryCheck(
+        'Question.submissions (user)',
+        lambda objects: list(_question(objects).submissions(user_id=objects['student'], limit=1)),
+    ),
+    QueryCheck(
+        'Question.latest_submissions',
+        lambda objects: list(_question(objects).latest_submissions()),
+        indexes=['ix_submissions_question_id_disabled_user_id_timestamp'],
+        # this ranks every submission to the question, to report on all of them
+        allowed_sorts=['submissions'],
+    ),
+    QueryCheck(
+        'Submission.site_submissions',
+        lambda objects: list(Submission.site_submissions(limit=100)),
+        indexes=['ix_submissions_timestamp'],
+    ),
+    QueryCheck(
+        'Submission.site_submissions (page)',
+        lambda objects: list(SubmissionPage(Submission.site_submissions, 100, older_than=_cursor(objects))),
+        indexes=['ix_submissions_timestamp'],
+    ),
+    QueryCheck(
+        'Submission.num_passed',
+        lambda objects: db.session.get(Submission, objects['submission']).num_passed,
+        indexes=['ix_results_submission_id_return_code'],
+    ),
+    QueryCheck(
+        'Submission.num_tbd',
+        lambda objects: db.session.get(Submission, objects['submission']).num_tbd,
+        indexes=['ix_results_submission_id_return_code'],
+    ),
+    QueryCheck(
+        'api.queue_position',
+        lambda objects: queue_position(objects['submission']),
+        indexes=['ix_results_return_code_queued_at'],
+    ),
+    QueryCheck(
+        'SubmissionFile.reference_counts',
+        lambda objects: SubmissionFile.reference_counts(),
+        # this counts every file, so it reads the whole (covering) index
+        allowed_scans=['submission_files'],
+    ),
+    QueryCheck(
+        'Blob.store',
+        lambda objects: Blob.store(''),
+        indexes=['sqlite_autoindex_blobs_1', 'blobs_digest_key'],
+    ),
+    QueryCheck(
+        'Result.dependent_file_grants',
+        lambda objects: db.session.get(Result, objects['result']).dependent_file_grants,
+        indexes=[
+            'ix_result_dependencies_result_id',
+            'sqlite_autoindex_result_dependencies_1', 'result_dependencies_result_id_submission_id_key',
+        ],
+        # only the files that one result depends on are sorted
+        allowed_sorts=['result_dependencies', 'submission_files', 'file_grants'],
+    ),
+    QueryCheck(
+        'FileGrant.refresh',
+        lambda objects: FileGrant.refresh([objects['result']]),
+        indexes=['ix_file_grants_result_id'],
+    ),
+]
+
+
+@contextmanager
+def recorded_statements():
+    """Record the statements run on the primary database.
+
+    Yields:
+        List[Tuple[str, Any]]: The statements and their parameters, as they
+            are run.
+    """
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')):
+            statements.append((statement, parameters))
+
+    engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+
+def explain(statement, parameters):
+    """Get the plan of a statement.
+
+    Parameters:
+        statement (str): The SQL statement, as run by the DBAPI.
+        parameters (Any): The parameters of the statement.
+
+    Returns:
+        List[PlanStep]: The steps of the plan that read tables.
+        List[str]: The plan, one line per step.
+        List[PlanStep]: The steps of large tables whose rows are sorted
+            without an index.
+    """
+    connection = db.session.connection()
+    if connection.dialect.name == 'sqlite':
+        rows = list(connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters))
+        lines = [row.detail for row in rows]
+        steps = [_plan_step(SQLITE_STEP_REGEX, line) for line in lines]
+        sorts = _sqlite_sorts(rows, steps)
+    else:
+        lines = [row[0] for row in connection.exec_driver_sql('EXPLAIN ' + statement, parameters)]
+        steps = [_plan_step(POSTGRES_STEP_REGEX, line) for line in lines]
+        sorts = _postgres_sorts(lines, steps)
+    return [step for step in steps if step], lines, sorts
+
+
+def _plan_step(regex, line):
+    match = regex.search(line)
+    if not match:
+        return None
+    table = match.group('table')
+    # aliased tables (eg. submissions_1) are shown by their alias in SQLite
+    if table not in db.metadata.tables:
+        table = re.sub(r'_[0-9]+$', '', table)
+    return PlanStep(
+        table,
+        match.group('operation') in ('SCAN', 'Seq Scan') and not match.group('index'),
+        match.group('index'),
+        line.strip(),
+    )
+
+
+def _sqlite_sorts(rows, steps):
+    # a TEMP B-TREE sorts the rows of the loops beside it (with the same
+    # parent); rows looked up by primary key are bounded by the other loops
+    sorts = []
+    for row in rows:
+        if 'TEMP B-TREE' not in row.detail:
+            continue
+        for sibling, step in zip(rows, steps):
+            if sibling.parent != row.parent or not step or step.table not in LARGE_TABLES:
+                continue
+            if 'PRIMARY KEY' not in step.detail:
+                sorts.append(step)
+    return sorts
+
+
+def _postgres_sorts(lines, steps):
+    # a Sort sorts the rows of the nodes below it, unless a Limit between
+    # them bounds the rows; rows looked up by primary key are bounded by
+    # the other nodes
+    sorts = []
+    for sort_index, line in enumerate(lines):
+        if not POSTGRES_SORT_REGEX.match(line.strip()):
+            continue
+        sort_indent = _postgres_indent(line)
+        # the Limit nodes between the sort and the current node, by indent
+        limits = []
+        for line, step in zip(lines[sort_index + 1:], steps[sort_index + 1:]):
+            if '->' not in line:
+                # a property of the node above, eg. "Sort Key: ..."
+                continue
+            indent = _postgres_indent(line)
+            if indent <= sort_indent:
+                break
+            limits = [limit_indent for limit_indent in limits if limit_indent < indent]
+            if line.strip().startswith('->  Limit'):
+                limits.append(indent)
+            elif step and step.table in LARGE_TABLES and not limits and not (step.index or '').endswith('_pkey'):
+                sorts.append(step)
+    return sorts
+
+
+def _postgres_indent(line):
+    if '->' in line:
+        return line.index('->')
+    return len(line) - len(line.lstrip())
+
+
+def check_query_plans(checks=None):
+    """Run the checks and explain their statements.
+
+    Everything the checks change is rolled back.
+
+    Parameters:
+        checks (List[QueryCheck]): The checks to run. Defaults to CHECKS.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: For each check, its statements with their
+            plans, and its problems.
+    """
+    if checks is None:
+        checks = CHECKS
+    objects = plan_objects()
+    report = {}
+    try:
+        for check in checks:
+            # start from an empty identity map, so lazy loads are included
+            db.session.expunge_all()
+            with recorded_statements() as statements:
+                check.run(objects)
+            explained = []
+            problems = []
+            used_indexes = set()
+            for statement, parameters in statements:
+                steps, lines, sorts = explain(statement, parameters)
+                explained.append({'statement': statement, 'plan': lines, 'steps': steps})
+                for step in steps:
+                    if step.index:
+                        used_indexes.add(step.index)
+                    if step.full_scan and step.table in LARGE_TABLES and step.table not in check.allowed_scans:
+                        problems.append(f'full scan of {step.table}: {step.detail}')
+                for step in sorts:
+                    if step.table not in check.allowed_sorts:
+                        problems.append(f'sort of {step.table} without an index: {step.detail}')
+            if check.indexes and not used_indexes.intersection(check.indexes):
+                problems.append(f'uses none of {", ".join(check.indexes)}')
+            report[check.name] = {'statements': explained, 'problems': problems}
+    finally:
+        db.session.rollback()
+    return report
+
+
+def advise_indexes(report):
+    """Suggest index changes from the plans of the checks.
+
+    Parameters:
+        report (Dict[str, Dict[str, Any]]): The report of check_query_plans().
+
+    Returns:
+        List[str]: The advice, one line per suggestion.
+    """
+    scanned = defaultdict(Counter)
+    sorts = Counter()
+    used_indexes = set()
+    for name, check_report in report.items():
+        for explained in check_report['statements']:
+            for step in explained['steps']:
+                if step.index:
+                    used_indexes.add(step.index)
+                if step.full_scan and step.table in LARGE_TABLES:
+                    for table, column in PREDICATE_REGEX.findall(explained['statement']):
+                        if table == step.table:
+                            scanned[table][column] += 1
+            if any('TEMP B-TREE' in line or line.strip().startswith('Sort') for line in explained['plan']):
+                sorts[name] += 1
+    advice = []
+    for table, columns in sorted(scanned.items()):
+        filters = ', '.join(f'{column} ({count} statements)' for column, count in columns.most_common())
+        advice.append(f'{table} is fully scanned; consider an index on {filters or "its join columns"}')
+    for name, count in sorted(sorts.items()):
+        advice.append(f'{name} sorts in {count} statements without an index')
+    inspector = inspect(db.session.connection())
+    for table in sorted(LARGE_TABLES):
+        for index in inspector.get_indexes(table):
+            if index['name'] not in used_indexes:
+                advice.append(f'{index["name"]} on {table} was not used by any check')
+    return advice
@@ -1,17 +1,31 @@
+import hmac
+import json
 import re
-from datetime import datetime as DateTime
-from io import BytesIO
-from zipfile import ZipFile
-
-from flask import Blueprint, render_template, url_for, redirect, abort, request, send_file
-from sqlalchemy import select
+from datetime import datetime as DateTime, timedelta as TimeDelta
+from functools import partial
+from queue import Empty
+from time import monotonic
+
+from flask import Blueprint, Response, current_app, render_template, url_for, redirect, abort, request, send_file
+from flask import stream_template, stream_with_context
+from sqlalchemy import and_, select
 from werkzeug.utils import secure_filename
 
-from .context import get_context
-from .forms import UserForm, CourseForm, AssignmentForm, QuestionForm, SubmissionForm
+from .api import result_url_prefix, submission_status
+from .archives import stream_zip
+from .conditional import conditional_response, entity_tag, viewer_key
+from .context import get_context, forget_identities
+from .database import use_read_replica
+from .enrollment import parse_roster, sync_enrollment
+from .instrumentation import query_budget
+from .latency import LATENCY_GROUPS, evaluation_latencies, latency_report
+from .metrics import dashboard, format_prometheus
+from .gradebook import EXPORT_FORMATS, grade_rows, export_lines
+from .forms import UserForm, CourseForm, RosterForm, AssignmentForm, QuestionForm, SubmissionForm
 from .models import db, SiteRole, CourseRole, User, Course, Assignment, Question
-from .models import QuestionDependency, QuestionFile
-from .models import Submission, SubmissionFile
+from .models import QuestionDependency, QuestionFile, FileGrant
+from .models import Submission, SubmissionFile, SubmissionPage, Result
+from .storage import store_file
 from .dispatch import enqueue_evaluate_submission, enqueue_reevaluate_submission, enqueue_reevaluate_result
 
 blueprint = Blueprint(name='demograder', import_name='demograder')
@@ -44,7 +58,7 @@ def user_view(page_user_email):
     allowed = (
         context['user'].admin
         or context['viewer'].id == context['user'].id
-        or bool(context['viewer'].courses_with_student(page_user.id).first())
+        or context['viewer'].teaches_student(page_user.id)
     )
     if not allowed:
         abort(403)
@@ -52,6 +66,74 @@ def user_view(page_user_email):
     return render_template('user.html', **context)
 
 
+def submission_page(context, submissions, **kwargs):
+    """Add a page of submissions to the context, as selected by the URL.
+
+    Parameters:
+        context (Dict[str, Any]): The context of the request.
+        submissions (Callable): The submissions() method of a model.
+        **kwargs: Other arguments to the submissions() method.
+    """
+    url_args = request.args.to_dict()
+    page = SubmissionPage(
+        submissions,
+        current_app.config['SUBMISSIONS_PAGE_SIZE'],
+        older_than=SubmissionPage.parse_cursor(url_args.pop('older', None)),
+        newer_than=SubmissionPage.parse_cursor(url_args.pop('newer', None)),
+        **kwargs,
+    )
+    context['page'] = page
+    context['newer_url'] = None
+    context['older_url'] = None
+    if page.newer_cursor:
+        context['newer_url'] = url_for(request.endpoint, **request.view_args, **url_args, newer=page.newer_cursor)
+    if page.older_cursor:
+        context['older_url'] = url_for(request.endpoint, **request.view_args, **url_args, older=page.older_cursor)
+
+
+def stream_page(template_name, **context):
+    """Render a template while it is being sent.
+
+    The browser can start drawing the page before the rest of it is rendered,
+    and the server only holds one page of submissions (SUBMISSIONS_PAGE_SIZE)
+    and a buffer of the rendered HTML. Since the status is sent first, any
+    errors must be raised before this is called.
+
+    With SERVER_TIMING, the page is rendered before it is sent instead, since
+    the Server-Timing header can only count the queries that ran before the
+    headers are sent.
+
+    Parameters:
+        template_name (str): The name of the template.
+        **context: The variables of the template.
+
+    Returns:
+        Response: The streaming response.
+    """
+    if current_app.config['SERVER_TIMING']:
+        return Response(render_template(template_name, **context), mimetype='text/html')
+    chunks = stream_template(template_name, **context)
+    return Response(
+        _join_chunks(chunks, current_app.config['STREAM_BUFFER_BYTES']),
+        mimetype='text/html',
+    )
+
+
+def _join_chunks(chunks, min_size):
+    # Jinja yields every piece of output separately; send fewer, larger writes
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= min_size:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
 # STUDENT
 
 
@@ -86,19 +168,19 @@ def submission_view(question_id, submission_id):
     )
     db.session.add(submission)
     db.session.commit()
-    # create the associated SubmissionFiles
+    # store the files and create the associated SubmissionFiles
     for file_submission_form in form.submission_files:
-        submission_file = SubmissionFile(
+        digest, size = store_file(file_submission_form.file.data.stream)
+        db.session.add(SubmissionFile(
             submission_id=submission.id,
             question_file_id=file_submission_form.question_file_id.data,
             filename=secure_filename(file_submission_form.file.data.filename),
-        )
-        db.session.add(submission_file)
-        db.session.commit()
-        submission_file.filepath.parent.mkdir(parents=True, exist_ok=True)
-        file_submission_form.file.data.save(submission_file.filepath)
+            digest=digest,
+            size=size,
+        ))
+    db.session.commit()
     # evaluate the submission and return
-    enqueue_evaluate_submission(submission.id)
+    enqueue_evaluate_submission(submission.id, question_id=context['question'].id)
     return redirect(url_for('demograder.submission_view', submission_id=submission.id))
 
 
@@ -107,6 +189,7 @@ def disable_submission(submission_id):
     # FIXME what should happen to results that have already been computed?
     context = get_context(submission_id=submission_id)
     context['submission'].disabled = not context['submission'].disabled
+    context['submission'].version = Submission.version + 1
     db.session.add(context['submission'])
     db.session.commit()
     return redirect(url_for('demograder.submission_view', question_id=context['question'].id))
@@ -121,19 +204,94 @@ def reevaluate_submission(submission_id):
 @blueprint.route('/download_submission/<int:submission_id>')
 def download_submission(submission_id):
     context = get_context(submission_id=submission_id)
+    submission = context['submission']
     filename = f'submission{submission_id}'
-    memory_file = BytesIO()
-    with ZipFile(memory_file, 'w') as zip_file:
-        for submission_file in context['submission'].files:
-            zip_file.writestr(f'{filename}/{submission_file.filename}', submission_file.contents)
-    memory_file.seek(0)
-    return send_file(memory_file, download_name=f'{filename}.zip', as_attachment=True)
+    entries = [
+        (f'{filename}/{submission_file.filename}', submission_file.filepath)
+        for submission_file in submission.files
+    ]
+    etag = entity_tag(
+        'download_submission',
+        sorted((submission_file.filename, _file_version(submission_file)) for submission_file in submission.files),
+        'store' in request.args,
+    )
+    return conditional_response(
+        partial(zip_response, filename, entries),
+        etag,
+        last_modified=submission.timestamp,
+        immutable=True,
+    )
+
+
+@blueprint.route('/submission_events/<int:submission_id>')
+@query_budget(10)
+def submission_events(submission_id):
+    """Stream the results of a submission as Server-Sent Events.
+
+    The full scoreboard is sent when the stream opens and whenever a result
+    changes, from the events relayed by app.result_events, so the database
+    is only read once per stream. The stream closes once no results are
+    pending, or after EVENT_STREAM_SECONDS, when the browser reconnects.
+    """
+    get_context(submission_id=submission_id)
+    app = current_app._get_current_object()
+    if app.result_events.num_subscribers() >= app.config['EVENT_STREAMS_PER_PROCESS']:
+        abort(503)
+    # subscribe first, so that no event is missed while reading the results
+    queue = app.result_events.subscribe(submission_id)
+    return_codes = dict(db.session.execute(
+        select(Result.id, Result.return_code)
+        .where(Result.submission_id == submission_id)
+        .order_by(Result.id)
+    ).all())
+    result_url = result_url_prefix()
+    deadline = monotonic() + app.config['EVENT_STREAM_SECONDS']
+
+    def scoreboard_event():
+        data = json.dumps(submission_status(return_codes, result_url))
+        return f'event: scoreboard\ndata: {data}\n\n'
+
+    def stream():
+        yield 'retry: 2000\n'
+        yield scoreboard_event()
+        while not return_codes or None in return_codes.values():
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                return
+            try:
+                event = queue.get(timeout=min(timeout, 15))
+            except Empty:
+                # keep proxies from closing the connection
+                yield ': keep-alive\n\n'
+                continue
+            if event['kind'] == 'created':
+                return_codes.clear()
+            return_codes.update(event['return_codes'])
+            yield scoreboard_event()
+        yield 'event: done\ndata: {}\n\n'
+
+    response = Response(stream(), mimetype='text/event-stream')
+    response.call_on_close(partial(app.result_events.unsubscribe, submission_id, queue))
+    response.headers['Cache-Control'] = 'no-cache'
+    # stop nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @blueprint.route('/result/<int:result_id>')
 def result_view(result_id):
     context = get_context(result_id=result_id)
-    return render_template('student/result.html', **context)
+    result = context['result']
+    # evaluating the result again resets both times
+    etag = entity_tag(
+        'result_view', result.id, result.queued_at, result.finished_at,
+        context['question'].hide_output, viewer_key(context),
+    )
+    return conditional_response(
+        partial(render_template, 'student/result.html', **context),
+        etag,
+        last_modified=(result.finished_at or result.queued_at),
+    )
 
 
 @blueprint.route('/reevaluate_result/<int:result_id>')
@@ -144,13 +302,65 @@ def reevaluate_result(result_id):
 
 @blueprint.route('/download_result/<int:result_id>')
 def download_result(result_id):
-    return f'{result_id=}' # TODO
+    context = get_context(result_id=result_id)
+    result = context['result']
+    filename = f'result{result_id}'
+    entries = [
+        (f'{filename}/{submission_file.question_file.filename}', submission_file.filepath)
+        for submission_file in result.submission.files
+    ]
+    # include the upstream files that the result page would show
+    if context['instructor'] or not context['question'].hide_output:
+        for submission_file, viewable in result.dependent_file_grants:
+            if context['instructor'] or viewable:
+                name = f'{filename}/upstream/submission{submission_file.submission_id}/{submission_file.question_file.filename}'
+                entries.append((name, submission_file.filepath))
+    return zip_response(filename, entries)
 
 
 @blueprint.route('/file/<int:submission_file_id>')
 def submission_file_view(submission_file_id):
     context = get_context(submission_file_id=submission_file_id)
     # FIXME check permissions - only allow if have question where submission is a dependency
+    submission_file = context['submission_file']
+    start = request.args.get('start', 1, type=int)
+    etag = entity_tag('submission_file_view', submission_file.id, _file_version(submission_file), start, viewer_key(context))
+    return conditional_response(
+        partial(_render_submission_file, context, start),
+        etag,
+        last_modified=context['submission'].timestamp,
+    )
+
+
+def _render_submission_file(context, start):
+    # large files are only offered for download; others are shown a range of lines at a time
+    submission_file = context['submission_file']
+    size = submission_file.size
+    if size is None:
+        size = submission_file.filepath.stat().st_size
+    context['file_range'] = None
+    context['previous_url'] = None
+    context['next_url'] = None
+    if size <= current_app.config['FILE_VIEW_MAX_BYTES']:
+        file_range = current_app.highlighter.render(
+            _file_version(submission_file),
+            submission_file.filepath,
+            submission_file.question_file.filename,
+            first_line=start,
+        )
+        context['file_range'] = file_range
+        if file_range.first_line > 1:
+            context['previous_url'] = url_for(
+                'demograder.submission_file_view',
+                submission_file_id=submission_file.id,
+                start=(file_range.first_line - file_range.lines_per_range),
+            )
+        if file_range.last_line < file_range.num_lines:
+            context['next_url'] = url_for(
+                'demograder.submission_file_view',
+                submission_file_id=submission_file.id,
+                start=(file_range.last_line + 1),
+            )
     return render_template('student/submission_file.html', **context)
 
 
@@ -158,17 +368,117 @@ def submission_file_view(submission_file_id):
 def download_file(submission_file_id):
     context = get_context(submission_file_id=submission_file_id)
     submission_file = context['submission_file']
-    return send_file(
-        submission_file.filepath,
-        download_name=submission_file.question_file.filename,
-        as_attachment=True,
+    download_name = submission_file.question_file.filename
+    etag = entity_tag('download_file', _file_version(submission_file), download_name)
+    last_modified = context['submission'].timestamp
+    return conditional_response(
+        # send_file also answers range requests, with the same validators
+        partial(
+            send_file,
+            submission_file.filepath,
+            download_name=download_name,
+            as_attachment=True,
+            etag=etag,
+            last_modified=last_modified,
+        ),
+        etag,
+        last_modified=last_modified,
+        immutable=True,
+    )
+
+
+def _file_version(submission_file):
+    # files from before the content-addressed store have no digest, but
+    # they are not changed either
+    return submission_file.digest or f'legacy-{submission_file.id}'
+
+
+def zip_response(filename, entries):
+    """Stream a ZIP archive of files as a download.
+
+    The archive is compressed unless the URL has a "store" argument, which
+    is faster for files that are already compressed.
+
+    Parameters:
+        filename (str): The name of the archive, without the extension.
+        entries (List[Tuple[str, Path]]): The name in the archive and the path
+            on disk of each file.
+
+    Returns:
+        Response: The streaming response.
+    """
+    return Response(
+        stream_zip(entries, compress=('store' not in request.args)),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename={filename}.zip'},
     )
 
 
 # INSTRUCTOR
 
 
+def latest_submissions_response(filename, submissions, *directories):
+    """Stream the latest submission of each user as a ZIP archive.
+
+    Parameters:
+        filename (str): The name of the archive, without the extension.
+        submissions (Iterable[Submission]): The submissions.
+        *directories (Callable[[Submission], str]): Functions that give the
+            directories to put each submission in, before the submitter.
+
+    Returns:
+        Response: The streaming response.
+    """
+    entries = []
+    for submission in submissions:
+        path = '/'.join([
+            filename,
+            *(secure_filename(directory(submission)) for directory in directories),
+            submission.user.email,
+        ])
+        for submission_file in submission.files:
+            entries.append((f'{path}/{submission_file.question_file.filename}', submission_file.filepath))
+    return zip_response(filename, entries)
+
+
+@blueprint.route('/download_course/<int:course_id>')
+@use_read_replica
+@query_budget(20)
+def download_course(course_id):
+    context = get_context(course_id=course_id, min_course_role=CourseRole.INSTRUCTOR)
+    return latest_submissions_response(
+        f'course{course_id}',
+        context['course'].latest_submissions(),
+        (lambda submission: submission.question.assignment.name),
+        (lambda submission: submission.question.name),
+    )
+
+
+@blueprint.route('/download_assignment/<int:assignment_id>')
+@use_read_replica
+@query_budget(20)
+def download_assignment(assignment_id):
+    context = get_context(assignment_id=assignment_id, min_course_role=CourseRole.INSTRUCTOR)
+    return latest_submissions_response(
+        f'assignment{assignment_id}',
+        context['assignment'].latest_submissions(),
+        (lambda submission: submission.question.name),
+    )
+
+
+@blueprint.route('/download_question/<int:question_id>')
+@use_read_replica
+@query_budget(20)
+def download_question(question_id):
+    context = get_context(question_id=question_id, min_course_role=CourseRole.INSTRUCTOR)
+    return latest_submissions_response(
+        f'question{question_id}',
+        context['question'].latest_submissions(),
+    )
+
+
 @blueprint.route('/user_submissions/<int:user_id>')
+@use_read_replica
 def user_submissions_view(user_id):
     page_user = db.session.get(User, user_id)
     if not page_user:
@@ -177,60 +487,147 @@ def user_submissions_view(user_id):
     allowed = (
         context['user'].admin
         or context['viewer'].id == context['user'].id
-        or bool(context['viewer'].courses_with_student(page_user.id).first())
+        or context['viewer'].teaches_student(page_user.id)
     )
     if not allowed:
         abort(403)
     context['page_user'] = page_user
-    return render_template('user_submissions.html', **context)
+    submission_page(context, page_user.submissions)
+    return stream_page('user_submissions.html', **context)
+
+
+def parse_before(url_args):
+    """Parse the submission cutoff of the grades pages.
+
+    Parameters:
+        url_args (Mapping[str, str]): The URL arguments, with the date, hour,
+            and minute of the cutoff.
+
+    Returns:
+        DateTime: The cutoff, or None if there is no valid cutoff.
+    """
+    try:
+        iso_date = f'{url_args["date"]} {url_args["hour"]}:{url_args["minute"]}'
+        return DateTime.fromisoformat(iso_date)
+    except (KeyError, ValueError):
+        return None
+
+
+def grade_export_urls(endpoint):
+    """Get the export URLs for the current grades page, with the same cutoff."""
+    url_args = {
+        key: value for key, value in request.args.items()
+        if key in ('date', 'hour', 'minute')
+    }
+    return {
+        export_format: url_for(endpoint, **request.view_args, **url_args, format=export_format)
+        for export_format in EXPORT_FORMATS
+    }
+
+
+def grade_export_response(filename, course_id, question_condition):
+    """Stream grades as CSV or newline-delimited JSON.
+
+    Parameters:
+        filename (str): The name of the file, without the extension.
+        course_id (int): The ID of the course whose students are graded.
+        question_condition (ColumnElement): The condition that selects the
+            questions to grade.
+
+    Returns:
+        Response: The streaming response.
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+    grades = grade_rows(course_id, question_condition, before=parse_before(request.args))
+    return Response(
+        stream_with_context(export_lines(grades, export_format)),
+        mimetype=EXPORT_FORMATS[export_format],
+        headers={'Content-Disposition': f'attachment; filename={filename}.{export_format}'},
+    )
 
 
 @blueprint.route('/course_enrollment/<int:course_id>')
+@use_read_replica
 def course_enrollment_view(course_id):
     context = get_context(course_id=course_id, min_course_role=CourseRole.INSTRUCTOR)
     return render_template('instructor/course_enrollment.html', **context)
 
 
 @blueprint.route('/course_submissions/<int:course_id>')
+@use_read_replica
 def course_submissions_view(course_id):
     context = get_context(course_id=course_id, min_course_role=CourseRole.INSTRUCTOR)
-    return render_template('instructor/course_submissions.html', **context)
+    submission_page(context, context['course'].submissions, include_hidden=True, include_disabled=True)
+    return stream_page('instructor/course_submissions.html', **context)
+
+
+@blueprint.route('/export_course_grades/<int:course_id>')
+@use_read_replica
+def export_course_grades(course_id):
+    get_context(course_id=course_id, min_course_role=CourseRole.INSTRUCTOR)
+    return grade_export_response(
+        f'course{course_id}_grades',
+        course_id,
+        and_(Assignment.course_id == course_id, Question.visible == True),
+    )
 
 
 @blueprint.route('/assignment_grades/<int:assignment_id>')
+@use_read_replica
 def assignment_grades_view(assignment_id):
     context = get_context(assignment_id=assignment_id, min_course_role=CourseRole.INSTRUCTOR)
-    url_args = request.args.to_dict()
-    try:
-        iso_date = f'{url_args["date"]} {url_args["hour"]}:{url_args["minute"]}'
-        context['before'] = DateTime.fromisoformat(iso_date)
-    except (KeyError, ValueError):
-        context['before'] = None
+    context['before'] = parse_before(request.args)
+    context['export_urls'] = grade_export_urls('demograder.export_assignment_grades')
     return render_template('instructor/assignment_grades.html', **context)
 
 
+@blueprint.route('/export_assignment_grades/<int:assignment_id>')
+@use_read_replica
+def export_assignment_grades(assignment_id):
+    context = get_context(assignment_id=assignment_id, min_course_role=CourseRole.INSTRUCTOR)
+    return grade_export_response(
+        f'assignment{assignment_id}_grades',
+        context['course'].id,
+        and_(Question.assignment_id == assignment_id, Question.visible == True),
+    )
+
+
 @blueprint.route('/assignment_submissions/<int:assignment_id>')
+@use_read_replica
 def assignment_submissions_view(assignment_id):
     context = get_context(assignment_id=assignment_id, min_course_role=CourseRole.INSTRUCTOR)
-    return render_template('instructor/assignment_submissions.html', **context)
+    submission_page(context, context['assignment'].submissions, include_hidden=True, include_disabled=True)
+    return stream_page('instructor/assignment_submissions.html', **context)
 
 
 @blueprint.route('/question_grades/<int:question_id>')
+@use_read_replica
 def question_grades_view(question_id):
     context = get_context(question_id=question_id, min_course_role=CourseRole.INSTRUCTOR)
-    url_args = request.args.to_dict()
-    try:
-        iso_date = f'{url_args["date"]} {url_args["hour"]}:{url_args["minute"]}'
-        context['before'] = DateTime.fromisoformat(iso_date)
-    except (KeyError, ValueError):
-        context['before'] = None
+    context['before'] = parse_before(request.args)
+    context['export_urls'] = grade_export_urls('demograder.export_question_grades')
     return render_template('instructor/question_grades.html', **context)
 
 
+@blueprint.route('/export_question_grades/<int:question_id>')
+@use_read_replica
+def export_question_grades(question_id):
+    context = get_context(question_id=question_id, min_course_role=CourseRole.INSTRUCTOR)
+    return grade_export_response(
+        f'question{question_id}_grades',
+        context['course'].id,
+        (Question.id == question_id),
+    )
+
+
 @blueprint.route('/question_submissions/<int:question_id>')
+@use_read_replica
 def question_submissions_view(question_id):
     context = get_context(question_id=question_id, min_course_role=CourseRole.INSTRUCTOR)
-    return render_template('instructor/question_submissions.html', **context)
+    submission_page(context, context['question'].submissions, include_hidden=True, include_disabled=True)
+    return stream_page('instructor/question_submissions.html', **context)
 
 
 # FORMS
@@ -257,6 +654,7 @@ def user_form(user_id):
         if int(form.id.data) != user_id:
             abort(403)
         user = db.session.get(User, int(form.id.data))
+        forget_identities([user.email])
         user.preferred_name = form.preferred_name.data.strip()
         user.family_name = form.family_name.data.strip()
         # only an admin can change the email or the admin/faculty statuses
@@ -275,14 +673,12 @@ def user_form(user_id):
     # commit and return
     db.session.add(user)
     db.session.commit()
+    forget_identities([user.email])
     return redirect(url_for('demograder.root'))
 
 
-def find_emails(text):
-    return [
-        re_match.group(0) for re_match in
-        re.finditer(r'[0-9a-z._]+@[0-9a-z]+(\.[0-9a-z]+)+', text, flags=re.IGNORECASE)
-    ]
+def changed_emails(*enrollment_changes):
+    return set().union(*(changes.added | changes.removed for changes in enrollment_changes))
 
 
 @blueprint.route('/forms/course/', defaults={'course_id': None}, methods=('GET', 'POST'))
@@ -323,34 +719,41 @@ def course_form(course_id):
             section=int(form.section.data),
             title=form.title.data.strip(),
         )
-    # register instructors
-    form_instructors = set(find_emails(form.instructors.data.strip()))
-    curr_instructors = set(user.email for user in course.instructors)
-    for email in form_instructors - curr_instructors:
-        user = User.get_by_email(email)
-        if not user:
-            user = User(email=email)
-            db.session.add(user)
-        course.instructors.append(user)
-    for email in curr_instructors - form_instructors:
-        course.instructors.remove(User.get_by_email(email))
-    # register students
-    form_students = set(find_emails(form.students.data.strip()))
-    curr_students = set(user.email for user in course.students)
-    for email in form_students - curr_students:
-        user = User.get_by_email(email)
-        if not user:
-            user = User(email=email)
-            db.session.add(user)
-        course.students.append(user)
-    for email in curr_students - form_students:
-        course.students.remove(User.get_by_email(email))
-    # commit and return
+    # flush so a new course has an ID
     db.session.add(course)
+    db.session.flush()
+    # register instructors and students
+    instructor_changes = sync_enrollment(course.id, parse_roster(form.instructors.data), instructors=True)
+    student_changes = sync_enrollment(course.id, parse_roster(form.students.data))
+    # commit and return
     db.session.commit()
+    forget_identities(changed_emails(instructor_changes, student_changes))
     return redirect(url_for('demograder.course_view', course_id=course.id))
 
 
+@blueprint.route('/forms/roster/<int:course_id>', methods=('GET', 'POST'))
+def roster_form(course_id):
+    # get the context
+    context = get_context(course_id=course_id, min_course_role=CourseRole.INSTRUCTOR)
+    # create the form
+    form = RosterForm.build(context)
+    # if the form is not being submitted or does not validate, return
+    if not form.validate_on_submit():
+        return render_template('forms/roster.html', form=form, **context)
+    # sync the enrollment
+    roster = parse_roster(form.roster.data.read().decode('utf-8-sig'))
+    changes = sync_enrollment(
+        course_id,
+        roster,
+        instructors=(form.role.data == 'instructors'),
+        remove=form.remove_missing.data,
+    )
+    # commit and return
+    db.session.commit()
+    forget_identities(changed_emails(changes))
+    return redirect(url_for('demograder.course_enrollment_view', course_id=course_id))
+
+
 @blueprint.route('/forms/assignment/<int:course_id>/', defaults={'assignment_id': None}, methods=('GET', 'POST'))
 @blueprint.route('/forms/assignment/<int:course_id>/<int:assignment_id>/', methods=('GET', 'POST'))
 def assignment_form(course_id, assignment_id):
@@ -407,6 +810,7 @@ def question_form(assignment_id, question_id):
         if int(form.id.data) != question_id:
             abort(403)
         question = db.session.get(Question, int(form.id.data))
+        question.version = Question.version + 1
     else:
         question = Question(assignment_id=assignment_id)
     # update the Question
@@ -428,6 +832,10 @@ def question_form(assignment_id, question_id):
     # commit the question first, so we can create dependencies
     db.session.add(question)
     db.session.commit()
+    # update the derived visibility and due date of the assignment
+    question.assignment.update_summary()
+    db.session.add(question.assignment)
+    db.session.commit()
     # update dependencies
     for dependency_form in form.dependencies:
         question_dependency = db.session.scalar(
@@ -468,6 +876,9 @@ def question_form(assignment_id, question_id):
                 db.session.add(QuestionFile(question_id=question.id, filename=filename))
     for _, question_file in filenames.items():
         db.session.delete(question_file)
+    # update which upstream files students can view
+    db.session.flush()
+    FileGrant.refresh_question(question.id)
     # commit and return
     db.session.commit()
     return redirect(url_for('demograder.submission_view', question_id=question.id))
@@ -479,10 +890,53 @@ def question_form(assignment_id, question_id):
 @blueprint.route('/admin')
 def admin():
     context = get_context(min_site_role=SiteRole.ADMIN)
+    context['identity_cache_stats'] = current_app.identity_cache.stats()
+    context['fragment_cache_stats'] = current_app.fragment_cache.stats()
     return render_template('admin/home.html', **context)
 
 
+@blueprint.route('/admin/metrics')
+def admin_metrics():
+    # Prometheus cannot log in, so it can use a token instead
+    authorization = request.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        token = current_app.config['METRICS_TOKEN']
+        if not token or not hmac.compare_digest(authorization.encode('utf-8'), f'Bearer {token}'.encode('utf-8')):
+            # not abort(401), which redirects to the login page
+            return Response('invalid token\n', status=401, mimetype='text/plain', headers={'WWW-Authenticate': 'Bearer'})
+        export_format = 'prometheus'
+    else:
+        context = get_context(min_site_role=SiteRole.ADMIN)
+        export_format = request.args.get('format', 'html')
+    metrics = current_app.metrics.aggregate()
+    if export_format == 'prometheus':
+        return Response(format_prometheus(metrics), mimetype='text/plain; version=0.0.4')
+    context['metrics'] = dashboard(metrics)
+    return render_template('admin/metrics.html', **context)
+
+
+@blueprint.route('/admin/latency')
+@use_read_replica
+def admin_latency():
+    context = get_context(min_site_role=SiteRole.ADMIN)
+    group = request.args.get('group', 'question')
+    if group not in LATENCY_GROUPS:
+        abort(400)
+    days = request.args.get('days', current_app.config['LATENCY_REPORT_DAYS'], type=int)
+    course_id = request.args.get('course_id', type=int)
+    target_seconds = current_app.config['FEEDBACK_LATENCY_TARGET_SECONDS']
+    evaluations = evaluation_latencies(DateTime.now() - TimeDelta(days=days), course_id=course_id)
+    context['report'] = latency_report(evaluations, group, target_seconds)
+    context['group'] = group
+    context['groups'] = LATENCY_GROUPS
+    context['days'] = days
+    context['course_id'] = course_id
+    context['target_seconds'] = target_seconds
+    return render_template('admin/latency.html', **context)
+
+
 @blueprint.route('/admin/users')
+@use_read_replica
 def admin_users_view():
     context = get_context(min_site_role=SiteRole.ADMIN)
     context['users'] = db.session.scalars(
@@ -493,6 +947,7 @@ def admin_users_view():
 
 
 @blueprint.route('/admin/courses')
+@use_read_replica
 def admin_courses_view():
     context = get_context(min_site_role=SiteRole.ADMIN)
     context['courses'] = db.session.scalars(
@@ -503,14 +958,11 @@ def admin_courses_view():
 
 
 @blueprint.route('/admin/submissions')
+@use_read_replica
 def admin_submissions_view():
     context = get_context(min_site_role=SiteRole.ADMIN)
-    context['submissions'] = db.session.scalars(
-        select(Submission)
-        .order_by(Submission.timestamp.desc())
-        .limit(200)
-    )
-    return render_template('admin/submissions.html', **context)
+    submission_page(context, Submission.site_submissions)
+    return stream_page('admin/submissions.html', **context)
 
 
 # REDIRECTS
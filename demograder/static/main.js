@@ -0,0 +1,53 @@
+// update the scoreboard of a submission page as its results finish
+function followScoreboard(scoreboard) {
+    const labels = {tbd: 'TBD', pass: 'Pass', fail: 'Fail'};
+    function render(data) {
+        scoreboard.replaceChildren(...data.results.map(function (result) {
+            const link = document.createElement('a');
+            link.className = 'score ' + result.status;
+            link.href = result.url;
+            link.textContent = labels[result.status];
+            return link;
+        }));
+        if (data.results.length > 0) {
+            document.getElementById('results-summary').textContent = ': ' + data.passed + ' / ' + data.results.length;
+        }
+    }
+    function finish() {
+        document.getElementById('results-pending').remove();
+    }
+    // poll the status API; the browser revalidates with the ETag, so
+    // unchanged statuses cost the server no rendering
+    function poll() {
+        fetch(scoreboard.dataset.statusUrl, {cache: 'no-cache'})
+            .then(function (response) { return response.json(); })
+            .then(function (data) {
+                render(data);
+                if (data.results.length > 0 && data.pending === 0) {
+                    finish();
+                } else {
+                    setTimeout(poll, 10000);
+                }
+            })
+            .catch(function () { setTimeout(poll, 10000); });
+    }
+    const source = new EventSource(scoreboard.dataset.eventsUrl);
+    source.addEventListener('scoreboard', function (event) {
+        render(JSON.parse(event.data));
+    });
+    source.addEventListener('done', function () {
+        source.close();
+        finish();
+    });
+    source.addEventListener('error', function () {
+        // the server refused the stream; fall back to polling
+        if (source.readyState === EventSource.CLOSED) {
+            setTimeout(poll, 10000);
+        }
+    });
+}
+
+const scoreboard = document.getElementById('scoreboard');
+if (scoreboard && scoreboard.dataset.eventsUrl) {
+    followScoreboard(scoreboard);
+}
@@ -0,0 +1,121 @@
+"""Content-addressed storage for submitted files.
+
+Each file is stored once, at SUBMISSION_PATH/objects/ab/cdef..., where
+abcdef... is the SHA-256 digest of its contents. Identical files submitted
+by different students, or resubmitted by the same student, share the stored
+object. Objects that no SubmissionFile refers to are removed by
+collect_garbage().
+"""
+
+import os
+from hashlib import sha256
+from tempfile import NamedTemporaryFile
+from time import time
+
+from flask import current_app
+
+CHUNK_SIZE = 64 * 1024
+
+
+def objects_path():
+    return current_app.config['SUBMISSION_PATH'] / 'objects'
+
+
+def object_path(digest):
+    """Get the path of a stored object.
+
+    Parameters:
+        digest (str): The SHA-256 hex digest of the object.
+
+    Returns:
+        Path: The path of the object.
+    """
+    return objects_path() / digest[:2] / digest[2:]
+
+
+def store_file(stream):
+    """Store the contents of a file, hashing it as it is written.
+
+    Parameters:
+        stream (BinaryIO): The file to store.
+
+    Returns:
+        Tuple[str, int]: The digest and size of the stored object.
+    """
+    objects_path().mkdir(parents=True, exist_ok=True)
+    hasher = sha256()
+    size = 0
+    # write to a temporary file next to the objects, so it can be renamed
+    with NamedTemporaryFile(dir=objects_path(), prefix='.upload-', delete=False) as temp_file:
+        try:
+            while chunk := stream.read(CHUNK_SIZE):
+                hasher.update(chunk)
+                size += len(chunk)
+                temp_file.write(chunk)
+        except BaseException:
+            os.unlink(temp_file.name)
+            raise
+    digest = hasher.hexdigest()
+    path = object_path(digest)
+    try:
+        # protect the object from garbage collection until it is referenced
+        os.utime(path)
+    except FileNotFoundError:
+        # a new object, or one that collect_garbage() just deleted
+        path.parent.mkdir(exist_ok=True)
+        os.replace(temp_file.name, path)
+    else:
+        os.unlink(temp_file.name)
+    return digest, size
+
+
+def collect_garbage(reference_counts, grace_seconds=3600):
+    """Delete stored objects that are no longer referenced.
+
+    Objects (and abandoned uploads) younger than the grace period are kept,
+    since their SubmissionFile may not have been committed yet. An object is
+    moved aside before its age is checked again and it is deleted, so that an
+    upload that reuses it after the reference counts were taken either keeps
+    it (by touching it first) or stores it again (by finding it gone).
+
+    Parameters:
+        reference_counts (Dict[str, int]): The number of references to
+            each digest.
+        grace_seconds (float): The minimum age of objects to delete.
+            Defaults to 3600.
+
+    Returns:
+        Tuple[int, int]: The number of objects deleted and their total size.
+    """
+    if not objects_path().exists():
+        return 0, 0
+    cutoff = time() - grace_seconds
+    deleted = 0
+    freed = 0
+    for path in objects_path().glob('**/*'):
+        if not path.is_file():
+            continue
+        digest = path.parent.name + path.name
+        if reference_counts.get(digest, 0) > 0:
+            continue
+        stat = path.stat()
+        if stat.st_mtime > cutoff:
+            continue
+        if not path.name.startswith('.'):
+            # uploads only touch the object at its own path
+            aside = path.with_name(f'.collect-{path.name}')
+            try:
+                os.replace(path, aside)
+            except FileNotFoundError:
+                continue
+            stat = aside.stat()
+            if stat.st_mtime > cutoff:
+                # touched by an upload since the scan; its contents are the same
+                # as any copy stored since, so it can be put back over it
+                os.replace(aside, path)
+                continue
+            path = aside
+        path.unlink()
+        deleted += 1
+        freed += stat.st_size
+    return deleted, freed
@@ -0,0 +1,273 @@
+"""Seeded generation of realistic synthetic data, for benchmarks.
+
+This should only be run on a scratch database; see the generate-data
+command in commands.py.
+
+Every course has its own instructor and a sample of a shared pool of
+students, so that some students take several courses. Every assignment has
+a tests question, to which the instructor submits several test files, and
+student questions that depend on all of those tests, so that every student
+submission has one result per test. Submissions cluster before the due
+dates, as they do in practice.
+"""
+
+from datetime import datetime as DateTime, timedelta as TimeDelta
+from io import BytesIO
+from random import Random
+
+from sqlalchemy import func, insert, select
+
+from .models import db, User, Course, Instructor, Student, Assignment, Question
+from .models import QuestionFile, QuestionDependency, Submission, SubmissionFile
+from .models import Blob, Result, ResultDependency, FileGrant
+from .storage import store_file
+
+PREFERRED_NAMES = [
+    'Alex', 'Bo', 'Casey', 'Dana', 'Eli', 'Fatima', 'Gabriel', 'Hana', 'Ines', 'Jun',
+    'Kai', 'Lena', 'Mateo', 'Nia', 'Omar', 'Priya', 'Quinn', 'Rosa', 'Sam', 'Tariq',
+]
+
+FAMILY_NAMES = [
+    'Adams', 'Bui', 'Chen', 'Diaz', 'Evans', 'Fischer', 'Garcia', 'Haddad', 'Ito', 'Jones',
+    'Kim', 'Lopez', 'Mensah', 'Nguyen', 'Okafor', 'Patel', 'Rossi', 'Smith', 'Tanaka', 'Wang',
+]
+
+# the number of distinct files submitted to each question; resubmissions and
+# common solutions make identical files frequent
+FILE_VARIANTS = 20
+
+
+def generate_dataset(
+        seed=0, courses=4, students=60, assignments=8, questions=2, tests=3, submissions=3,
+        output_bytes=2000, now=None,
+):
+    """Generate courses, users, questions, submissions, and results.
+
+    Everything is inserted in bulk and committed at the end.
+
+    Parameters:
+        seed (int): The random seed. Defaults to 0.
+        courses (int): The number of courses. Defaults to 4.
+        students (int): The number of students per course. Defaults to 60.
+        assignments (int): The number of assignments per course. Defaults
+            to 8.
+        questions (int): The number of student questions per assignment.
+            Defaults to 2.
+        tests (int): The number of test files submitted by the instructor
+            to each assignment. Defaults to 3.
+        submissions (int): The average number of submissions per student
+            per question. Defaults to 3.
+        output_bytes (int): The average size of result output. Defaults to
+            2000.
+        now (DateTime): The current time; the last assignments are still
+            due after this. Defaults to now.
+
+    Returns:
+        Dict[str, int]: The number of rows created, by table.
+    """
+    rng = Random(seed)
+    if now is None:
+        now = DateTime.now().replace(microsecond=0)
+    counts = {}
+    # users
+    pool_size = max(students, courses * students * 3 // 4)
+    student_ids = _insert(User, [
+        {
+            'email': f'student{index}@example.edu',
+            'preferred_name': rng.choice(PREFERRED_NAMES),
+            'family_name': rng.choice(FAMILY_NAMES),
+        }
+        for index in range(pool_size)
+    ])
+    instructor_ids = _insert(User, [
+        {
+            'email': f'instructor{index}@example.edu',
+            'preferred_name': rng.choice(PREFERRED_NAMES),
+            'family_name': rng.choice(FAMILY_NAMES),
+            'faculty': True,
+        }
+        for index in range(courses)
+    ])
+    counts['users'] = pool_size + courses
+    # courses and enrollments
+    course_ids = _insert(Course, [
+        {
+            'season': 'Fall',
+            'year': now.year,
+            'department_code': 'COMP',
+            'number': str(100 + index),
+            'section': 0,
+            'title': f'Synthetic Course {index}',
+        }
+        for index in range(courses)
+    ])
+    counts['courses'] = courses
+    rosters = {
+        course_id: rng.sample(student_ids, students)
+        for course_id in course_ids
+    }
+    db.session.execute(insert(Instructor), [
+        {'user_id': instructor_id, 'course_id': course_id}
+        for course_id, instructor_id in zip(course_ids, instructor_ids)
+    ])
+    db.session.execute(insert(Student), [
+        {'user_id': student_id, 'course_id': course_id}
+        for course_id, roster in rosters.items()
+        for student_id in roster
+    ])
+    counts['enrollments'] = courses * (students + 1)
+    # assignments, due weekly, with the last two still open
+    assignment_rows = []
+    for course_id in course_ids:
+        for index in range(assignments):
+            assignment_rows.append({
+                'course_id': course_id,
+                'name': f'Assignment {index + 1}',
+                'visible': True,
+                'due_date': now + TimeDelta(weeks=(index - assignments + 2), hours=rng.randrange(24)),
+            })
+    assignment_ids = _insert(Assignment, assignment_rows)
+    counts['assignments'] = len(assignment_ids)
+    # questions; the tests question comes first in each assignment
+    question_rows = []
+    for assignment_id, assignment_row in zip(assignment_ids, assignment_rows):
+        for index in range(questions + 1):
+            question_rows.append({
+                'assignment_id': assignment_id,
+                'name': ('tests' if index == 0 else f'question{index}'),
+                'due_date': assignment_row['due_date'],
+                'visible': (index > 0),
+                'script': '#!/bin/sh\n\npython3 test.py\n',
+            })
+    question_ids = _insert(Question, question_rows)
+    counts['questions'] = len(question_ids)
+    question_file_ids = _insert(QuestionFile, [
+        {
+            'question_id': question_id,
+            'filename': ('test.py' if question_row['name'] == 'tests' else f'{question_row["name"]}.py'),
+        }
+        for question_id, question_row in zip(question_ids, question_rows)
+    ])
+    dependency_rows = []
+    per_assignment = questions + 1
+    for start in range(0, len(question_ids), per_assignment):
+        tests_id = question_ids[start]
+        for question_id in question_ids[start + 1:start + per_assignment]:
+            dependency_rows.append({
+                'producer_id': tests_id,
+                'consumer_id': question_id,
+                'input_type': 'all',
+                'submitters': 'instructors',
+                'viewable': rng.random() < 0.5,
+            })
+    db.session.execute(insert(QuestionDependency), dependency_rows)
+    counts['question_dependencies'] = len(dependency_rows)
+    # submissions, clustered before the due date
+    file_variants = {}
+    for question_id, question_row in zip(question_ids, question_rows):
+        file_variants[question_id] = [
+            store_file(BytesIO(f'# {question_row["name"]}, variant {variant}\n'.encode('utf-8') * (variant + 1)))
+            for variant in range(FILE_VARIANTS)
+        ]
+    submission_rows = []
+    test_submissions = {}
+    for index, (question_id, question_row) in enumerate(zip(question_ids, question_rows)):
+        course_id = assignment_rows[index // per_assignment]['course_id']
+        due_date = question_row['due_date']
+        if question_row['name'] == 'tests':
+            instructor_id = instructor_ids[course_ids.index(course_id)]
+            test_submissions[question_id] = (len(submission_rows), tests)
+            for test in range(tests):
+                submission_rows.append({
+                    'user_id': instructor_id,
+                    'question_id': question_id,
+                    'timestamp': due_date - TimeDelta(days=(7 + test)),
+                })
+            continue
+        for student_id in rosters[course_id]:
+            for _ in range(max(0, round(rng.gauss(submissions, submissions / 2)))):
+                timestamp = due_date - TimeDelta(hours=rng.expovariate(1 / 24))
+                if timestamp > now:
+                    continue
+                submission_rows.append({
+                    'user_id': student_id,
+                    'question_id': question_id,
+                    'timestamp': timestamp.replace(microsecond=0),
+                })
+    submission_ids = _insert(Submission, submission_rows)
+    counts['submissions'] = len(submission_ids)
+    question_file_by_question = dict(zip(question_ids, question_file_ids))
+    submission_file_rows = []
+    for submission_id, submission_row in zip(submission_ids, submission_rows):
+        question_id = submission_row['question_id']
+        digest, size = rng.choice(file_variants[question_id])
+        submission_file_rows.append({
+            'submission_id': submission_id,
+            'question_file_id': question_file_by_question[question_id],
+            'filename': ('test.py' if question_id in test_submissions else f'submission{submission_id}.py'),
+            'digest': digest,
+            'size': size,
+        })
+    db.session.execute(insert(SubmissionFile), submission_file_rows)
+    counts['submission_files'] = len(submission_file_rows)
+    # results, one per test; only outputs from a small pool, as most runs
+    # of the same tests produce the same output
+    outputs = []
+    for variant in range(FILE_VARIANTS):
+        line = f'test {variant}: ' + ('ok' if variant % 3 else 'FAILED') + '\n'
+        outputs.append(Blob.store(line * max(1, round(rng.expovariate(1 / output_bytes)) // len(line))))
+    empty = Blob.store('')
+    db.session.flush()
+    tests_by_question = {
+        dependency['consumer_id']: dependency['producer_id']
+        for dependency in dependency_rows
+    }
+    result_rows = []
+    result_upstreams = []
+    for submission_id, submission_row in zip(submission_ids, submission_rows):
+        question_id = submission_row['question_id']
+        if question_id not in tests_by_question:
+            continue
+        start, count = test_submissions[tests_by_question[question_id]]
+        for test_submission_id in submission_ids[start:start + count]:
+            queued_at = submission_row['timestamp']
+            started_at = queued_at + TimeDelta(seconds=rng.expovariate(1 / 5))
+            output = rng.choice(outputs)
+            result_rows.append({
+                'submission_id': submission_id,
+                'stdout_id': output.id,
+                'stderr_id': empty.id,
+                'return_code': (0 if rng.random() < 0.7 else 1),
+                'queued_at': queued_at,
+                'started_at': started_at,
+                'finished_at': started_at + TimeDelta(seconds=rng.expovariate(1 / 2)),
+            })
+            result_upstreams.append(test_submission_id)
+    result_ids = _insert(Result, result_rows)
+    counts['results'] = len(result_ids)
+    db.session.execute(insert(ResultDependency), [
+        {'result_id': result_id, 'submission_id': upstream_id}
+        for result_id, upstream_id in zip(result_ids, result_upstreams)
+    ])
+    FileGrant.refresh(select(Result.id))
+    counts['file_grants'] = db.session.scalar(select(func.count(FileGrant.id)))
+    db.session.commit()
+    return counts
+
+
+def _insert(model, rows):
+    """Insert rows in bulk.
+
+    Parameters:
+        model (db.Model): The model of the rows.
+        rows (List[Dict[str, Any]]): The rows.
+
+    Returns:
+        List[int]: The IDs of the rows, in order.
+    """
+    if not rows:
+        return []
+    return list(db.session.scalars(
+        insert(model).returning(model.id, sort_by_parameter_order=True),
+        rows,
+    ))
@@ -0,0 +1,252 @@
+"""Capture of request traces, and their replay as a load test.
+
+When TRAFFIC_CAPTURE_PATH is set, every request is appended to that file as
+a line of JSON, with the time it arrived, its endpoint and arguments, the ID
+of the logged in user, and its status and duration. Traces are anonymized:
+emails in the URL are replaced by user IDs, only numeric form fields are
+kept, and uploaded files are reduced to their size and suffix.
+
+replay_trace() re-issues a trace against an app, at the original pace or
+faster, and reports the latency of each endpoint. The app should use copies
+of the database and submissions the trace was captured on (so that the IDs
+match), and the "fake" sandbox (see workers.py), so that a deadline can be
+rehearsed on any machine.
+"""
+
+import json
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from threading import Lock, local
+from time import perf_counter, sleep, time
+
+from flask import g, request
+from sqlalchemy import select
+
+from .latency import percentile
+from .models import db, User
+
+# requests that are not worth capturing
+IGNORED_ENDPOINTS = {'static'}
+
+
+class TraceWriter:
+    """Appends request traces to a file, one JSON object per line.
+
+    Every process (eg. each gunicorn worker) appends to the same file. Each
+    line is written with a single write, so lines are not interleaved.
+    """
+
+    def __init__(self, path):
+        """Initialize the TraceWriter.
+
+        Parameters:
+            path (Path): The trace file.
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = Lock()
+        self.file = self.path.open('a', encoding='utf-8')
+
+    def write(self, trace):
+        line = json.dumps(trace, sort_keys=True) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+
+def init_traffic_capture(app):
+    """Capture the requests of the app, if TRAFFIC_CAPTURE_PATH is set.
+
+    Parameters:
+        app (Flask): The Flask app.
+
+    Returns:
+        TraceWriter: The writer of the traces, or None if capture is off.
+    """
+    if not app.config['TRAFFIC_CAPTURE_PATH']:
+        return None
+    writer = TraceWriter(app.config['TRAFFIC_CAPTURE_PATH'])
+
+    @app.before_request
+    def start_trace():
+        g.trace_start_time = (time(), perf_counter())
+
+    @app.after_request
+    def write_trace(response):
+        start_time = g.pop('trace_start_time', None)
+        if start_time is None or request.endpoint in IGNORED_ENDPOINTS:
+            return response
+        try:
+            trace = capture_request(start_time[0])
+        except Exception: # pylint: disable = broad-except
+            # capturing must never break the request
+            logging.exception(f'failed to capture {request.method} {request.path}')
+            return response
+        trace['status'] = response.status_code
+        trace['seconds'] = round(perf_counter() - start_time[1], 6)
+        writer.write(trace)
+        return response
+
+    return writer
+
+
+def capture_request(timestamp):
+    """Describe the current request, without personal information.
+
+    Parameters:
+        timestamp (float): When the request arrived, in seconds since the
+            epoch.
+
+    Returns:
+        Dict[str, Any]: The trace of the request.
+    """
+    identity = g.get('identity')
+    trace = {
+        'time': round(timestamp, 6),
+        'method': request.method,
+        'endpoint': request.endpoint,
+        'args': {name: _anonymize(value) for name, value in (request.view_args or {}).items()},
+        'query': {name: value for name, value in request.args.items() if '@' not in value},
+        'user': (identity.user_id if identity else None),
+    }
+    if request.method == 'POST':
+        # other form fields may be names, emails, or instructions
+        trace['form'] = {
+            name: value for name, value in request.form.items()
+            if value.isdigit()
+        }
+        trace['files'] = {
+            name: {'size': _file_size(file), 'suffix': Path(file.filename or '').suffix}
+            for name, file in request.files.items()
+        }
+    return trace
+
+
+def _anonymize(value):
+    if isinstance(value, str) and '@' in value:
+        return {'user': db.session.scalar(select(User.id).where(User.email == value))}
+    return value
+
+
+def _file_size(file):
+    stream = file.stream
+    position = stream.tell()
+    size = stream.seek(0, 2)
+    stream.seek(position)
+    return size
+
+
+def load_trace(path):
+    """Load a captured trace, in the order the requests arrived.
+
+    Parameters:
+        path (Path): The trace file.
+
+    Returns:
+        List[Dict[str, Any]]: The traces of the requests.
+    """
+    with Path(path).open(encoding='utf-8') as fd:
+        traces = [json.loads(line) for line in fd if line.strip()]
+    traces.sort(key=(lambda trace: trace['time']))
+    return traces
+
+
+def replay_trace(app, traces, speed=1, concurrency=32):
+    """Re-issue captured requests against an app.
+
+    Requests are sent through the Flask test client, logged in as the user
+    who made them, at the same relative times, divided by the speed. Each
+    uploaded file is replaced by as many distinct bytes.
+
+    Parameters:
+        app (Flask): The Flask app.
+        traces (List[Dict[str, Any]]): The traces, from load_trace().
+        speed (float): How many times faster to replay. Defaults to 1.
+        concurrency (int): The maximum number of requests in flight; later
+            requests are delayed if there are more. Defaults to 32.
+
+    Returns:
+        Dict[str, Any]: The number of requests, the seconds the replay took,
+            the p95 of how late requests were sent, and the count, errors,
+            and p50, p95 and p99 latency in seconds of each endpoint, with
+            the p95 from the capture for comparison.
+    """
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        emails = dict(db.session.execute(select(User.id, User.email)).all())
+    clients = local()
+    timings = defaultdict(list)
+    captured = defaultdict(list)
+    errors = defaultdict(int)
+    delays = []
+    lock = Lock()
+
+    def send(trace, scheduled_at):
+        if not hasattr(clients, 'client'):
+            clients.client = app.test_client()
+        client = clients.client
+        with client.session_transaction() as session:
+            if trace['user'] in emails:
+                session['user_email'] = emails[trace['user']]
+            else:
+                session.pop('user_email', None)
+        with app.test_request_context():
+            url = app.url_for(trace['endpoint'], **_replay_args(trace['args'], emails), **trace['query'])
+        data = None
+        if trace['method'] == 'POST':
+            data = dict(trace.get('form', {}))
+            for name, file in trace.get('files', {}).items():
+                data[name] = (BytesIO(_file_contents(file['size'])), 'file' + file['suffix'])
+        start = perf_counter()
+        response = client.open(url, method=trace['method'], data=data)
+        seconds = perf_counter() - start
+        response.close()
+        with lock:
+            delays.append(start - scheduled_at)
+            timings[trace['endpoint']].append(seconds)
+            captured[trace['endpoint']].append(trace['seconds'])
+            if response.status_code >= 500 or response.status_code != trace['status']:
+                errors[trace['endpoint']] += 1
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='replay') as executor:
+        futures = []
+        for trace in traces:
+            scheduled_at = start + (trace['time'] - traces[0]['time']) / speed
+            sleep(max(0, scheduled_at - perf_counter()))
+            futures.append(executor.submit(send, trace, scheduled_at))
+        for future in futures:
+            # raise any exception from building the request
+            future.result()
+    report = {
+        'requests': len(traces),
+        'seconds': perf_counter() - start,
+        'delay_p95': percentile(sorted(delays), 0.95),
+        'endpoints': {},
+    }
+    for endpoint, seconds in sorted(timings.items()):
+        seconds.sort()
+        report['endpoints'][endpoint] = {
+            'count': len(seconds),
+            'errors': errors[endpoint],
+            'p50': percentile(seconds, 0.5),
+            'p95': percentile(seconds, 0.95),
+            'p99': percentile(seconds, 0.99),
+            'captured_p95': percentile(sorted(captured[endpoint]), 0.95),
+        }
+    return report
+
+
+def _replay_args(args, emails):
+    return {
+        name: (emails.get(value['user']) if isinstance(value, dict) else value)
+        for name, value in args.items()
+    }
+
+
+def _file_contents(size):
+    # different submissions should not deduplicate to the same stored file
+    return (repr(perf_counter()).encode('utf-8') * (size // 8 + 1))[:size]
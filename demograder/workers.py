@@ -1,4 +1,6 @@
 import sys
+from datetime import datetime as DateTime
+from hashlib import sha256
 from itertools import chain
 from os import chmod, walk
 from os.path import join as join_path
@@ -6,8 +8,7 @@ from pathlib import Path
 from shutil import copyfile
 from subprocess import run as run_process, PIPE
 from tempfile import TemporaryDirectory
-
-from sqlalchemy import select
+from time import sleep
 
 # pylint: disable = import-outside-toplevel
 
@@ -15,45 +16,33 @@ sys.path.append(str(Path(__file__).parent.parent))
 
 
 def evaluate_submission(submission_id):
-    for result_id in create_empty_results(submission_id):
-        evaluate_result(result_id)
+    """Determine the results needed to evaluate a submission.
 
+    The results are not created here; instead, the return value is passed to
+    the result writer (see dispatch.py), which creates them and enqueues them
+    for evaluation.
 
-def create_empty_results(submission_id):
+    Returns:
+        int: The submission ID.
+        List[Tuple[int]]: The IDs of the upstream submissions for each result.
+    """
     from demograder import create_app
-    from demograder.models import db, Submission, Result, ResultDependency
-    with create_app(with_queue=False).app_context():
+    from demograder.instrumentation import job_query_stats
+    from demograder.models import db, Submission
+    app = create_app(with_queue=False)
+    with app.app_context(), job_query_stats(app, f'evaluate_submission({submission_id})'):
         submission = db.session.get(Submission, submission_id)
-        result_ids = []
-        for upstream_ids in submission.question.upstream_submission_id_sets:
-            result = Result(submission_id=submission_id)
-            db.session.add(result)
-            db.session.commit()
-            # need to commit the Result first so there is an id
-            for upstream_id in upstream_ids:
-                db.session.add(ResultDependency(result_id=result.id, submission_id=upstream_id))
-            db.session.commit()
-            result_ids.append(result.id)
-        return result_ids
+        return submission_id, submission.question.upstream_submission_id_sets
 
 
 def reevaluate_submission(submission_id):
-    delete_submission_results(submission_id)
-    evaluate_submission(submission_id)
+    # the result writer replaces the existing results
+    return evaluate_submission(submission_id)
 
 
 def reevaluate_result(result_id):
-    delete_result(result_id)
-    evaluate_result(result_id)
-
-
-def delete_submission_results(submission_id):
-    from demograder import create_app
-    from demograder.models import db, Result
-    with create_app(with_queue=False).app_context():
-        for result in db.session.scalars(select(Result).where(Result.submission_id == submission_id)):
-            db.session.delete(result)
-        db.session.commit()
+    # the result writer overwrites the existing output
+    return evaluate_result(result_id)
 
 
 def recursive_chmod(path):
@@ -74,10 +63,103 @@ def recursive_chmod(path):
             chmod(join_path(root, f), 0o777)
 
 
+def sudo_sandbox(config, temp_dir, timeout_seconds):
+    """Run an evaluation script as the nobody user.
+
+    Parameters:
+        config (Mapping[str, Any]): The app config.
+        temp_dir (Path): The directory with the script and the files.
+        timeout_seconds (int): The number of seconds before the script is
+            killed.
+
+    Returns:
+        bytes: The standard output of the script.
+        bytes: The standard error of the script.
+        int: The return code of the script, or -9 if it was killed.
+    """
+    completed_process = run_process(
+        [
+            'sudo',
+            '-u', 'nobody',
+            'timeout',
+            '-s', 'KILL',
+            str(timeout_seconds), str(temp_dir.joinpath('.script')),
+        ],
+        cwd=temp_dir,
+        stderr=PIPE,
+        stdout=PIPE,
+        check=False,
+    )
+    # Some programs (eg. Python) writes to directory (eg. __pycache__),
+    # but with the permissions of the executing user (in this case,
+    # nobody). This subprocess cleans all of that up.
+    run_process(
+        ['sudo', '-u', 'nobody', 'rm', '-rf', *temp_dir.iterdir()],
+        cwd=temp_dir,
+        check=False,
+    )
+    return completed_process.stdout, completed_process.stderr, completed_process.returncode
+
+
+def local_sandbox(config, temp_dir, timeout_seconds):
+    """Run an evaluation script as the current user, without isolation.
+
+    This is only for development and testing without root; see sudo_sandbox()
+    for the parameters and return values.
+    """
+    completed_process = run_process(
+        ['timeout', '-s', 'KILL', str(timeout_seconds), str(temp_dir.joinpath('.script'))],
+        cwd=temp_dir,
+        stderr=PIPE,
+        stdout=PIPE,
+        check=False,
+    )
+    return completed_process.stdout, completed_process.stderr, completed_process.returncode
+
+
+def fake_sandbox(config, temp_dir, timeout_seconds):
+    """Pretend to run an evaluation script, for benchmarks.
+
+    The script is not run. Instead, this waits for FAKE_SANDBOX_SECONDS and
+    outputs about FAKE_SANDBOX_OUTPUT_BYTES, derived from the files so that
+    different submissions have different output. See sudo_sandbox() for the
+    parameters and return values.
+    """
+    sleep(config['FAKE_SANDBOX_SECONDS'])
+    lines = []
+    for path in sorted(temp_dir.iterdir()):
+        lines.append(f'{path.name}: {sha256(path.read_bytes()).hexdigest()}\n'.encode('utf-8'))
+    output = b''.join(lines)
+    output = (output * (config['FAKE_SANDBOX_OUTPUT_BYTES'] // len(output) + 1))[:config['FAKE_SANDBOX_OUTPUT_BYTES']]
+    return output, b'', 0
+
+
+# the ways to run evaluation scripts; see EVALUATION_SANDBOX in settings.py
+SANDBOXES = {
+    'sudo': sudo_sandbox,
+    'local': local_sandbox,
+    'fake': fake_sandbox,
+}
+
+
 def evaluate_result(result_id):
+    """Evaluate a result.
+
+    The output is not saved here; instead, the return value is passed to the
+    result writer (see dispatch.py), which saves it.
+
+    Returns:
+        int: The result ID.
+        str: The standard output of the evaluation script.
+        str: The standard error of the evaluation script.
+        int: The return code of the evaluation script.
+        DateTime: When the evaluation script started.
+    """
     from demograder import create_app
+    from demograder.instrumentation import job_query_stats
     from demograder.models import db, Result
-    with create_app(with_queue=False).app_context():
+    app = create_app(with_queue=False)
+    with app.app_context(), job_query_stats(app, f'evaluate_result({result_id})'):
         result = db.session.get(Result, result_id)
         # create a temporary directory for evaluation
         with TemporaryDirectory() as temp_dir:
@@ -92,45 +174,16 @@ def evaluate_result(result_id):
                 for submission_file in submission.files:
                     copyfile(submission_file.filepath, temp_dir.joinpath(submission_file.question_file.filename))
             recursive_chmod(temp_dir)
-            completed_process = run_process(
-                [
-                    'sudo',
-                    '-u', 'nobody',
-                    'timeout',
-                    '-s', 'KILL',
-                    str(result.question.timeout_seconds), str(temp_dir.joinpath('.script')),
-                ],
-                cwd=temp_dir,
-                stderr=PIPE,
-                stdout=PIPE,
-                check=False,
-            )
-            stdout = completed_process.stdout.decode('utf-8')[:2**16]
-            stderr = completed_process.stderr.decode('utf-8')[:2**16]
-            return_code = completed_process.returncode
+            timeout_seconds = result.question.timeout_seconds
+            sandbox = SANDBOXES[app.config['EVALUATION_SANDBOX']]
+            # end the read transaction, so it is not held open while the script runs
+            db.session.close()
+            started_at = DateTime.now()
+            stdout, stderr, return_code = sandbox(app.config, temp_dir, timeout_seconds)
+            stdout = stdout.decode('utf-8')[:2**16]
+            stderr = stderr.decode('utf-8')[:2**16]
             if return_code == -9: # from timeout
                 stderr += '\n\n'
-                stderr += f'The program failed to complete within {result.question.timeout_seconds} seconds and was terminated.'
+                stderr += f'The program failed to complete within {timeout_seconds} seconds and was terminated.'
                 stderr = stderr.strip()
-            # Some programs (eg. Python) writes to directory (eg. __pycache__),
-            # but with the permissions of the executing user (in this case,
-            # nobody). This subprocess cleans all of that up.
-            completed_process = run_process(
-                ['sudo', '-u', 'nobody', 'rm', '-rf', *temp_dir.iterdir()],
-                cwd=temp_dir,
-                check=False,
-            )
-        result = db.session.get(Result, result_id)
-        result.stdout = stdout.strip()
-        result.stderr = stderr.strip()
-        result.return_code = return_code
-        db.session.add(result)
-        db.session.commit()
-
-
-def delete_result(result_id):
-    from demograder import create_app
-    from demograder.models import db, Result
-    with create_app(with_queue=False).app_context():
-        db.session.delete(db.session.get(Result, result_id))
-        db.session.commit()
+        return result_id, stdout.strip(), stderr.strip(), return_code, started_at
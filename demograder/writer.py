@@ -0,0 +1,100 @@
+"""A single database writer that commits many writes in one transaction."""
+
+import logging
+from queue import Queue as ThreadQueue, Empty
+from threading import Thread
+from time import monotonic
+from typing import Callable, List, Optional
+
+from .models import db
+
+__all__ = ['BatchWriter']
+
+# a write is run inside an app context, and may return a function to call after it is committed
+Write = Callable[[], Optional[Callable[[], None]]]
+
+
+class BatchWriter:
+    """A single thread that commits many writes in one transaction.
+
+    With SQLite, every transaction takes the database write lock and waits for
+    an fsync. Funnelling writes through one thread removes lock contention
+    between writers, and grouping the writes that arrive close together into
+    one transaction amortizes the fsync.
+
+    If a batch fails, its writes are retried one at a time, so that a single
+    bad write does not lose the others.
+    """
+
+    def __init__(self, app, max_batch: int = 100, max_delay: float = 0.05):
+        """Initialize the BatchWriter.
+
+        Parameters:
+            app (Flask): The Flask app, for the database session.
+            max_batch (int): The maximum number of writes per transaction.
+                Defaults to 100.
+            max_delay (float): The maximum number of seconds to wait for more
+                writes before committing. Defaults to 0.05.
+        """
+        self.app = app
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue: ThreadQueue = ThreadQueue()
+        self.thread = Thread(name='writer-thread', target=self._run, daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        """Return the approximate number of writes waiting to be committed."""
+        return self.queue.qsize()
+
+    def put(self, write: Write) -> None:
+        """Add a write to be committed.
+
+        Parameters:
+            write (Callable[[], Optional[Callable[[], None]]]): A function that
+                makes changes to db.session. It may return a function to call
+                (in an app context) after the changes are committed.
+        """
+        self.queue.put(write)
+
+    def _next_batch(self) -> List[Write]:
+        batch = [self.queue.get()]
+        deadline = monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        logging.info('writer thread started')
+        while True:
+            batch = self._next_batch()
+            with self.app.app_context():
+                try:
+                    after_commits = self._commit(batch)
+                except Exception: # pylint: disable = broad-except
+                    db.session.rollback()
+                    after_commits = []
+                    for write in batch:
+                        try:
+                            after_commits.extend(self._commit([write]))
+                        except Exception: # pylint: disable = broad-except
+                            db.session.rollback()
+                            logging.exception('failed to commit write')
+                # the writes are committed, so they must not be retried if these fail
+                for after_commit in after_commits:
+                    try:
+                        after_commit()
+                    except Exception: # pylint: disable = broad-except
+                        logging.exception('failed to run after a committed write')
+
+    @staticmethod
+    def _commit(batch: List[Write]) -> List[Callable[[], None]]:
+        after_commits = [write() for write in batch]
+        db.session.commit()
+        return [after_commit for after_commit in after_commits if after_commit is not None]
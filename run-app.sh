@@ -7,5 +7,8 @@ elif ! command -v systemctl >/dev/null 2>&1 && systemctl list-unit-files httpd &
     echo 'httpd service is running, and likely using port 5000'
     echo 'kill httpd as root with `systemctl stop httpd` first and try again'
 else
-    . demograder/secrets && gunicorn --bind 0.0.0.0:5000 'demograder:create_app()'
+    # a new revision invalidates the pages that browsers have cached
+    DEMOGRADER_CACHE_VERSION="${DEMOGRADER_CACHE_VERSION:-$(git rev-parse --short HEAD 2>/dev/null)}"
+    export DEMOGRADER_CACHE_VERSION
+    . demograder/secrets && gunicorn --bind 0.0.0.0:5000 --worker-class gthread --threads 128 'demograder:create_app()'
 fi
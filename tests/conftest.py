@@ -0,0 +1,51 @@
+"""Fixtures for tests on in-memory SQLite databases."""
+
+import pytest
+
+from demograder import create_app
+from demograder.models import db
+from demograder.synthetic import generate_dataset
+
+
+@pytest.fixture
+def make_app(monkeypatch, tmp_path):
+    """Create apps on in-memory SQLite databases.
+
+    The runtime files of the apps are kept in a temporary directory. Keyword
+    arguments set other environment variables, eg. DEMOGRADER_REPLICA_URI.
+    """
+
+    def make(**environ):
+        environ = {
+            'FLASK_SECRET_KEY': 'test',
+            'GOOGLE_CLIENT_ID': 'test',
+            'GOOGLE_CLIENT_SECRET': 'test',
+            'DEMOGRADER_DATABASE_URI': 'sqlite://',
+            'DEMOGRADER_SUBMISSION_PATH': str(tmp_path / 'submissions'),
+            'DEMOGRADER_METRICS_PATH': str(tmp_path / 'metrics'),
+            'DEMOGRADER_EVENTS_PATH': str(tmp_path / 'events'),
+            'DEMOGRADER_IDENTITY_GENERATION_PATH': str(tmp_path / 'identity-generation'),
+            'DEMOGRADER_EVALUATION_SANDBOX': 'fake',
+            **environ,
+        }
+        for name, value in environ.items():
+            monkeypatch.setenv(name, value)
+        app = create_app(with_queue=False, init_database=True)
+        app.config['TESTING'] = True
+        return app
+
+    return make
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+@pytest.fixture
+def dataset_app(app):
+    """An app with a small generated dataset."""
+    with app.app_context():
+        generate_dataset(courses=1, students=8, assignments=3, questions=2, tests=1, submissions=3)
+        db.session.commit()
+    return app
@@ -0,0 +1,74 @@
+import pytest
+from sqlalchemy import select
+
+from demograder.database import use_read_replica
+from demograder.database_checks import REPLICA_ONLY_EMAIL, check_database, prepare_replica
+from demograder.models import db, User
+from demograder.synthetic import generate_dataset
+
+
+def _add_views(app):
+
+    def find_replica_user():
+        return str(User.get_by_email(REPLICA_ONLY_EMAIL) is not None)
+
+    @use_read_replica
+    def replica_find_view():
+        return find_replica_user()
+
+    @use_read_replica
+    def replica_write_view():
+        db.session.add(User(email='written@example.com'))
+        db.session.commit()
+        return 'written'
+
+    app.add_url_rule('/test/primary', view_func=find_replica_user)
+    app.add_url_rule('/test/replica', view_func=replica_find_view)
+    app.add_url_rule('/test/write', view_func=replica_write_view)
+
+
+@pytest.fixture
+def replica_app(make_app):
+    """An app whose replica (a separate in-memory database) has a user the primary does not."""
+    app = make_app(DEMOGRADER_REPLICA_URI='sqlite://')
+    prepare_replica(app)
+    _add_views(app)
+    return app
+
+
+def _has_email(engine, email):
+    with engine.connect() as connection:
+        return connection.scalar(select(User.id).where(User.email == email)) is not None
+
+
+def test_replica_views_read_from_replica(replica_app):
+    client = replica_app.test_client()
+    assert client.get('/test/replica').get_data(as_text=True) == 'True'
+    assert client.get('/test/primary').get_data(as_text=True) == 'False'
+
+
+def test_replica_views_write_to_primary(replica_app):
+    assert replica_app.test_client().get('/test/write').status_code == 200
+    with replica_app.app_context():
+        assert _has_email(db.engines[None], 'written@example.com')
+        assert not _has_email(db.engines['replica'], 'written@example.com')
+
+
+def test_replica_views_read_from_primary_without_replica(app):
+    _add_views(app)
+    with app.app_context():
+        db.session.add(User(email=REPLICA_ONLY_EMAIL))
+        db.session.commit()
+    assert app.test_client().get('/test/replica').get_data(as_text=True) == 'True'
+
+
+def test_check_database(replica_app):
+    # this includes the latest submissions selected with row_number()
+    with replica_app.app_context():
+        generate_dataset(courses=1, students=8, assignments=3, questions=2, tests=1, submissions=3)
+        db.session.commit()
+    assert check_database(replica_app) == {
+        'replica reads': [],
+        'primary writes': [],
+        'latest submissions (row_number)': [],
+    }
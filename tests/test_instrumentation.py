@@ -0,0 +1,53 @@
+import logging
+
+import pytest
+from flask import request
+from sqlalchemy import select
+
+from demograder.instrumentation import QueryBudgetExceeded, job_query_stats, query_budget
+from demograder.models import db
+
+
+def _run_queries(count):
+    for _ in range(count):
+        db.session.execute(select(1))
+
+
+@pytest.fixture
+def budget_app(app):
+    """An app with a view that runs ?queries= queries on a budget of 2."""
+
+    @query_budget(2)
+    def queries_view():
+        _run_queries(request.args.get('queries', type=int))
+        return 'done'
+
+    app.add_url_rule('/test/queries', view_func=queries_view)
+    return app
+
+
+def test_strict_budget_raises(budget_app):
+    budget_app.config['QUERY_BUDGET_STRICT'] = True
+    with pytest.raises(QueryBudgetExceeded):
+        budget_app.test_client().get('/test/queries?queries=3')
+
+
+def test_strict_budget_allows_queries_within_budget(budget_app):
+    budget_app.config['QUERY_BUDGET_STRICT'] = True
+    assert budget_app.test_client().get('/test/queries?queries=2').status_code == 200
+
+
+def test_budget_only_logs_when_not_strict(budget_app, caplog):
+    with caplog.at_level(logging.WARNING):
+        response = budget_app.test_client().get('/test/queries?queries=3')
+    assert response.status_code == 200
+    assert 'ran 3 queries (budget 2)' in caplog.text
+
+
+def test_strict_budget_raises_for_jobs(app):
+    app.config['QUERY_BUDGET_STRICT'] = True
+    app.config['QUERY_BUDGET'] = 2
+    with app.app_context():
+        with pytest.raises(QueryBudgetExceeded):
+            with job_query_stats(app, 'test job'):
+                _run_queries(3)
@@ -0,0 +1,54 @@
+from sqlalchemy import select
+
+from demograder.models import db, Assignment, Question, Submission
+from demograder.query_plans import QueryCheck, check_query_plans
+
+
+def _sorted_course_submissions(objects):
+    # the course listing before it walked an index per question
+    return db.session.scalars(
+        select(Submission)
+        .join(Question)
+        .join(Assignment)
+        .where(Assignment.course_id == objects['course'])
+        .order_by(Submission.timestamp.desc(), Submission.id.desc())
+        .limit(100)
+    ).all()
+
+
+def _problems(app, checks=None):
+    with app.app_context():
+        report = check_query_plans(checks)
+    return {name: check_report['problems'] for name, check_report in report.items() if check_report['problems']}
+
+
+def test_checks_pass(dataset_app):
+    assert _problems(dataset_app) == {}
+
+
+def test_unindexed_sort_fails(dataset_app):
+    problems = _problems(dataset_app, [QueryCheck('sorted', _sorted_course_submissions)])
+    assert problems
+    assert all(problem.startswith('sort of submissions without an index') for problem in problems['sorted'])
+
+
+def test_allowed_sort_passes(dataset_app):
+    check = QueryCheck('sorted', _sorted_course_submissions, allowed_sorts=['submissions'])
+    assert _problems(dataset_app, [check]) == {}
+
+
+def test_full_scan_fails(dataset_app):
+    check = QueryCheck(
+        'scanned',
+        lambda objects: db.session.scalars(select(Submission).where(Submission.version == 1)).all(),
+    )
+    assert _problems(dataset_app, [check]) == {'scanned': ['full scan of submissions: SCAN submissions']}
+
+
+def test_missing_index_fails(dataset_app):
+    check = QueryCheck(
+        'listing',
+        lambda objects: list(db.session.get(Question, objects['question']).submissions(limit=10)),
+        indexes=['ix_submissions_timestamp'],
+    )
+    assert _problems(dataset_app, [check]) == {'listing': ['uses none of ix_submissions_timestamp']}